@@ -0,0 +1,547 @@
+# -*- coding: UTF-8 -*-
+"""
+The asyncio engine of the sending and receiving sockets.
+"""
+
+import asyncio
+import inspect
+import itertools
+import logging
+import socket
+import threading
+import time
+
+import fileLoader
+import fileMetrics
+import fileScheduler
+import fileSocket
+
+logger = logging.getLogger(__name__)
+
+_protocol = fileSocket._protocol
+
+
+class _loopQueue(object):
+    """A queue to put messages from any thread into an event loop, which has the put() of
+    multiprocessing.Queue for fileSocket.command.put().
+
+    Attributes:
+        loop: A event loop to get the messages.
+        scheduler: None or a instance of fileScheduler.sendScheduler to order the messages,
+        which is only used in the event loop.
+        queue: None or a asyncio.Queue of the messages, or of a mark of each message put into
+        scheduler, which is created in the event loop.
+    """
+    def __init__(self, loop, scheduler=None):
+        self.loop = loop
+        self.scheduler = scheduler
+        self.queue = None
+
+    def put(self, obj, block=True):
+        """Put a message into the queue, which is thread-safe.
+
+        Args:
+            obj: A message to put.
+            block: A bool kept for the interface of multiprocessing.Queue, as the queue is
+            unbounded.
+        """
+        self.loop.call_soon_threadsafe(self._put, obj)
+
+    def renew(self, filename, file_size):
+        """Start a new transmission of a file in the scheduler after the messages put before.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the current size of the file.
+        """
+        self.loop.call_soon_threadsafe(self.scheduler.renew, filename, file_size)
+
+    async def get(self):
+        """Get a message from the queue in the event loop.
+
+        Returns:
+            A message in the queue.
+        """
+        if self.scheduler is None:
+            return await self._get_queue().get()
+        # The marks of the stale blocks removed from the scheduler are skipped.
+        while True:
+            await self._get_queue().get()
+            cmd = self.scheduler.pop()
+            if cmd is not None:
+                return cmd
+
+    def _put(self, obj):
+        if self.scheduler is not None:
+            self.scheduler.put(obj)
+            obj = None
+        self._get_queue().put_nowait(obj)
+
+    def _get_queue(self):
+        # The asyncio.Queue is bound to the running loop by Python before 3.10.
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        return self.queue
+
+
+async def get_command(self, queue, retry=None):
+    """Get message from a given _loopQueue and run it as a coroutine.
+
+    The function in the message is resolved by its name on the instance, so that the messages
+    put for the threads of fileSocket are run by the coroutines with the same names.
+
+    Args:
+        self: A instance of the class which the coroutine is from.
+        queue: A instance of fileAsync._loopQueue to read message from.
+        retry: None or Exception to retry condition.
+    """
+    cmd = await queue.get()
+    coroutine = getattr(self, cmd[0].__name__)(*cmd[1:])
+    # The send commands of fileSocket._sendHandler return generators of actions.
+    if inspect.isgenerator(coroutine):
+        coroutine = self.transmit(coroutine)
+    if fileSocket.command.profile:
+        coroutine = _profile_command(cmd, coroutine)
+    if retry is None:
+        await coroutine
+    else:
+        try:
+            await coroutine
+        except retry:
+            fileMetrics.inc('command_retries', command=cmd[0].__name__)
+            queue.put(cmd)
+
+
+async def _profile_command(cmd, coroutine):
+    # The time is recorded as fileSocket.command.run() in the profiling mode.
+    name = cmd[0].__qualname__
+    start_time = time.monotonic()
+    if isinstance(cmd, fileSocket._timedCommand):
+        fileMetrics.observe('command_wait_seconds', start_time - cmd.put_time, command=name)
+    try:
+        await coroutine
+    finally:
+        fileMetrics.observe('command_run_seconds', time.monotonic() - start_time, command=name)
+
+
+async def run_in_executor(func, *args):
+    """Run a blocking function of disk or hashing work in the default executor.
+
+    Args:
+        func: A function to run.
+        *args: Arguments for the given function.
+
+    Returns:
+        The return of the function.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+class _sendTask(fileSocket._sendHandler):
+    """A coroutine-based task to send messages to dynamic connections, which runs the send
+    commands of fileSocket._sendHandler with the features in asyncEngine.features. The commands
+    are resumed in the executor, as they read and compress the data.
+
+    Attributes:
+        reader: None or a asyncio.StreamReader of the connection to the target address.
+        writer: None or a asyncio.StreamWriter of the connection to the target address.
+        cmd_queue: A instance of fileAsync._loopQueue to read message from
+        fileAsync.asyncSendSocket.
+        parent: A instance of fileAsync.asyncSendSocket which owns this task.
+        name: A string of the name of the task in the metrics.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, cmd_queue, parent):
+        self.reader = None
+        self.writer = None
+        self.cmd_queue = cmd_queue
+        self.parent = parent
+        self.name = 'Task-{}'.format(next(self._ids))
+
+    def start(self):
+        """Start the task in the event loop of the parent from any thread.
+        """
+        asyncio.run_coroutine_threadsafe(self.run(), self.parent.loop)
+
+    async def run(self):
+        """Start function for the task. The task is ended if the pool is shrunk.
+        """
+        try:
+            while self.parent.keep_thread(self):
+                await get_command(self, self.cmd_queue, retry=socket.error)
+            fileMetrics.remove_gauge('send_bytes_per_second', thread=self.name)
+        except Exception:
+            # The exception of a task is not printed like a thread, so it is logged instead.
+            logger.exception("Send task ended by an exception")
+            raise
+
+    async def transmit(self, actions):
+        """Run the actions of a send command in the event loop.
+
+        Args:
+            actions: A generator returned by a send command of fileSocket._sendHandler.
+        """
+        result = error = None
+        while True:
+            action = await run_in_executor(self.next_action, actions, result, error)
+            if action is None:
+                return
+            result = error = None
+            try:
+                result = await getattr(self, action[0])(*action[1:])
+            except socket.error as e:
+                error = e
+
+    async def open_connection(self, send_addr, max_retries=None, is_link=True):
+        """Connect to a target address by retrying with exponential backoff.
+
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            max_retries: None or a integer of the connecting attempts, which is infinite if None.
+            is_link: A bool of whether the message may be sent in a persistent link, which is not
+            implemented by the engine.
+
+        Raises:
+            socket.error: The target is not connected in max_retries attempts.
+        """
+        # Release the connection of the last failed transmission.
+        await self.close_connection()
+        wait_time = fileSocket._link.backoff_time
+        attempts = 0
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_connection(*send_addr)
+                return
+            except socket.error:
+                pass
+            fileMetrics.inc('reconnects')
+            attempts += 1
+            if max_retries is not None and attempts >= max_retries:
+                raise socket.error("Failed to connect to {}:{}".format(*send_addr))
+            await asyncio.sleep(wait_time)
+            wait_time = min(wait_time * 2, fileSocket._link.max_backoff_time)
+
+    async def close_connection(self):
+        """Pause the connection by closing it.
+        """
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except socket.error:
+            pass
+        self.reader = self.writer = None
+
+    async def write_package(self, code, args, fp=None):
+        """Send a message by given code and arguments.
+
+        Args:
+            code: A _protocol.code of the sending package code.
+            args: A tuple of the arguments of the message.
+            fp: None or a file pointer to send the raw data following the message, where the
+            position and size of the data are the first two arguments.
+        """
+        # The data is copied from the reused buffer, as the transport may keep it.
+        args = [bytes(arg) if isinstance(arg, memoryview) else arg for arg in args]
+        buffers = _protocol.pack_buffers(code, *args, version=self.get_version(code))
+        # Send a guide package of a fixed length to tell the length of the message.
+        self.writer.writelines([_protocol.guide_struct.pack(sum(map(len, buffers))), *buffers])
+        if fp is not None:
+            await self._send_raw(fp, *args[:2])
+        await self.writer.drain()
+
+    async def read_package(self):
+        """Receive a reply on the connection in fileSocket._link.reply_timeout.
+
+        Returns:
+            None if the connection is closed by the target, or a set of the code and arguments.
+
+        Raises:
+            socket.timeout: The target does not reply or close the connection.
+        """
+        try:
+            guide = await asyncio.wait_for(self.reader.readexactly(_protocol.guide_struct.size),
+                                           fileSocket._link.reply_timeout)
+            buffer_size, = _protocol.guide_struct.unpack(guide)
+            package = await asyncio.wait_for(self.reader.readexactly(buffer_size),
+                                             fileSocket._link.reply_timeout)
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.TimeoutError:
+            raise socket.timeout("No reply from the target")
+        return _protocol.unpack(package)
+
+    def get_tcp_info(self):
+        sock = None if self.writer is None else self.writer.get_extra_info('socket')
+        return fileSocket._poolController.get_tcp_info(sock)
+
+    async def _send_raw(self, fp, position, size):
+        """Send raw data of a file copied from the page cache to the connection by the kernel.
+
+        Args:
+            fp: A file pointer of the file.
+            position: A integer of the start position of the data.
+            size: A integer of the size of the data.
+        """
+        loop = asyncio.get_running_loop()
+        sent = await loop.sendfile(self.writer.transport, fp, position, size)
+        # Pad the data if the file is truncated meanwhile to keep the stream aligned.
+        if sent < size:
+            self.writer.write(bytes(size - sent))
+
+
+class asyncSendSocket(fileSocket.sendSocket):
+    """A thread-based class to send messages by a pool of fileAsync._sendTask in an event loop.
+
+    The commands from fileSocket.fileSocket are run in order by the thread as the ones of
+    fileSocket.sendSocket, so that the hashing of the files does not block the event loop.
+
+    Attributes:
+        thread_queue: A instance of fileAsync._loopQueue to transmit message from
+        fileAsync.asyncSendSocket to the tasks.
+        thread_list: A list of the _sendTask tasks.
+        peer_queue: A instance of fileAsync._loopQueue to transmit message to the swarm peers
+        from fileAsync.asyncSendSocket to the tasks out of the pool.
+        loop: A event loop to run the tasks.
+        controller: A instance of fileSocket._poolController which only records the sent blocks,
+        as the 'pool' feature is not implemented by the engine.
+    """
+    thread_list = list()
+    pool_lock = threading.Lock()
+
+    def __init__(self, send_addr, main_queue, send_queue, thread_queue, peer_queue, loop):
+        fileSocket.sendSocket.__init__(self, send_addr, main_queue, send_queue)
+        self.thread_queue = thread_queue
+        self.peer_queue = peer_queue
+        self.loop = loop
+        self.controller = fileSocket._poolController(self, self.min_sock_num, self.max_sock_num)
+
+    def start(self):
+        """Start function for multithreading.
+        """
+        while True:
+            self.get_command()
+
+    def new_thread(self, cmd_queue=None):
+        return _sendTask(self.thread_queue if cmd_queue is None else cmd_queue, self)
+
+
+class _recvTask(fileSocket._recvHandler):
+    """A coroutine-based task to receive messages from a connection, which handles them by
+    fileSocket._recvHandler in the executor with the features in asyncEngine.features.
+
+    Attributes:
+        buffer_size: A integer of the maximum size of raw block data read at once.
+        reader: A asyncio.StreamReader of the connection.
+        writer: A asyncio.StreamWriter of the connection.
+        loop: A event loop of the connection.
+        main_queue: A queue to transmit message from this task to fileSocket.fileSocket.
+        recv_dict: A instance of fileState.stateTable of the received files shared with
+        fileSocket.fileSocket.
+        share_folder: A string of the relative path of the shared folder.
+        peer_ip: None or a string of the ip of the connection.
+        streams: A dictionary of the stream id 0 (key) and fileSocket._recvStream (value) of the
+        transmission in the connection.
+        stream: A instance of fileSocket._recvStream of the transmission in the connection.
+    """
+    buffer_size = fileSocket._recvThread.buffer_size
+
+    def __init__(self, reader, writer, main_queue, recv_dict, share_folder):
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.main_queue = main_queue
+        self.recv_dict = recv_dict
+        self.share_folder = share_folder
+        peer = writer.get_extra_info('peername')
+        self.peer_ip = None if peer is None else peer[0]
+        self.streams = dict()
+        self.stream = None
+
+    async def run(self):
+        """Start function for the task. Keep receiving until the connection is closed.
+        """
+        try:
+            while not self.writer.is_closing():
+                package = await self._recv_package()
+                if package is None:
+                    break
+                await self.recv_package(package)
+        except (socket.error, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the connection. The unfinished transmission will be sent again.
+        """
+        self.writer.close()
+        self.close_streams()
+
+    def pause(self):
+        """Pause the connection by closing it, which is called by the handlers in the executor.
+        """
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+    def reply(self, code, *args):
+        """Reply a message on the connection in the basic framing, which is called by the
+        handlers in the executor.
+
+        Args:
+            code: A _protocol.code of the message.
+            *args: The arguments of the message.
+        """
+        package = _protocol.pack(code, *args)
+        self.loop.call_soon_threadsafe(self.writer.write,
+                                       _protocol.guide_struct.pack(len(package)) + package)
+
+    async def _recv_package(self):
+        """Receive a message by a guide package.
+
+        Returns:
+            None or A bytes of raw message.
+        """
+        try:
+            guide = await self.reader.readexactly(_protocol.guide_struct.size)
+        except asyncio.IncompleteReadError:
+            # The connection is closed by another socket.
+            return None
+        buffer_size, = _protocol.guide_struct.unpack(guide)
+        self.select_stream(0)
+        return await self.reader.readexactly(buffer_size)
+
+    async def recv_package(self, package):
+        """Parse a given message package. The raw block data following BLCK command is read in
+        the event loop, and the other messages are handled in the executor.
+
+        Args:
+            package: A bytes of received message.
+        """
+        package = _protocol.unpack(package)
+        if package[0] == _protocol.code.BLCK:
+            await self.recv_blck(*package[1:])
+        else:
+            await run_in_executor(self.dispatch, *package)
+
+    async def recv_blck(self, position, size):
+        """Receive BLCK command from another socket and the following raw block data.
+
+        Args:
+            position: A integer of the written position in the file.
+            size: A integer of the size of the raw block data.
+        """
+        end = position + size
+        while position < end:
+            data = await self.reader.readexactly(min(end - position, self.buffer_size))
+            await run_in_executor(self.stream.fw.write, position, data)
+            position += len(data)
+        fileMetrics.inc('recv_bytes', size)
+
+
+class asyncRecvSocket(object):
+    """A coroutine-based class to receive messages, where each accepted connection is served by
+    a fileAsync._recvTask.
+
+    Attributes:
+        recv_addr: A address-like set of the local ip and port.
+        main_queue: A queue to transmit message from fileAsync.asyncRecvSocket to
+        fileSocket.fileSocket.
+        recv_queue: A instance of fileAsync._loopQueue to transmit message to
+        fileAsync.asyncRecvSocket.
+        recv_dict: A instance of fileState.stateTable of the received files shared with
+        fileSocket.fileSocket.
+        share_folder: A string of the relative path of the shared folder, out of which the
+        received files are rejected.
+        recv_sock: A socket to bind the local address and listen connections.
+        server: None or a asyncio.Server serving the connections.
+    """
+    def __init__(self, recv_addr, main_queue, recv_queue, recv_dict, share_folder='./share'):
+        self.recv_addr = recv_addr
+        self.main_queue = main_queue
+        self.recv_queue = recv_queue
+        self.recv_dict = recv_dict
+        self.share_folder = share_folder
+        self.server = None
+
+        self.recv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allow rebinding the port when a restarted process left connections in TIME_WAIT.
+        self.recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.recv_sock.bind(self.recv_addr)
+        self.recv_sock.listen()
+
+    async def start(self):
+        """Start function for the event loop.
+        """
+        self.server = await asyncio.start_server(self.accept, sock=self.recv_sock)
+        while True:
+            await get_command(self, self.recv_queue)
+
+    async def accept(self, reader, writer):
+        """Serve an accepted connection.
+
+        Args:
+            reader: A asyncio.StreamReader of the connection.
+            writer: A asyncio.StreamWriter of the connection.
+        """
+        await _recvTask(reader, writer, self.main_queue, self.recv_dict, self.share_folder).run()
+
+    async def init_thread(self, num):
+        """Resize the receiving threads, which is not needed as every connection is served by a
+        task.
+
+        Args:
+            num: A integer of the number of threads.
+        """
+        pass
+
+
+class asyncEngine(object):
+    """An engine to send and receive messages for fileSocket.fileSocket by coroutines in one
+    event loop, instead of the sendSocket and recvSocket processes with a thread per socket.
+
+    The disk and hashing work is run in the default executor, so that the concurrent
+    transmissions only cost a task each.
+
+    Attributes:
+        features: A tuple of strings of the _protocol.features implemented by the engine.
+        loop: A event loop to run the tasks.
+        recv_queue: A instance of fileAsync._loopQueue to transmit message to
+        fileAsync.asyncRecvSocket.
+        my_send_socket: A instance of fileAsync.asyncSendSocket.
+        my_recv_socket: A instance of fileAsync.asyncRecvSocket.
+        send_thread: A thread of my_send_socket.
+        loop_thread: A thread of the event loop.
+    """
+    features = ('bundle', 'bz2', 'crc', 'dedup', 'delta', 'lzma', 'merkle', 'resume', 'sendfile',
+                'sparse', 'v2', 'zlib')
+
+    def __init__(self, send_addr, recv_addr, main_queue, send_queue, recv_dict,
+                 policy=fileScheduler.DEFAULT_POLICY, rules=None, share_folder='./share'):
+        self.loop = asyncio.new_event_loop()
+        self.recv_queue = _loopQueue(self.loop)
+        thread_queue = _loopQueue(self.loop, fileScheduler.sendScheduler(policy, rules))
+        peer_queue = _loopQueue(self.loop, fileScheduler.sendScheduler(policy, rules))
+        self.my_send_socket = asyncSendSocket(send_addr, main_queue, send_queue, thread_queue,
+                                              peer_queue, self.loop)
+        self.my_recv_socket = asyncRecvSocket(recv_addr, main_queue, self.recv_queue,
+                                              recv_dict, share_folder)
+
+        self.send_thread = threading.Thread(target=self.my_send_socket.start)
+        self.loop_thread = threading.Thread(target=self.run_loop)
+        self.send_thread.daemon = True
+        self.loop_thread.daemon = True
+
+    def start(self):
+        """Start function for the engine.
+        """
+        fileMetrics.set_gauge_function('send_threads', lambda: self.my_send_socket.thread_num)
+        self.loop_thread.start()
+        self.send_thread.start()
+
+    def run_loop(self):
+        """Start function for multithreading. Run the event loop.
+        """
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.my_recv_socket.start())
@@ -0,0 +1,369 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks of the transmission between two local nodes.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+# The slowest of several runs of the default workloads, against which the runs are compared.
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json')
+
+
+class peerProcess(object):
+    """A class to run a peer of main.py in its own directory on loopback.
+
+    Attributes:
+        name: A string of the name of the peer.
+        root: A string of the directory of the peer, where the share folder, the hash cache and
+        the journal are kept.
+        port: A integer of the local port.
+        peer_port: A integer of the port of the other peer.
+        engine: A string of the engine of fileSocket.fileSocket.
+        share: A string of the share folder of the peer.
+        process: None or a subprocess.Popen of the running peer.
+    """
+    def __init__(self, name, root, port, peer_port, engine='thread'):
+        self.name = name
+        self.root = os.path.join(root, name)
+        self.port = port
+        self.peer_port = peer_port
+        self.engine = engine
+        self.share = os.path.join(self.root, 'share')
+        self.process = None
+        os.makedirs(self.share, exist_ok=True)
+
+    def start(self):
+        """Start the peer, whose output is appended to its log file.
+        """
+        with open(os.path.join(self.root, 'peer.log'), 'a') as log:
+            # A new session lets the peer be killed with all its subprocesses.
+            self.process = subprocess.Popen(
+                [sys.executable, MAIN_PATH, '--ip', '127.0.0.1', '--port', str(self.port),
+                 '--peer-port', str(self.peer_port), '--engine', self.engine],
+                cwd=self.root, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def kill(self):
+        """Kill the peer and all its subprocesses.
+        """
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        self.process = None
+
+
+class shareDigest(object):
+    """A class to calculate the md5 of the files in a share folder, which are reused if the stat
+    signature of the files is not changed, so that waiting for a large file does not hash it
+    again and again.
+
+    Attributes:
+        share: A string of the share folder.
+        cache: A dictionary of absolute filepath (keys) and a set of the stat signature and md5
+        (values).
+    """
+    def __init__(self, share):
+        self.share = share
+        self.cache = dict()
+
+    def get(self, filename):
+        """Get the md5 of a file in the share folder.
+
+        Args:
+            filename: A string of the path of the file relative to the share folder.
+
+        Returns:
+            None if the file is not existed, or a string of the md5 of the file.
+        """
+        filepath = os.path.join(self.share, filename)
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        if filepath in self.cache and self.cache[filepath][0] == signature:
+            return self.cache[filepath][1]
+        md5 = hashlib.md5()
+        with open(filepath, 'rb') as fp:
+            for data in iter(lambda: fp.read(1024 * 1024), b''):
+                md5.update(data)
+        self.cache[filepath] = (signature, md5.hexdigest())
+        return md5.hexdigest()
+
+
+class benchmark(object):
+    """A class to benchmark the end-to-end synchronization of two peers on loopback by the test
+    phases of README and more workloads.
+
+    Each workload is generated by a seeded random generator out of the share folders and moved
+    into a share folder, and it is timed until the md5 of all the files match in the other share
+    folder.
+
+    Attributes:
+        root: A string of the working directory of the peers.
+        scale: A float of the scale of the sizes of the workloads.
+        timeout: A float of the maximum time (second) to wait for a workload.
+        interval_time: A float of the interval time (second) between checking the md5.
+        restart_time: A float of the waiting time (second) before a killed peer is restarted.
+        random: A random.Random of the content of the workloads.
+        peer_a: A instance of fileBenchmark.peerProcess.
+        peer_b: A instance of fileBenchmark.peerProcess.
+        results: A dictionary of workload names (keys) and dictionaries of the results (values).
+    """
+    interval_time = 0.05
+    restart_time = 1.0
+
+    def __init__(self, root, port=26101, peer_port=26102, engine='thread', scale=1.0,
+                 timeout=120.0, seed=201):
+        self.root = root
+        self.scale = scale
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.peer_a = peerProcess('A', root, port, peer_port, engine)
+        self.peer_b = peerProcess('B', root, peer_port, port, engine)
+        self.results = dict()
+
+    def run(self):
+        """Run all the workloads in order, as later ones depend on the files of earlier ones.
+
+        Returns:
+            A dictionary of the results.
+        """
+        try:
+            # PHASE 1: Start the peer A with an empty share folder.
+            self.peer_a.start()
+            time.sleep(self.restart_time)
+
+            # PHASE 2: Move a large file to A and start B.
+            files = self.generate({'file1.bin': self.size(128 * 1024 * 1024)})
+            self.move(files, self.peer_a)
+            start_time = time.time()
+            self.peer_b.start()
+            self.wait('large_file', files, self.peer_b, start_time)
+
+            # PHASE 3: Move a file and a folder of 50 files to B, then kill and restart A.
+            sizes = {'file2.ppt': self.size(20 * 1024 * 1024)}
+            for i in range(50):
+                sizes[os.path.join('folder', 'sub%d' % (i % 3), 'f%d' % i)] = \
+                    self.random.randint(1, self.size(100 * 1024))
+            files = self.generate(sizes)
+            self.move(files, self.peer_b)
+            self.peer_a.kill()
+            time.sleep(self.restart_time)
+            start_time = time.time()
+            self.peer_a.start()
+            self.wait('restart_tree', files, self.peer_a, start_time)
+
+            # Many small files in nested folders.
+            sizes = {os.path.join('small', 'd%d' % (i % 10), 'd%d' % (i % 7), 's%d.txt' % i):
+                     self.random.randint(1, self.size(8 * 1024)) for i in range(500)}
+            files = self.generate(sizes)
+            start_time = self.move(files, self.peer_a)
+            self.wait('small_files', files, self.peer_b, start_time)
+
+            # An in-place update of the large file.
+            files = {'file1.bin': None}
+            start_time = time.time()
+            with open(os.path.join(self.peer_a.share, 'file1.bin'), 'r+b') as fp:
+                fp.seek(os.path.getsize(fp.name) // 2)
+                fp.write(self.random.randbytes(4096))
+            self.wait('update', files, self.peer_b, start_time, source=self.peer_a)
+        finally:
+            self.peer_a.kill()
+            self.peer_b.kill()
+        return self.results
+
+    def size(self, size):
+        return max(int(size * self.scale), 1)
+
+    def generate(self, sizes):
+        """Generate the files of a workload in a staging folder.
+
+        Args:
+            sizes: A dictionary of the relative paths (keys) and sizes (values) of the files.
+
+        Returns:
+            A dictionary of the relative paths (keys) and md5 (values) of the files.
+        """
+        staging = os.path.join(self.root, 'staging')
+        files = dict()
+        for filename, size in sizes.items():
+            filepath = os.path.join(staging, filename)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            data = self.random.randbytes(size)
+            with open(filepath, 'wb') as fp:
+                fp.write(data)
+            files[filename] = hashlib.md5(data).hexdigest()
+        return files
+
+    def move(self, files, peer):
+        """Move the generated files into the share folder of a peer.
+
+        Args:
+            files: A dictionary of the relative paths (keys) and md5 (values) of the files.
+            peer: A instance of fileBenchmark.peerProcess.
+
+        Returns:
+            A float of the time when the files are moved.
+        """
+        staging = os.path.join(self.root, 'staging')
+        start_time = time.time()
+        for name in os.listdir(staging):
+            shutil.move(os.path.join(staging, name), os.path.join(peer.share, name))
+        return start_time
+
+    def wait(self, name, files, peer, start_time, source=None):
+        """Wait until the files match in the share folder of a peer, and record the result.
+
+        Args:
+            name: A string of the name of the workload.
+            files: A dictionary of the relative paths (keys) and md5 (values) of the files, where
+            the md5 is None to be read from the source peer.
+            peer: A instance of fileBenchmark.peerProcess which receives the files.
+            start_time: A float of the time when the workload is started.
+            source: None or a instance of fileBenchmark.peerProcess which sends the files.
+        """
+        if source is not None:
+            source_digest = shareDigest(source.share)
+            files = {filename: source_digest.get(filename) for filename in files}
+        digest = shareDigest(peer.share)
+        pending = dict(files)
+        while pending and time.time() - start_time < self.timeout:
+            pending = {filename: md5 for filename, md5 in pending.items()
+                       if digest.get(filename) != md5}
+            if pending:
+                time.sleep(self.interval_time)
+
+        self.results[name] = {
+            'ok': not pending,
+            'seconds': round(time.time() - start_time, 3),
+            'files': len(files),
+            'bytes': sum(os.path.getsize(os.path.join(peer.share, filename))
+                         for filename in files if filename not in pending),
+        }
+        print("{:<14} {:>4} {:>8.3f}s {}".format(name, 'ok' if not pending else 'FAIL',
+                                                 self.results[name]['seconds'],
+                                                 self.results[name]['files']), flush=True)
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """Compare the results against a baseline.
+
+    Args:
+        results: A dictionary of the results of the workloads.
+        baseline: A dictionary of the baseline results of the workloads.
+        tolerance: A float of the relative slowdown regarded as noise.
+        min_delta: A float of the absolute slowdown (second) regarded as noise.
+
+    Returns:
+        A list of strings of the failed or regressed workloads.
+    """
+    regressions = list()
+    for name, result in results.items():
+        if not result['ok']:
+            regressions.append(name)
+            continue
+        if name not in baseline:
+            continue
+        seconds = baseline[name]['seconds']
+        change = result['seconds'] - seconds
+        print("{:<14} {:>8.3f}s -> {:>8.3f}s ({:+.1f}%)".format(
+            name, seconds, result['seconds'], 100 * change / max(seconds, 1e-6)))
+        if change > min_delta and change > seconds * tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def _argparse():
+    parser = argparse.ArgumentParser(description="Benchmark two peers on loopback.")
+    parser.add_argument('--port', action='store', type=int, default=26101, dest='port',
+                        help='port of peer A')
+    parser.add_argument('--peer-port', action='store', type=int, default=26102, dest='peer_port',
+                        help='port of peer B')
+    parser.add_argument('--engine', action='store', choices=('thread', 'async'), default='thread',
+                        dest='engine', help='engine of the peers')
+    parser.add_argument('--scale', action='store', type=float, default=1.0, dest='scale',
+                        help='scale of the sizes of the workloads')
+    parser.add_argument('--timeout', action='store', type=float, default=120.0, dest='timeout',
+                        help='maximum time (second) of each workload')
+    parser.add_argument('--seed', action='store', type=int, default=201, dest='seed',
+                        help='seed of the content of the workloads')
+    parser.add_argument('--workdir', action='store', default=None, dest='workdir',
+                        help='directory to keep a new directory of the peers in, which is '
+                             'temporary and removed by default')
+    parser.add_argument('--output', action='store', default=None, dest='output',
+                        help='path of the JSON results')
+    parser.add_argument('--baseline', action='store', default=BASELINE_PATH, dest='baseline',
+                        help='path of the JSON results to compare against, or "none"')
+    parser.add_argument('--tolerance', action='store', type=float, default=0.2, dest='tolerance',
+                        help='relative slowdown regarded as noise')
+    parser.add_argument('--min-delta', action='store', type=float, default=0.25,
+                        dest='min_delta', help='absolute slowdown (second) regarded as noise')
+
+    return parser.parse_args()
+
+
+def main():
+    parser = _argparse()
+    # The peers run in a new directory under the given one, so that the files of the user are
+    # never removed, and it is kept for inspection.
+    if parser.workdir is not None:
+        os.makedirs(parser.workdir, exist_ok=True)
+    root = tempfile.mkdtemp(prefix='left-benchmark-', dir=parser.workdir)
+
+    try:
+        results = benchmark(root, parser.port, parser.peer_port, parser.engine, parser.scale,
+                            parser.timeout, parser.seed).run()
+    finally:
+        if parser.workdir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'engine': parser.engine,
+            'scale': parser.scale,
+            'seed': parser.seed,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+    if parser.output is not None:
+        with open(parser.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+    regressions = [name for name, result in results.items() if not result['ok']]
+    if parser.baseline != 'none':
+        with open(parser.baseline, 'r') as fp:
+            baseline = json.load(fp)
+        # The timings of another engine or scale are not comparable.
+        if all(baseline['meta'].get(key) == report['meta'][key] for key in ('engine', 'scale')):
+            regressions = compare(results, baseline['results'], parser.tolerance,
+                                  parser.min_delta)
+        else:
+            print("Baseline {} is of another engine or scale".format(parser.baseline))
+    if regressions:
+        print("Regressed or failed: {}".format(', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
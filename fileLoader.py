@@ -5,12 +5,70 @@
 # @Contact: zirui.zhou19@student.xjtlu.edu.cn
 """
 
+import bisect
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import hashlib
+import json
+import lzma
 import math
+import mmap
 import os
+import struct
+import threading
+import time
+import zlib
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import fileMetrics
 
 TEMP_FILE_SIZE = 32 * (1024 * 1024)
 DATA_SIZE = 32 * 1024
+HASH_READ_SIZE = 1024 * 1024
+HASH_CACHE_PATH = './.hash_cache'
+HASH_CACHE_SIZE = 64 * 1024
+HASH_CACHE_FLUSH_NUM = 1024
+HASH_CACHE_FLUSH_SIZE = 64 * (1024 * 1024)
+HASH_CACHE_FLUSH_TIME = 5.0
+JOURNAL_PATH = './.transfer_journal'
+RECEIVED_PATH = './.received_files'
+DELTA_BLOCK_SIZE = 64 * 1024
+DELTA_MIN_SIZE = 1024 * 1024
+PART_SUFFIX = '.leftpart'
+BUNDLE_THRESHOLD = 1024 * 1024
+BUNDLE_SIZE = TEMP_FILE_SIZE
+BUNDLE_FILE_NUM = 256
+DEDUP_MIN_SIZE = 1024 * 1024
+BLOCK_HASH_SIZE = 20
+COMPRESS_SIZE = 1024 * 1024
+COMPRESS_SAMPLE_SIZE = 64 * 1024
+COMPRESS_RATIO = 0.9
+READ_AHEAD_SIZE = 1024 * 1024
+READ_AHEAD_TIME = 0.01
+READ_AHEAD_WORKERS = 16
+HOLE_MIN_SIZE = 64 * 1024
+# The codecs are preferred in order, where the faster one is used if both sides support it.
+CODECS = ('zlib', 'lzma', 'bz2')
+
+_signature_format = struct.Struct('!I16s')
+_adler_mod = 65521
+_compressors = {
+    'zlib': lambda data: zlib.compress(data, 6),
+    'lzma': lambda data: lzma.compress(data, preset=1),
+    'bz2': lambda data: bz2.compress(data, 9),
+}
+_decompressors = {
+    'zlib': zlib.decompress,
+    'lzma': lzma.decompress,
+    'bz2': bz2.decompress,
+}
 
 
 class fileLoader(object):
@@ -22,11 +80,20 @@ class fileLoader(object):
         block_num: A integer of the number of split blocks by TEMP_FILE_SIZE.
         it: A iterator of number of blocks.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, bitmap=None):
+        """
+        Args:
+            filename: A string of the relative path of the file.
+            bitmap: None or a bytes of the bitmap of blocks to skip returned by
+            transferJournal.bitmap().
+        """
         self.filename = filename
         self.file_size = os.path.getsize(self.filename)
         self.block_num = math.ceil(self.file_size / TEMP_FILE_SIZE)
         self.it = iter(range(self.block_num))
+        if bitmap is not None:
+            skipped = int.from_bytes(bitmap, 'little')
+            self.it = iter([i for i in range(self.block_num) if not skipped >> i & 1])
 
     def __iter__(self):
         return self
@@ -38,21 +105,46 @@ class fileLoader(object):
 class blockLoader(object):
     """An iterator-like class to read a split block.
 
+    The next part of data is read ahead by a background thread into a ring of reusable buffers
+    while the current part is being sent. The size of the parts adapts to the rate at which they
+    are consumed, so that a fast socket gets fewer and larger messages.
+
     Attributes:
         filename: A string of the relative path of the target file.
         block_index: A integer of the index of this block.
         _start: A protected integer of start position for read().
         _end: A protected integer of end position for read().
         fp: A file pointer of the target file.
+        file_size: A integer of the size of the target file when opened.
+        adaptive: A bool of whether data_size is adapted to the consuming rate, which is False
+        after data_size is set.
+        position: A integer of the position of the next part of data.
+        holes: A list of [position, size] of the holes in the block found by find_holes(), which
+        are skipped by the iteration.
+        buffers: None or a list of the reusable buffers of the ring.
+        future: None or a concurrent.futures.Future of the part which is read ahead.
+        last_time: None or a float of the time when the last part was returned.
     """
-    def __init__(self, filename, block_index=0):
+    ring_size = 2
+
+    def __init__(self, filename, block_index=0, data_size=None):
         self.filename = filename
         self.block_index = block_index
+        self.adaptive = data_size is None
+        self._data_size = DATA_SIZE if data_size is None else data_size
+
+        self.fp = open(self.filename, 'rb')
+        self.file_size = os.fstat(self.fp.fileno()).st_size
         self._start = self.block_index * TEMP_FILE_SIZE
         self._end = min(self._start + TEMP_FILE_SIZE, self.file_size)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.fp.fileno(), self._start, self.size, os.POSIX_FADV_SEQUENTIAL)
 
-        self.fp = open(self.filename, 'rb')
-        self.fp.seek(self._start, os.SEEK_SET)
+        self.position = self._start
+        self.holes = list()
+        self.buffers = None
+        self.future = None
+        self.last_time = None
 
     def __iter__(self):
         return self
@@ -62,63 +154,1216 @@ class blockLoader(object):
 
         Returns:
             A integer of the position of the data.
-            A bytes of file data of DATA_SIZE in maximum.
+            A memoryview of file data of data_size in maximum, which is valid until the next
+            iteration as its buffer is reused.
         """
         # If the pointer is at the end of the block, stop reading.
-        if self.fp.tell() == self._end:
-            self.fp.close()
+        if self.position == self._end:
+            self.close()
             raise StopIteration
 
-        position = self.fp.tell()
-        data = self.fp.read(min(self._end - position, DATA_SIZE))
+        if self.adaptive and self.last_time is not None:
+            self._adapt(time.monotonic() - self.last_time)
+        if self.buffers is None:
+            self.buffers = [bytearray(max(self._data_size, READ_AHEAD_SIZE))
+                            for i in range(self.ring_size)]
+            self.future = self._read_ahead(0, self.position)
+
+        index, position, size = self.future.result()
+        self.position = self._skip_holes(position + size)
+        self.future = None
+        # Read the next part into the next buffer while this part is being sent.
+        if self.position < self._end:
+            self.future = self._read_ahead((index + 1) % self.ring_size, self.position)
 
-        return position, data
+        self.last_time = time.monotonic()
+        return position, memoryview(self.buffers[index])[:size]
+
+    def find_holes(self):
+        """Find the holes of the block in a sparse file by SEEK_DATA and SEEK_HOLE, so that they
+        are sent as HOLE commands instead of zero data. The holes smaller than HOLE_MIN_SIZE are
+        sent as data.
+
+        Returns:
+            A list of [position, size] of the holes.
+        """
+        if not hasattr(os, 'SEEK_HOLE'):
+            return self.holes
+        fd = self.fp.fileno()
+        position = self._start
+        while position < self._end:
+            try:
+                data_start = min(os.lseek(fd, position, os.SEEK_DATA), self._end)
+            except OSError as e:
+                # The file system does not support it.
+                if e.errno != errno.ENXIO:
+                    break
+                # There is no data from the position to the end of the file.
+                data_start = self._end
+            if data_start - position >= HOLE_MIN_SIZE:
+                self.holes.append([position, data_start - position])
+            if data_start == self._end:
+                break
+            position = min(os.lseek(fd, data_start, os.SEEK_HOLE), self._end)
+        self.position = self._skip_holes(self.position)
+        return self.holes
+
+    def is_sparse(self):
+        """Check whether the file has any hole, so that the receiver does not allocate it.
+
+        Returns:
+            A bool of whether the file is sparse.
+        """
+        if not hasattr(os, 'SEEK_HOLE'):
+            return False
+        try:
+            # A file without holes has its only hole at its end.
+            return os.lseek(self.fp.fileno(), 0, os.SEEK_HOLE) < self.file_size
+        except OSError:
+            return False
+
+    def get_ranges(self):
+        """Get the ranges of data in the block between the holes.
+
+        Returns:
+            A list of sets of the position and the size of the data.
+        """
+        ranges = list()
+        position = self._start
+        for start, size in self.holes + [[self._end, 0]]:
+            if start > position:
+                ranges.append((position, start - position))
+            position = start + size
+        return ranges
+
+    def sample(self, size):
+        """Read the data at the start of the block without moving the pointer.
+
+        Args:
+            size: A integer of the maximum size of the data.
+
+        Returns:
+            A bytes of the data.
+        """
+        # The holes are not sampled, as they are not sent.
+        position = self._skip_holes(self._start)
+        return os.pread(self.fp.fileno(), min(size, self._end - position), position)
+
+    def checksum(self):
+        """Get the CRC32 of the block without moving the pointer, e.g. for the block sent by
+        sendfile or with holes, where the holes are read as zeros without disk IO.
+
+        Returns:
+            A integer of the CRC32 of the data.
+        """
+        return get_checksum(self.fp.fileno(), self._start, self._end)
+
+    def close(self):
+        # Wait for the part in reading before the file descriptor is closed and reused.
+        if self.future is not None:
+            concurrent.futures.wait([self.future])
+            self.future = None
+        self.fp.close()
+
+    def _read_ahead(self, index, position):
+        # A part of data ends at the next hole.
+        end = min([start for start, _ in self.holes if start > position] + [self._end])
+        size = min(end - position, self._data_size)
+        # The buffer is grown if a larger size is set after the ring is allocated, which is safe
+        # as the part in it was returned before the last iteration.
+        if len(self.buffers[index]) < size:
+            self.buffers[index] = bytearray(size)
+        return get_read_executor().submit(self._read, index, position, size)
+
+    def _skip_holes(self, position):
+        for start, size in self.holes:
+            if start == position:
+                position += size
+        return position
+
+    def _read(self, index, position, size):
+        """Read a part of data into a buffer of the ring.
+
+        Args:
+            index: A integer of the index of the buffer.
+            position: A integer of the position of the data.
+            size: A integer of the size of the data.
+
+        Returns:
+            A set of the index of the buffer, the position and the size of the data.
+        """
+        view = memoryview(self.buffers[index])[:size]
+        received = 0
+        while received < size:
+            length = os.preadv(self.fp.fileno(), [view[received:]], position + received)
+            if length == 0:
+                # Pad the data if the file is truncated meanwhile to keep the block aligned. The
+                # changed file will be sent again after the next scanning.
+                view[received:] = bytes(size - received)
+                break
+            received += length
+        return index, position, size
+
+    def _adapt(self, elapsed):
+        # Size the next parts to be consumed in READ_AHEAD_TIME at the measured rate.
+        rate = self._data_size / max(elapsed, 1e-6)
+        size = int(rate * READ_AHEAD_TIME) // DATA_SIZE * DATA_SIZE
+        self._data_size = min(max(size, DATA_SIZE), READ_AHEAD_SIZE)
+
+    @property
+    def data_size(self):
+        return self._data_size
+
+    @data_size.setter
+    def data_size(self, size):
+        # A given size is kept, e.g. the size of the parts to compress.
+        self._data_size = size
+        self.adaptive = False
+
+    @property
+    def start(self):
+        return self._start
 
     @property
-    def file_size(self):
-        return os.path.getsize(self.filename)
+    def size(self):
+        return self._end - self._start
+
+
+class bundleLoader(object):
+    """An iterator-like class to read small files as a bundle, where the files are concatenated
+    in order.
+
+    Attributes:
+        manifest: A list of [filename, size, md5] of the files, where md5 is None if not needed.
+        size: A integer of the size of the bundle.
+        data_size: A integer of the maximum size of data in each iteration.
+        crcs: A list of integers of the CRC32 of the files read so far.
+        it: A iterator of the data.
+    """
+    def __init__(self, filenames, with_hash=False, data_size=DATA_SIZE):
+        """
+        Args:
+            filenames: A list of strings of the relative paths of the files.
+            with_hash: A bool of whether the md5 of the files are in the manifest.
+            data_size: A integer of the maximum size of data in each iteration.
+        """
+        self.manifest = list()
+        for filename in filenames:
+            try:
+                file_hash = get_file_info(filename) if with_hash else None
+                self.manifest.append([filename, os.path.getsize(filename), file_hash])
+            except OSError:
+                # The file is removed meanwhile.
+                continue
+        self.size = sum(entry[1] for entry in self.manifest)
+        self.data_size = data_size
+        self.crcs = list()
+        self.it = self._read()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Iterate next part of data in the bundle, which may span several files.
+
+        Returns:
+            A integer of the position of the data in the bundle.
+            A bytes of bundle data of data_size in maximum.
+        """
+        return next(self.it)
+
+    def sample(self, size):
+        """Read the data at the start of the bundle.
+
+        Args:
+            size: A integer of the maximum size of the data.
+
+        Returns:
+            A bytes of the data.
+        """
+        data = bytearray()
+        for filename, file_size, _ in self.manifest:
+            if len(data) >= size:
+                break
+            try:
+                with open(filename, 'rb') as fp:
+                    data += fp.read(min(file_size, size - len(data)))
+            except OSError:
+                continue
+        return bytes(data)
+
+    def checksums(self):
+        """Get the CRC32 of the files after the bundle is read, so that only the corrupt files
+        are sent again.
+
+        Returns:
+            A bytes of the concatenated CRC32 of the files.
+        """
+        return struct.pack('!{}I'.format(len(self.crcs)), *self.crcs)
+
+    def close(self):
+        self.it.close()
+
+    def _read(self):
+        buffer = bytearray()
+        position = 0
+        for filename, file_size, _ in self.manifest:
+            try:
+                fp = open(filename, 'rb')
+            except OSError:
+                fp = None
+            remaining = file_size
+            crc = 0
+            while remaining:
+                size = min(remaining, self.data_size - len(buffer))
+                data = fp.read(size) if fp is not None else b''
+                # Pad the file if it is truncated or removed meanwhile to keep the offsets of the
+                # manifest. The changed file will be sent again after the next scanning.
+                data = data if data else bytes(size)
+                crc = zlib.crc32(data, crc)
+                buffer += data
+                remaining -= len(data)
+                if len(buffer) == self.data_size:
+                    yield position, bytes(buffer)
+                    position += len(buffer)
+                    buffer.clear()
+            if fp is not None:
+                fp.close()
+            self.crcs.append(crc)
+        if buffer:
+            yield position, bytes(buffer)
+
+
+class deltaLoader(object):
+    """An iterator-like class to generate rsync-style delta of a file against the block
+    signatures of its old copy.
+
+    The blocks of the old copy are searched at every byte offset of the file by a rolling weak
+    checksum (adler32) and confirmed by a strong checksum (md5). The matched ranges are copied
+    from the old copy and the other ranges are sent as literal data.
+
+    Attributes:
+        filename: A string of the relative path of the file.
+        block_size: A integer of the block size of the signatures.
+        file_size: A integer of the size of the file.
+        fp: A file pointer of the file.
+        mm: None or a mmap of the file.
+        instructions: None or a list of (position, size, offset) of the delta where offset is None
+        for literal data. It is None if the delta is not smaller enough than the file.
+        it: A iterator of the instructions.
+    """
+    max_literal_ratio = 0.5
+
+    def __init__(self, filename, signatures, block_size=DELTA_BLOCK_SIZE):
+        self.filename = filename
+        self.block_size = block_size
+        self.fp = open(self.filename, 'rb')
+        self.file_size = os.fstat(self.fp.fileno()).st_size
+        self.mm = None
+        if self.file_size > 0:
+            self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.instructions = self._match(signatures)
+        self.it = iter(self.instructions or ())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Iterate next instruction of the delta.
+
+        Returns:
+            A integer of the position of the data in the file.
+            A integer of the size of the data.
+            None or a integer of the offset to copy from the old copy.
+            None or a bytes of literal data of DATA_SIZE in maximum.
+        """
+        try:
+            position, size, offset = next(self.it)
+        except StopIteration:
+            self.close()
+            raise
+        if offset is not None:
+            return position, size, offset, None
+        return position, size, None, self.mm[position: position + size]
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.fp.close()
+
+    def _match(self, signatures):
+        """Match the file against the block signatures.
+
+        Args:
+            signatures: A bytes of the signatures returned by get_signatures().
+
+        Returns:
+            None or a list of instructions.
+        """
+        table = dict()
+        for index, (weak, strong) in enumerate(_signature_format.iter_unpack(signatures)):
+            table.setdefault(weak, []).append((strong, index * self.block_size))
+
+        size = self.block_size
+        instructions = list()
+        literal = 0
+        start = position = 0
+        weak = None
+        while position + size <= self.file_size:
+            if weak is None:
+                weak = zlib.adler32(self.mm[position: position + size])
+                a, b = weak & 0xffff, weak >> 16
+
+            offset = None
+            if weak in table:
+                strong = hashlib.md5(self.mm[position: position + size]).digest()
+                offset = next((i for s, i in table[weak] if s == strong), None)
+            if offset is not None:
+                literal += self._add_literal(instructions, start, position)
+                self._add_copy(instructions, position, size, offset)
+                position += size
+                start = position
+                weak = None
+                continue
+
+            # Give up if most of the file is new, where sending the whole file is cheaper.
+            if position - start > 16 * size and literal + position - start > \
+                    self.max_literal_ratio * position:
+                return None
+            if position + size == self.file_size:
+                break
+
+            # Roll the weak checksum forward by one byte.
+            out_byte, in_byte = self.mm[position], self.mm[position + size]
+            a = (a - out_byte + in_byte) % _adler_mod
+            b = (b - size * out_byte + a - 1) % _adler_mod
+            weak = (b << 16) | a
+            position += 1
+
+        literal += self._add_literal(instructions, start, self.file_size)
+        if literal > self.max_literal_ratio * self.file_size:
+            return None
+        return instructions
+
+    @staticmethod
+    def _add_copy(instructions, position, size, offset):
+        # Merge the continuous copies into one instruction.
+        if instructions and instructions[-1][2] is not None:
+            last_position, last_size, last_offset = instructions[-1]
+            if last_position + last_size == position and last_offset + last_size == offset:
+                instructions[-1] = (last_position, last_size + size, last_offset)
+                return
+        instructions.append((position, size, offset))
+
+    @staticmethod
+    def _add_literal(instructions, start, end):
+        for position in range(start, end, DATA_SIZE):
+            instructions.append((position, min(end - position, DATA_SIZE), None))
+        return end - start
 
 
 class fileWriter(object):
-    """A file-like class to write a file from unpacked split data.
+    """A file-like class to write a file from unpacked split data by positional writing.
+
+    If a basis file is given, the file is rebuilt in a temporary file from the written data and
+    the ranges copied from the basis file, and then replaces the target file when closed.
+
+    The file is preallocated to its size by the first writer of a transmission, so that the
+    blocks written at scattered positions by the receiving threads are not fragmented, and the
+    size is set once instead of truncating the file after every block. A sparse file is only
+    extended, so that its holes are left unallocated.
 
     Attributes:
         filename: A string of the relative path of the target file.
         file_size: A integer of the file size of the file.
-        fp: A file pointer of the target file.
+        basis: None or a string of the relative path of the basis file.
+        sparse: A bool of whether the file is sparse, which is not preallocated.
+        path: A string of the relative path of the file to write.
+        fd: A file descriptor of the written file.
+        basis_fd: None or a file descriptor of the basis file.
+        start: None or a integer of the start position of the written range.
+        end: None or a integer of the end position of the written range.
     """
-    def __init__(self, filename, file_size):
+    def __init__(self, filename, file_size, basis=None, sparse=False):
         self.filename = filename
         self.file_size = file_size
+        self.basis = basis
+        self.sparse = sparse
+        self.path = filename + PART_SUFFIX if basis is not None else filename
 
         # If the path is not existed, create the path.
         filepath = os.path.dirname(filename)
         os.makedirs(filepath, exist_ok=True)
 
         # If the file is not existed, create the file.
-        open(filename, 'ab').close()
-        self.fp = open(filename, 'rb+')
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        self.basis_fd = os.open(basis, os.O_RDONLY) if basis is not None else None
+        self.start = None
+        self.end = None
+        self._allocate()
 
     def write(self, position, data):
-        self.fp.seek(position, os.SEEK_SET)
-        self.fp.write(data)
+        """Write data at the position without moving any file pointer.
+
+        Args:
+            position: A integer of the written position in the file.
+            data: A bytes-like object of the file data.
+        """
+        data = memoryview(data)
+        self._mark(position, len(data))
+        while data:
+            size = os.pwrite(self.fd, data, position)
+            data = data[size:]
+            position += size
+
+    def copy(self, position, offset, size, source_fd=None):
+        """Copy a range of the basis file or another file to the position.
+
+        Args:
+            position: A integer of the written position in the file.
+            offset: A integer of the position of the range in the source file.
+            size: A integer of the size of the range.
+            source_fd: None or a file descriptor of the source file instead of the basis file.
+        """
+        source_fd = self.basis_fd if source_fd is None else source_fd
+        self._mark(position, size)
+        end = offset + size
+        while offset < end:
+            try:
+                length = os.copy_file_range(source_fd, self.fd, end - offset, offset, position)
+            except (AttributeError, OSError):
+                # Copy by user space if the kernel does not support it between these files.
+                data = os.pread(source_fd, min(end - offset, DATA_SIZE), offset)
+                length = len(data)
+                self.write(position, data)
+            if length == 0:
+                raise EOFError("Copy beyond the source file of: {}".format(self.filename))
+            offset += length
+            position += length
+
+    def fill(self, position, size):
+        """Make a hole of the sent file read as zeros. Only the old data in the range is
+        overwritten, as the preallocated or extended range is read as zeros already.
+
+        Args:
+            position: A integer of the position of the hole in the file.
+            size: A integer of the size of the hole.
+        """
+        self._mark(position, size)
+        end = position + size
+        while position < end:
+            data = os.pread(self.fd, min(end - position, HASH_READ_SIZE), position)
+            # The range beyond the end of the file is read as zeros.
+            if not data:
+                break
+            if data.count(0) != len(data):
+                self.write(position, bytes(len(data)))
+            position += len(data)
+
+    def checksum(self):
+        """Get the CRC32 of the written range read back from the file, which is compared with
+        the CRC32 of the sent block.
+
+        Returns:
+            A integer of the CRC32 of the data.
+        """
+        if self.start is None:
+            return 0
+        return get_checksum(self.fd, self.start, self.end)
 
     def close(self):
-        self.fp.truncate(self.file_size)
-        self.fp.close()
+        os.close(self.fd)
+        if self.basis_fd is not None:
+            os.close(self.basis_fd)
+            os.replace(self.path, self.filename)
 
+    def _allocate(self):
+        # A larger file of the previous version is truncated, and a smaller one is extended by
+        # the first writer, while the other writers find the file in its size.
+        size = os.fstat(self.fd).st_size
+        if size > self.file_size:
+            os.ftruncate(self.fd, self.file_size)
+        elif size < self.file_size and self.sparse:
+            os.ftruncate(self.fd, self.file_size)
+        elif size < self.file_size:
+            try:
+                os.posix_fallocate(self.fd, size, self.file_size - size)
+            except (AttributeError, OSError):
+                # Extend the file without allocation if it is not supported.
+                os.ftruncate(self.fd, self.file_size)
 
-def get_file_info(filename):
-    """Calculate the md5 of the target file.
+    def _mark(self, position, size):
+        self.start = position if self.start is None else min(self.start, position)
+        self.end = position + size if self.end is None else max(self.end, position + size)
+
+
+class bundleWriter(object):
+    """A file-like class to write the files of a bundle from unpacked split data.
+
+    Attributes:
+        manifest: A list of [filename, size, md5] of the files in the bundle.
+        offsets: A list of integers of the start positions of the files in the bundle.
+        writers: A list of fileLoader.fileWriter of the files.
+    """
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.offsets = list()
+        position = 0
+        for filename, file_size, _ in self.manifest:
+            self.offsets.append(position)
+            position += file_size
+        self.writers = [fileWriter(filename, file_size) for filename, file_size, _ in manifest]
+
+    def write(self, position, data):
+        """Write data at the position of the bundle, which may span several files.
+
+        Args:
+            position: A integer of the written position in the bundle.
+            data: A bytes-like object of the bundle data.
+        """
+        data = memoryview(data)
+        index = bisect.bisect_right(self.offsets, position) - 1
+        while data and index < len(self.writers):
+            offset = self.offsets[index]
+            size = min(len(data), offset + self.manifest[index][1] - position)
+            if size > 0:
+                self.writers[index].write(position - offset, data[:size])
+                data = data[size:]
+                position += size
+            index += 1
 
-    This function depends on the md5sum shell-command in Linux.
+    def checksums(self):
+        """Get the CRC32 of the files read back from them.
+
+        Returns:
+            A bytes of the concatenated CRC32 of the files.
+        """
+        crcs = [get_checksum(writer.fd, 0, file_size)
+                for writer, (_, file_size, _) in zip(self.writers, self.manifest)]
+        return struct.pack('!{}I'.format(len(crcs)), *crcs)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class hashCache(object):
+    """A persistent LRU cache of file md5 and block hashes keyed by the relative path and the stat
+    signature (size, modification time in nanosecond and inode) of the file.
+
+    The cache is shared by processes through a json file. Entries of other processes are merged
+    when the file is changed on disk, and the least recently used entries are evicted when the
+    number of entries exceeds max_size. The block hashes of the entries are indexed to find the
+    local copies of blocks by content. The cache is locked for the threads of the same process,
+    and the file is merged and replaced under a file lock between the processes.
+
+    The file is rewritten only after enough entries or hashed bytes are changed, or some time
+    after the last writing, so that hashing many small files does not rewrite the whole cache for
+    each of them, while the md5 of a large file is shared with the other processes at once.
+
+    Attributes:
+        path: A string of the path of the cache file.
+        max_size: A integer of the maximum number of entries.
+        entries: A ordered dictionary of relative filepath (keys) and [size, mtime_ns, inode, md5,
+        block_hashes] (values) in the order of usage, where block_hashes is a string of the
+        concatenated hex sha1 of the blocks.
+        dirty: A bool of whether there are entries not flushed into the cache file.
+        dirty_num: A integer of the number of entries put since the last flushing.
+        dirty_size: A integer of the total size of the files put since the last flushing.
+        lock: A reentrant lock to access the entries exclusively.
+        _flush_time: A protected float of the monotonic time of the last flushing.
+        _mtime: A protected integer of the modification time of the cache file when last loaded.
+        _index: None or a protected dictionary of hex sha1 of blocks (keys) and (filename,
+        block_index) (values), which is rebuilt after the entries are changed.
+    """
+    def __init__(self, path=HASH_CACHE_PATH, max_size=HASH_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.dirty = False
+        self.dirty_num = 0
+        self.dirty_size = 0
+        self.lock = threading.RLock()
+        self._flush_time = time.monotonic()
+        self._mtime = None
+        self._index = None
+        self.load()
+
+    def load(self):
+        """Merge the entries in the cache file if it is changed since last loading.
+        """
+        with self.lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self._mtime:
+                    return
+                with open(self.path, 'r') as fp:
+                    entries = json.load(fp)
+            except (OSError, ValueError):
+                return
+            self._mtime = mtime
+
+            for filename, *entry in entries:
+                # The entries without block hashes are written by older versions.
+                if len(entry) != 5:
+                    continue
+                old_entry = self.entries.get(filename)
+                if old_entry is None:
+                    self.entries[filename] = entry
+                    self.entries.move_to_end(filename, last=False)
+                # An entry hashed by another process after the file is changed again replaces
+                # the one in memory.
+                elif entry[:3] != old_entry[:3] and entry[1] > old_entry[1]:
+                    self.entries[filename] = entry
+            self._index = None
+            self._evict()
+
+    def get(self, filename, signature):
+        """Get the cached md5 and block hashes of a file.
+
+        Args:
+            filename: A string of the relative path of the file.
+            signature: A set of the stat signature of the file.
+
+        Returns:
+            None or a set of (md5, block_hashes) of the file.
+        """
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None or tuple(entry[:3]) != signature:
+                # Another process may have hashed the file already.
+                self.load()
+                entry = self.entries.get(filename)
+                if entry is None or tuple(entry[:3]) != signature:
+                    return None
+            self.entries.move_to_end(filename)
+            return entry[3], entry[4]
+
+    def put(self, filename, signature, md5, block_hashes):
+        """Put the md5 and block hashes of a file into the cache.
+
+        Args:
+            filename: A string of the relative path of the file.
+            signature: A set of the stat signature of the file.
+            md5: A string of the md5 of the file.
+            block_hashes: A string of the concatenated hex sha1 of the blocks of the file.
+        """
+        with self.lock:
+            self.entries[filename] = [*signature, md5, block_hashes]
+            self.entries.move_to_end(filename)
+            self.dirty = True
+            self.dirty_num += 1
+            self.dirty_size += signature[0]
+            self._index = None
+            self._evict()
+
+    def find_block(self, block_hash):
+        """Find a local file holding a block by its hash. The file is checked to be not changed
+        since it was hashed.
+
+        Args:
+            block_hash: A string of the hex sha1 of the block.
+
+        Returns:
+            None or a set of (filename, block_index) of the block.
+        """
+        with self.lock:
+            hex_size = BLOCK_HASH_SIZE * 2
+            if self._index is None:
+                self._index = dict()
+                for filename, entry in self.entries.items():
+                    for i in range(0, len(entry[4]), hex_size):
+                        self._index[entry[4][i: i + hex_size]] = (filename, i // hex_size)
+            found = self._index.get(block_hash)
+            if found is None:
+                return None
+            try:
+                if get_signature(found[0]) != tuple(self.entries[found[0]][:3]):
+                    return None
+            except (OSError, KeyError):
+                return None
+            return found
+
+    def flush(self, force=False):
+        """Merge the entries of the other processes and write the entries into the cache file
+        atomically if enough entries are changed.
+
+        Args:
+            force: A bool of whether the changed entries are written regardless of the thresholds.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            if not force and self.dirty_num < HASH_CACHE_FLUSH_NUM and \
+                    self.dirty_size < HASH_CACHE_FLUSH_SIZE and \
+                    time.monotonic() - self._flush_time < HASH_CACHE_FLUSH_TIME:
+                return
+            with self._file_lock():
+                self.load()
+                temp_path = '{}.{}'.format(self.path, os.getpid())
+                with open(temp_path, 'w') as fp:
+                    json.dump([[filename, *entry] for filename, entry in self.entries.items()],
+                              fp)
+                os.replace(temp_path, self.path)
+                self._mtime = os.stat(self.path).st_mtime_ns
+            self.dirty = False
+            self.dirty_num = 0
+            self.dirty_size = 0
+            self._flush_time = time.monotonic()
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        # The updates of the other processes are not lost between merging and replacing the
+        # file. The lock is only for the threads of this process without fcntl.
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.dirty = True
+            self._index = None
+
+
+class transferJournal(object):
+    """A persistent journal of the verified blocks of the files in transmission, which allows
+    resuming the transmission after a restart, and of the md5 of the received versions, which
+    tells the received copies from the local changes after a restart.
+
+    Attributes:
+        path: A string of the path of the journal file.
+        entries: A dictionary of relative filepath (keys) and [file_size, file_hash, block_num,
+        bitmap] (values) where bit i of the integer bitmap marks that block i is verified.
+        received_path: A string of the path of the file of the received versions, where a line
+        of JSON [filename, md5] is appended for each received version.
+        received: A dictionary of relative filepath (keys) and the md5 of the last received
+        version (values) of the files.
+    """
+    def __init__(self, path=JOURNAL_PATH, received_path=RECEIVED_PATH):
+        self.path = path
+        self.entries = dict()
+        self.received_path = received_path
+        self.received = dict()
+        self.load()
+
+    def __contains__(self, filename):
+        return filename in self.entries
+
+    def load(self):
+        """Load the entries from the journal file.
+        """
+        try:
+            with open(self.path, 'r') as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            self.entries = dict()
+        self.received = dict()
+        line_num = 0
+        try:
+            with open(self.received_path, 'r') as fp:
+                for line in fp:
+                    line_num += 1
+                    try:
+                        filename, file_hash = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut by a crash.
+                        continue
+                    self.received[filename] = file_hash
+        except OSError:
+            return
+        # The versions replaced by later lines are dropped from the file.
+        if line_num > 2 * len(self.received):
+            temp_path = self.received_path + PART_SUFFIX
+            with open(temp_path, 'w') as fp:
+                fp.writelines(json.dumps(item) + '\n' for item in self.received.items())
+            os.replace(temp_path, self.received_path)
+
+    def save(self):
+        """Write the entries into the journal file atomically.
+        """
+        temp_path = self.path + PART_SUFFIX
+        with open(temp_path, 'w') as fp:
+            json.dump(self.entries, fp)
+        os.replace(temp_path, self.path)
+
+    def start(self, filename, file_size, file_hash, block_num):
+        """Start or continue the transmission of a file. The verified blocks are kept only if the
+        file is not changed.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the expected size of the file.
+            file_hash: A string of the expected md5 of the file.
+            block_num: A integer of the number of split blocks.
+        """
+        entry = self.entries.get(filename)
+        if entry is None or entry[:3] != [file_size, file_hash, block_num]:
+            self.entries[filename] = [file_size, file_hash, block_num, 0]
+            self.save()
+
+    def complete(self, filename, block_index):
+        """Mark a block of a file as verified.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_index: A integer of the index of the block.
+
+        Returns:
+            A bool of whether the block is verified for the first time.
+        """
+        entry = self.entries[filename]
+        if entry[3] >> block_index & 1:
+            return False
+        entry[3] |= 1 << block_index
+        self.save()
+        return True
+
+    def finish(self, filename):
+        """Remove a file from the journal.
+
+        Args:
+            filename: A string of the relative path of the file.
+        """
+        if self.entries.pop(filename, None) is not None:
+            self.save()
+
+    def receive(self, filename, file_hash):
+        """Record the md5 of a received version of a file, which is appended to the file of the
+        received versions, so that receiving many small files does not write all of them each
+        time.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the file.
+        """
+        if self.received.get(filename) == file_hash:
+            return
+        self.received[filename] = file_hash
+        with open(self.received_path, 'a') as fp:
+            fp.write(json.dumps([filename, file_hash]) + '\n')
+
+    def remaining(self, filename):
+        """Get the number of blocks of a file which are not verified.
+
+        Args:
+            filename: A string of the relative path of the file.
+
+        Returns:
+            A integer of the number of remaining blocks.
+        """
+        entry = self.entries[filename]
+        return entry[2] - bin(entry[3]).count('1')
+
+    def bitmap(self, filename):
+        """Get the bitmap of the verified blocks of a file.
+
+        Args:
+            filename: A string of the relative path of the file.
+
+        Returns:
+            A bytes of the bitmap where bit i (little-endian) marks block i.
+        """
+        entry = self.entries[filename]
+        return entry[3].to_bytes((entry[2] + 7) // 8, 'little')
+
+
+_hash_cache = None
+_hash_cache_lock = threading.Lock()
+
+
+def get_hash_cache():
+    """Get the hash cache of the current process, which is loaded at the first call.
+
+    Returns:
+        A instance of fileLoader.hashCache.
+    """
+    global _hash_cache
+    with _hash_cache_lock:
+        if _hash_cache is None:
+            _hash_cache = hashCache()
+    return _hash_cache
+
+
+_read_executor = None
+_read_executor_lock = threading.Lock()
+
+
+def get_read_executor():
+    """Get the thread pool of the current process to read the blocks ahead, which is created at
+    the first call.
+
+    Returns:
+        A instance of concurrent.futures.ThreadPoolExecutor.
+    """
+    global _read_executor
+    with _read_executor_lock:
+        if _read_executor is None:
+            _read_executor = concurrent.futures.ThreadPoolExecutor(READ_AHEAD_WORKERS)
+    return _read_executor
+
+
+def get_signature(filename):
+    """Get the stat signature of a file.
+
+    Args:
+        filename: A string of the relative path of the target file.
+
+    Returns:
+        A set of the size, modification time (nanosecond) and inode of the file.
+    """
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def hash_file(filename):
+    """Calculate the md5 of the target file and the sha1 of its blocks split by TEMP_FILE_SIZE
+    by reading it in large chunks.
 
     Args:
         filename: A string of the relative path of the target file.
 
     Returns:
         A string of the md5 of the target file.
+        A string of the concatenated hex sha1 of the blocks.
+    """
+    md5 = hashlib.md5()
+    block_hashes = list()
+    sha1 = hashlib.sha1()
+    block_size = 0
+    buffer = memoryview(bytearray(HASH_READ_SIZE))
+    with open(filename, 'rb', buffering=0) as fp:
+        while True:
+            size = fp.readinto(buffer)
+            if not size:
+                break
+            md5.update(buffer[:size])
+            # The chunks are aligned to the blocks since TEMP_FILE_SIZE is a multiple of
+            # HASH_READ_SIZE.
+            sha1.update(buffer[:size])
+            block_size += size
+            if block_size == TEMP_FILE_SIZE:
+                block_hashes.append(sha1.hexdigest())
+                sha1 = hashlib.sha1()
+                block_size = 0
+    if block_size:
+        block_hashes.append(sha1.hexdigest())
+    return md5.hexdigest(), ''.join(block_hashes)
+
+
+def get_signatures(filename, block_size=DELTA_BLOCK_SIZE):
+    """Calculate the rsync-style signatures of the full blocks of the target file.
+
+    Args:
+        filename: A string of the relative path of the target file.
+        block_size: A integer of the size of blocks.
+
+    Returns:
+        A bytes of the packed weak checksum (adler32) and strong checksum (md5) of each block.
+    """
+    signatures = list()
+    with open(filename, 'rb') as fp:
+        while True:
+            block = fp.read(block_size)
+            if len(block) < block_size:
+                break
+            signatures.append(_signature_format.pack(zlib.adler32(block),
+                                                     hashlib.md5(block).digest()))
+    return b''.join(signatures)
+
+
+def get_checksum(fd, start, end, crc=0):
+    """Get the CRC32 of a range of a file, which checks a block much faster than md5.
+
+    Args:
+        fd: A file descriptor of the file.
+        start: A integer of the start position of the range.
+        end: A integer of the end position of the range.
+        crc: A integer of the CRC32 of the preceding data to continue.
+
+    Returns:
+        A integer of the CRC32 of the range, where the data beyond the end of the file is
+        counted as zeros.
+    """
+    position = start
+    while position < end:
+        data = os.pread(fd, min(end - position, HASH_READ_SIZE), position)
+        if not data:
+            # Pad the data like blockLoader if the file is truncated meanwhile.
+            data = bytes(min(end - position, HASH_READ_SIZE))
+        crc = zlib.crc32(data, crc)
+        position += len(data)
+    return crc
+
+
+def get_file_info(filename):
+    """Calculate the md5 of the target file, which is reused from the hash cache if the file is
+    not changed.
+
+    Args:
+        filename: A string of the relative path of the target file.
+
+    Returns:
+        A string of the md5 of the target file.
+    """
+    return _get_hashes(filename)[0]
+
+
+def get_block_hashes(filename):
+    """Calculate the sha1 of the blocks of the target file, which is reused from the hash cache if
+    the file is not changed.
+
+    Args:
+        filename: A string of the relative path of the target file.
+
+    Returns:
+        A bytes of the concatenated sha1 of the blocks split by TEMP_FILE_SIZE.
+    """
+    return bytes.fromhex(_get_hashes(filename)[1])
+
+
+def copy_blocks(filename, file_size, block_hashes):
+    """Copy the blocks of a file from the local files holding the same content.
+
+    Args:
+        filename: A string of the relative path of the file.
+        file_size: A integer of the size of the file.
+        block_hashes: A bytes of the concatenated sha1 of the blocks of the file.
+
+    Returns:
+        A list of integers of the indexes of the blocks held locally.
+    """
+    cache = get_hash_cache()
+    # Merge the local files hashed by the scanner.
+    cache.load()
+    copied = list()
+    writer = None
+    for block_index in range(len(block_hashes) // BLOCK_HASH_SIZE):
+        block_hash = block_hashes[block_index * BLOCK_HASH_SIZE:
+                                  (block_index + 1) * BLOCK_HASH_SIZE].hex()
+        found = cache.find_block(block_hash)
+        if found is None:
+            continue
+        source, source_index = found
+        if source == filename:
+            # The block is not changed in the old copy of the file. The other blocks of the old
+            # copy may be overwritten, so they are not copied.
+            if source_index == block_index:
+                copied.append(block_index)
+            continue
+
+        position = block_index * TEMP_FILE_SIZE
+        size = min(TEMP_FILE_SIZE, file_size - position)
+        try:
+            if writer is None:
+                writer = fileWriter(filename, file_size)
+            source_fd = os.open(source, os.O_RDONLY)
+            try:
+                writer.copy(position, source_index * TEMP_FILE_SIZE, size, source_fd)
+            finally:
+                os.close(source_fd)
+        except (OSError, EOFError):
+            # The source file is changed or removed meanwhile.
+            continue
+        copied.append(block_index)
+    if writer is not None:
+        writer.close()
+    return copied
+
+
+def _get_hashes(filename):
+    cache = get_hash_cache()
+    signature = get_signature(filename)
+    hashes = cache.get(filename, signature)
+    if hashes is None:
+        with fileMetrics.timer('hash_seconds'):
+            hashes = hash_file(filename)
+        fileMetrics.inc('hashed_bytes', signature[0])
+        cache.put(filename, signature, *hashes)
+    return hashes
+
+
+def is_shared(filename, root):
+    """Decide whether a path received from another socket is a file in the shared folder, so that
+    the paths like '../secret' or those through a symbolic link out of the folder are rejected.
+
+    Args:
+        filename: A string of the relative path of the file.
+        root: A string of the relative path of the shared folder.
+
+    Returns:
+        A bool of whether the file is in the shared folder.
+    """
+    if os.path.isabs(filename):
+        return False
+    root = os.path.realpath(root)
+    path = os.path.realpath(filename)
+    return path != root and os.path.commonpath([root, path]) == root
+
+
+def split_bundles(filenames):
+    """Split small files into bundles by BUNDLE_SIZE and BUNDLE_FILE_NUM.
+
+    Args:
+        filenames: A list of strings of the relative paths of the files.
+
+    Returns:
+        A list of lists of strings of the relative paths of the files in each bundle.
+    """
+    bundles = list()
+    size = 0
+    for filename in filenames:
+        file_size = os.path.getsize(filename) if os.path.isfile(filename) else 0
+        if not bundles or size + file_size > BUNDLE_SIZE or len(bundles[-1]) >= BUNDLE_FILE_NUM:
+            bundles.append(list())
+            size = 0
+        bundles[-1].append(filename)
+        size += file_size
+    return bundles
+
+
+def compress(codec, data):
+    """Compress data by a codec.
+
+    Args:
+        codec: A string of the codec in CODECS.
+        data: A bytes-like object of the data.
+
+    Returns:
+        A bytes of the compressed data.
+    """
+    return _compressors[codec](data)
+
+
+def decompress(codec, data):
+    """Decompress data by a codec.
+
+    Args:
+        codec: A string of the codec in CODECS.
+        data: A bytes-like object of the compressed data.
+
+    Returns:
+        A bytes of the data.
+    """
+    return _decompressors[codec](data)
+
+
+def is_compressible(codec, sample):
+    """Decide whether data is worth compressing by compressing a sample of it. The compressed
+    media (e.g. images, videos and archives) are not compressible.
+
+    Args:
+        codec: A string of the codec in CODECS.
+        sample: A bytes of the sample data.
+
+    Returns:
+        A bool of whether the sample is compressed by COMPRESS_RATIO at least.
     """
-    # TODO(Zirui): Make md5 calculation compatible in Windows.
-    md5 = os.popen('md5sum ' + filename).read().split()[0]
-    return md5
+    return len(compress(codec, sample)) < len(sample) * COMPRESS_RATIO
@@ -0,0 +1,305 @@
+# -*- coding: UTF-8 -*-
+"""
+The Merkle tree of the shared folder, which finds the changed files between peers.
+"""
+
+import bisect
+import hashlib
+import os
+import threading
+
+import fileLoader
+
+MERKLE_BUCKET_SIZE = 64
+HEX_DIGITS = '0123456789abcdef'
+
+
+def get_key(filename):
+    """Get the position of a file in the tree, which spreads the files evenly whatever the
+    layout of the directories is.
+
+    Args:
+        filename: A string of the relative path of the file.
+
+    Returns:
+        A string of the hex sha1 of the path.
+    """
+    return hashlib.sha1(os.fsencode(filename)).hexdigest()
+
+
+def get_leaf(filename, file_size, file_hash):
+    """Get the hash of a leaf of the tree.
+
+    Args:
+        filename: A string of the relative path of the file.
+        file_size: A integer of the size of the file.
+        file_hash: A string of the md5 of the file.
+
+    Returns:
+        A bytes of the sha1 of the path, size and md5 of the file.
+    """
+    return hashlib.sha1('{}\0{}\0{}'.format(filename, file_size, file_hash).encode()).digest()
+
+
+def is_newer(entry, peer_entry):
+    """Decide whether a local version of a file replaces the version of another socket. The
+    versions are ordered by the md5 of the versions they are received as, instead of the
+    modification times which differ between the clocks of the hosts, and a received copy gets
+    the time when it is received.
+
+    Args:
+        entry: A list of [size, md5, base, mtime_ns] of the local file, where base is the md5 of
+        the version it is received as or an empty string.
+        peer_entry: A list of [size, md5, base, mtime_ns] of the file of another socket, where
+        base is None if the file is still in transmission.
+
+    Returns:
+        A bool of whether the local version is newer.
+    """
+    file_size, file_hash, base, mtime = entry
+    peer_size, peer_hash, peer_base, peer_mtime = peer_entry
+    if peer_base is None or [file_size, file_hash] == [peer_size, peer_hash]:
+        return False
+    # A received copy is never newer, nor the version which another socket is changed from.
+    if file_hash == base or file_hash == peer_base:
+        return False
+    # Another socket holds the version changed from or a received copy.
+    if peer_hash == base or peer_hash == peer_base:
+        return True
+    # Both versions are changed locally, e.g. while the sockets are disconnected. The later one
+    # is guessed by the times, and the md5 breaks the tie, so that only one socket sends.
+    return (mtime, file_hash) > (peer_mtime, peer_hash)
+
+
+class merkleTree(object):
+    """A Merkle tree over (path, size, md5) of the files in the shared folder, which is compared
+    with the tree of another socket by descending only into the differing subtrees.
+
+    The files are sorted by the hex sha1 of their paths, and a node of the tree is a prefix of
+    the keys with a child for each following hex digit. The hash of a node is the sha1 of the
+    leaves under it, so the root is the same for the same files. A node with at most
+    MERKLE_BUCKET_SIZE files is sent with its files instead of its children.
+
+    The tree is refreshed in place instead of built again. The md5 of the files whose size and
+    modification time are not changed are kept in the tree, so that a large shared folder is not
+    hashed again when its entries are evicted from the bounded hash cache, and only the nodes
+    above the changed leaves are hashed again.
+
+    Attributes:
+        files: A dictionary of relative filepath (keys) and [size, md5, base, mtime_ns] (values)
+        of the files, where base is the md5 of the version the file is received as or an empty
+        string, and base and mtime_ns are None if the file is still in transmission.
+        keys: A sorted list of the keys of the files.
+        names: A list of relative filepath in the order of keys.
+        leaves: A list of the hashes of the leaves in the order of keys.
+        nodes: A dictionary of prefixes (keys) and the hex hashes of the nodes (values) computed
+        so far.
+        lock: A lock to access the tree exclusively, as it is refreshed by a thread while it is
+        read by another.
+        refresh_lock: A lock to refresh the tree by one thread at a time.
+    """
+    def __init__(self, files=None):
+        self.files = dict()
+        self.keys = list()
+        self.names = list()
+        self.leaves = list()
+        self.nodes = dict()
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        if files:
+            self.update(files)
+
+    def refresh(self, root, recv_dict, journal):
+        """Refresh the tree by the files in a root path. Only the new files and the files whose
+        size or modification time is changed are hashed, where the md5 is still reused from the
+        hash cache after a restart. The folder is walked without holding the lock.
+
+        Args:
+            root: A string of the root path.
+            recv_dict: A instance of fileState.stateTable of the received files.
+            journal: A instance of fileLoader.transferJournal, whose files in transmission are
+            added by their expected size and md5, so that they are not sent again, and whose
+            received versions tell the received copies.
+
+        Returns:
+            A string of the root hash of the refreshed tree.
+        """
+        with self.refresh_lock:
+            files = dict()
+            for path, dirs, names in os.walk(root):
+                for name in names:
+                    if name.endswith(fileLoader.PART_SUFFIX):
+                        continue
+                    filename = os.path.join(path, name)
+                    if isinstance(recv_dict.get(filename), int):
+                        entry = journal.entries.get(filename)
+                        if entry is not None:
+                            files[filename] = entry[:2] + [None, None]
+                        continue
+                    try:
+                        stat = os.stat(filename)
+                        entry = self.files.get(filename)
+                        if entry is None or entry[0] != stat.st_size or \
+                                entry[3] != stat.st_mtime_ns:
+                            entry = [stat.st_size, fileLoader.get_file_info(filename), '',
+                                     stat.st_mtime_ns]
+                        files[filename] = entry[:2] + [journal.received.get(filename, ''),
+                                                       entry[3]]
+                    except OSError:
+                        continue
+            fileLoader.get_hash_cache().flush()
+
+            changes = {filename: entry for filename, entry in files.items()
+                       if self.files.get(filename) != entry}
+            changes.update((filename, None) for filename in self.files.keys() - files.keys())
+            with self.lock:
+                self.update(changes)
+                return self.root
+
+    def update(self, changes):
+        """Apply the changed files to the tree, which drops the hashes of the nodes above them.
+
+        Args:
+            changes: A dictionary of relative filepath (keys) and [size, md5, base, mtime_ns] of
+            the changed files or None of the removed files (values).
+        """
+        # Many changes (e.g. the first refreshing) are sorted at once instead of one by one.
+        if len(changes) * 16 > len(self.files):
+            for filename, entry in changes.items():
+                if entry is None:
+                    self.files.pop(filename, None)
+                else:
+                    self.files[filename] = entry
+            entries = sorted((get_key(filename), filename) for filename in self.files)
+            self.keys = [key for key, _ in entries]
+            self.names = [filename for _, filename in entries]
+            self.leaves = [get_leaf(filename, *self.files[filename][:2])
+                           for filename in self.names]
+            self.nodes = dict()
+            return
+
+        for filename, entry in changes.items():
+            key = get_key(filename)
+            index = bisect.bisect_left(self.keys, key)
+            is_found = index < len(self.keys) and self.keys[index] == key
+            if entry is None:
+                if not is_found:
+                    continue
+                del self.keys[index], self.names[index], self.leaves[index]
+                del self.files[filename]
+            else:
+                leaf = get_leaf(filename, *entry[:2])
+                if is_found:
+                    self.leaves[index] = leaf
+                else:
+                    self.keys.insert(index, key)
+                    self.names.insert(index, filename)
+                    self.leaves.insert(index, leaf)
+                self.files[filename] = entry
+            for i in range(len(key) + 1):
+                self.nodes.pop(key[:i], None)
+
+    @property
+    def root(self):
+        return self.get_hash('')
+
+    def get_range(self, prefix):
+        """Get the range of the files under a node.
+
+        Args:
+            prefix: A string of the prefix of the node.
+
+        Returns:
+            Two integers of the start and the end of the range in keys.
+        """
+        # 'g' follows all the hex digits.
+        return bisect.bisect_left(self.keys, prefix), bisect.bisect_left(self.keys, prefix + 'g')
+
+    def get_hash(self, prefix):
+        """Get the hash of a node.
+
+        Args:
+            prefix: A string of the prefix of the node.
+
+        Returns:
+            A string of the hex sha1 of the leaves under the node, which is empty if there is no
+            file under it.
+        """
+        node_hash = self.nodes.get(prefix)
+        if node_hash is None:
+            start, end = self.get_range(prefix)
+            node_hash = hashlib.sha1(b''.join(self.leaves[start:end])).hexdigest() \
+                if end > start else ''
+            self.nodes[prefix] = node_hash
+        return node_hash
+
+    def get_files(self, prefix):
+        """Get the files under a node.
+
+        Args:
+            prefix: A string of the prefix of the node.
+
+        Returns:
+            A list of [filename, size, md5, base, mtime_ns] of the files.
+        """
+        start, end = self.get_range(prefix)
+        return [[filename, *self.files[filename]] for filename in self.names[start:end]]
+
+    def get_node(self, prefix):
+        """Get a node to send to another socket.
+
+        Args:
+            prefix: A string of the prefix of the node.
+
+        Returns:
+            A list of [prefix, children, files], where children is None or a list of the hashes
+            of the children, and files is None or a list of the files under a small node.
+        """
+        start, end = self.get_range(prefix)
+        if end - start <= MERKLE_BUCKET_SIZE:
+            return [prefix, None, self.get_files(prefix)]
+        return [prefix, [self.get_hash(prefix + i) for i in HEX_DIGITS], None]
+
+    def compare(self, prefix, children, files):
+        """Compare a node of another socket with the local one. Only the local files which are
+        missing or older in another socket are returned, as another socket compares the trees
+        in reverse and sends its files.
+
+        Args:
+            prefix: A string of the prefix of the node.
+            children: None or a list of the hashes of the children of another socket.
+            files: None or a list of [filename, size, md5, base, mtime_ns] of the files of
+            another socket.
+
+        Returns:
+            A list of the prefixes of the differing children to descend into.
+            A list of the relative filepath of the files missing in another socket.
+            A list of the relative filepath of the files newer than those of another socket.
+        """
+        prefixes = list()
+        added = list()
+        updated = list()
+        if children is not None:
+            for digit, child_hash in zip(HEX_DIGITS, children):
+                local_hash = self.get_hash(prefix + digit)
+                if not local_hash or local_hash == child_hash:
+                    continue
+                if child_hash:
+                    prefixes.append(prefix + digit)
+                else:
+                    # The whole subtree is missing in another socket.
+                    added.extend(filename for filename, _, _, base, _ in
+                                 self.get_files(prefix + digit) if base is not None)
+            return prefixes, added, updated
+
+        peer_files = {filename: entry for filename, *entry in files}
+        for filename, *entry in self.get_files(prefix):
+            # The files still in transmission are not sent.
+            if entry[2] is None:
+                continue
+            peer_entry = peer_files.get(filename)
+            if peer_entry is None:
+                added.append(filename)
+            elif is_newer(entry, peer_entry):
+                updated.append(filename)
+        return prefixes, added, updated
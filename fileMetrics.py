@@ -0,0 +1,434 @@
+# -*- coding: UTF-8 -*-
+"""
+Metrics of the transmission, exported in the Prometheus text format.
+"""
+
+import bisect
+import contextlib
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+REPORT_INTERVAL = 5
+LOG_INTERVAL = 60
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+METRICS_PREFIX = 'left_'
+
+
+class metricsRegistry(object):
+    """A thread-safe registry of the counters, gauges and latency histograms of a process, which
+    also keeps the latest snapshots reported by the other processes.
+
+    A metric is keyed by a set of its name and the sorted (label, value) pairs of its labels.
+
+    Attributes:
+        pid: A integer of the id of the process owning the registry.
+        counters: A dictionary of metric keys (keys) and numbers (values) which only increase.
+        gauges: A dictionary of metric keys (keys) and numbers (values) of the current values.
+        gauge_functions: A dictionary of metric keys (keys) and functions (values) to sample
+        gauges when a snapshot is taken, e.g. the depth of a queue.
+        histograms: A dictionary of metric keys (keys) and lists of [a list of the counts of the
+        observations in HISTOGRAM_BUCKETS and above, the count, the sum] (values).
+        sources: A dictionary of the names of the other processes (keys) and their latest
+        snapshots (values).
+        lock: A lock to update the metrics exclusively.
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.counters = dict()
+        self.gauges = dict()
+        self.gauge_functions = dict()
+        self.histograms = dict()
+        self.sources = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, key, value=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, key, value):
+        with self.lock:
+            self.gauges[key] = value
+
+    def remove_gauge(self, key):
+        with self.lock:
+            self.gauges.pop(key, None)
+            self.gauge_functions.pop(key, None)
+
+    def set_gauge_function(self, key, func):
+        with self.lock:
+            self.gauge_functions[key] = func
+
+    def observe(self, key, value):
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(HISTOGRAM_BUCKETS) + 1), 0, 0.0]
+            histogram[0][bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def snapshot(self):
+        """Take a snapshot of the metrics of this process.
+
+        Returns:
+            A dictionary of 'counters', 'gauges' and 'histograms' (keys) and dictionaries of
+            metric keys and values (values), which can be pickled.
+        """
+        with self.lock:
+            gauges = dict(self.gauges)
+            gauge_functions = list(self.gauge_functions.items())
+            result = {'counters': dict(self.counters),
+                      'histograms': {key: [list(histogram[0]), histogram[1], histogram[2]]
+                                     for key, histogram in self.histograms.items()}}
+        for key, func in gauge_functions:
+            try:
+                gauges[key] = func()
+            except (NotImplementedError, OSError):
+                # The depth of a multiprocessing.Queue is not available on some platforms.
+                continue
+        result['gauges'] = gauges
+        return result
+
+    def update(self, source, snapshot):
+        """Keep the latest snapshot reported by another process.
+
+        Args:
+            source: A string of the name of the process.
+            snapshot: A dictionary returned by snapshot() in the process.
+        """
+        with self.lock:
+            self.sources[source] = snapshot
+
+    def collect(self):
+        """Merge the metrics of this process and the latest snapshots of the other processes.
+
+        Returns:
+            A dictionary in the format of snapshot().
+        """
+        with self.lock:
+            snapshots = list(self.sources.values())
+        result = self.snapshot()
+        for snapshot in snapshots:
+            for key, value in snapshot['counters'].items():
+                result['counters'][key] = result['counters'].get(key, 0) + value
+            for key, value in snapshot['gauges'].items():
+                result['gauges'][key] = result['gauges'].get(key, 0) + value
+            for key, histogram in snapshot['histograms'].items():
+                merged = result['histograms'].setdefault(
+                    key, [[0] * (len(HISTOGRAM_BUCKETS) + 1), 0, 0.0])
+                merged[0] = [i + j for i, j in zip(merged[0], histogram[0])]
+                merged[1] += histogram[1]
+                merged[2] += histogram[2]
+        return result
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Get the metrics registry of the current process, which is created at the first call. A
+    forked process gets a new registry instead of the copy of its parent's.
+
+    Returns:
+        A instance of fileMetrics.metricsRegistry.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None or _registry.pid != os.getpid():
+            _registry = metricsRegistry()
+    return _registry
+
+
+def _get_key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Increase a counter.
+
+    Args:
+        name: A string of the name of the counter.
+        value: A number to add to the counter.
+        **labels: The labels of the counter.
+    """
+    get_registry().inc(_get_key(name, labels), value)
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge to its current value.
+
+    Args:
+        name: A string of the name of the gauge.
+        value: A number of the current value.
+        **labels: The labels of the gauge.
+    """
+    get_registry().set_gauge(_get_key(name, labels), value)
+
+
+def set_gauge_function(name, func, **labels):
+    """Set a gauge to be sampled by a function when a snapshot is taken.
+
+    Args:
+        name: A string of the name of the gauge.
+        func: A function without arguments returning the current value.
+        **labels: The labels of the gauge.
+    """
+    get_registry().set_gauge_function(_get_key(name, labels), func)
+
+
+def remove_gauge(name, **labels):
+    """Remove a gauge, e.g. of an ended thread.
+
+    Args:
+        name: A string of the name of the gauge.
+        **labels: The labels of the gauge.
+    """
+    get_registry().remove_gauge(_get_key(name, labels))
+
+
+def observe(name, value, **labels):
+    """Record an observation (e.g. a latency in seconds) into a histogram.
+
+    Args:
+        name: A string of the name of the histogram.
+        value: A number of the observation.
+        **labels: The labels of the histogram.
+    """
+    get_registry().observe(_get_key(name, labels), value)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Record the elapsed time (second) of a with statement into a histogram.
+
+    Args:
+        name: A string of the name of the histogram.
+        **labels: The labels of the histogram.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start_time, **labels)
+
+
+def get_quantile(histogram, q):
+    """Estimate a quantile of a histogram by the upper bound of its bucket.
+
+    Args:
+        histogram: A list of [the counts of the buckets, the count, the sum].
+        q: A float of the quantile between 0 and 1.
+
+    Returns:
+        A float of the estimated quantile, which is 0 without observations and infinite above
+        the largest bucket.
+    """
+    if not histogram[1]:
+        return 0.0
+    rank = q * histogram[1]
+    count = 0
+    for bound, bucket_count in zip(HISTOGRAM_BUCKETS + (float('inf'),), histogram[0]):
+        count += bucket_count
+        if count >= rank:
+            return bound
+    return float('inf')
+
+
+def _get_label_text(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, value) for label, value in labels) + '}'
+
+
+def to_text(metrics):
+    """Format metrics in the Prometheus text format.
+
+    Args:
+        metrics: A dictionary in the format of metricsRegistry.snapshot().
+
+    Returns:
+        A string of the formatted metrics.
+    """
+    lines = list()
+    for kind, type_name in (('counters', 'counter'), ('gauges', 'gauge')):
+        names = set()
+        for (name, labels), value in sorted(metrics[kind].items()):
+            if name not in names:
+                names.add(name)
+                lines.append('# TYPE {}{} {}'.format(METRICS_PREFIX, name, type_name))
+            lines.append('{}{}{} {}'.format(METRICS_PREFIX, name, _get_label_text(labels), value))
+
+    names = set()
+    for (name, labels), histogram in sorted(metrics['histograms'].items()):
+        if name not in names:
+            names.add(name)
+            lines.append('# TYPE {}{} histogram'.format(METRICS_PREFIX, name))
+        count = 0
+        for bound, bucket_count in zip(HISTOGRAM_BUCKETS + ('+Inf',), histogram[0]):
+            count += bucket_count
+            lines.append('{}{}_bucket{} {}'.format(METRICS_PREFIX, name,
+                                                   _get_label_text(labels, [('le', bound)]),
+                                                   count))
+        lines.append('{}{}_sum{} {}'.format(METRICS_PREFIX, name, _get_label_text(labels),
+                                            histogram[2]))
+        lines.append('{}{}_count{} {}'.format(METRICS_PREFIX, name, _get_label_text(labels),
+                                              histogram[1]))
+    return '\n'.join(lines) + '\n'
+
+
+def to_json(metrics):
+    """Format metrics in JSON, where the metrics are listed by their names.
+
+    Args:
+        metrics: A dictionary in the format of metricsRegistry.snapshot().
+
+    Returns:
+        A string of the formatted metrics.
+    """
+    result = dict()
+    for kind in ('counters', 'gauges'):
+        result[kind] = dict()
+        for (name, labels), value in metrics[kind].items():
+            result[kind].setdefault(name, list()).append({'labels': dict(labels), 'value': value})
+    result['histograms'] = dict()
+    for (name, labels), histogram in metrics['histograms'].items():
+        result['histograms'].setdefault(name, list()).append({
+            'labels': dict(labels), 'buckets': histogram[0], 'count': histogram[1],
+            'sum': histogram[2], 'p50': get_quantile(histogram, 0.5),
+            'p99': get_quantile(histogram, 0.99)})
+    return json.dumps(result, indent=2, sort_keys=True)
+
+
+class _metricsHandler(http.server.BaseHTTPRequestHandler):
+    """A handler of the stats endpoint, which serves the merged metrics in the Prometheus text
+    format at /metrics and in JSON at /stats.
+    """
+    def do_GET(self):
+        metrics = get_registry().collect()
+        if self.path == '/metrics':
+            body, content_type = to_text(metrics), 'text/plain; version=0.0.4'
+        elif self.path in ('/', '/stats'):
+            body, content_type = to_json(metrics), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request: " + format, *args)
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve the stats endpoint of this process in a thread.
+
+    Args:
+        port: A integer of the local port.
+        host: A string of the local host, which is only the loopback by default.
+
+    Returns:
+        A instance of http.server.ThreadingHTTPServer.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), _metricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def start_reporter(report, interval=REPORT_INTERVAL):
+    """Report the snapshot of the metrics of this process periodically in a thread, e.g. from a
+    subprocess to the main process.
+
+    Args:
+        report: A function to report a snapshot, which is given the snapshot as the argument.
+        interval: A integer of the interval time (second) between reporting.
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            report(get_registry().snapshot())
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+
+def _get_total(metrics, kind, name):
+    return sum(value for (key, _), value in metrics[kind].items() if key == name)
+
+
+def _get_histogram(metrics, name):
+    merged = [[0] * (len(HISTOGRAM_BUCKETS) + 1), 0, 0.0]
+    for (key, _), histogram in metrics['histograms'].items():
+        if key == name:
+            merged[0] = [i + j for i, j in zip(merged[0], histogram[0])]
+            merged[1] += histogram[1]
+            merged[2] += histogram[2]
+    return merged
+
+
+def format_line(metrics, last_metrics, elapsed):
+    """Format a summary line of the metrics since the last line.
+
+    Args:
+        metrics: A dictionary of the current metrics in the format of metricsRegistry.snapshot().
+        last_metrics: A dictionary of the metrics of the last line.
+        elapsed: A float of the time (second) since the last line.
+
+    Returns:
+        A string of the summary line.
+    """
+    def rate(name):
+        total = _get_total(metrics, 'counters', name)
+        return (total - _get_total(last_metrics, 'counters', name)) / max(elapsed, 1e-9)
+
+    def latency(name):
+        histogram = _get_histogram(metrics, name)
+        return histogram[1], get_quantile(histogram, 0.5)
+
+    queues = ' '.join('{}={}'.format(dict(labels).get('queue'), value)
+                      for (name, labels), value in sorted(metrics['gauges'].items())
+                      if name == 'queue_depth')
+    return ("Metrics: sent {:.2f} MiB/s, received {:.2f} MiB/s, blocks sent {} (p50 {}s), "
+            "blocks received {} (p50 {}s), scans {} (p50 {}s), hashes {} (p50 {}s), "
+            "queues {}, retries {}, reconnects {}").format(
+        rate('sent_bytes') / 2 ** 20, rate('recv_bytes') / 2 ** 20,
+        *latency('block_send_seconds'), *latency('block_recv_seconds'),
+        *latency('scan_seconds'), *latency('hash_seconds'), queues or '-',
+        _get_total(metrics, 'counters', 'command_retries'),
+        _get_total(metrics, 'counters', 'reconnects'))
+
+
+def start_logger(interval=LOG_INTERVAL):
+    """Log a summary line of the merged metrics periodically in a thread.
+
+    Args:
+        interval: A integer of the interval time (second) between lines.
+    """
+    def run():
+        last_metrics = get_registry().collect()
+        last_time = time.time()
+        while True:
+            time.sleep(interval)
+            metrics = get_registry().collect()
+            now = time.time()
+            logger.info(format_line(metrics, last_metrics, now - last_time))
+            last_metrics, last_time = metrics, now
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
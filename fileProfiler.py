@@ -0,0 +1,210 @@
+# -*- coding: UTF-8 -*-
+"""
+Sampling profiler of the threads, dumped on SIGUSR1.
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+import fileMetrics
+
+logger = logging.getLogger(__name__)
+
+PROFILE_PATH = './.profile'
+SAMPLE_INTERVAL = 0.01
+
+
+class stackSampler(threading.Thread):
+    """A thread to sample the stacks of all the other threads of a process periodically.
+
+    The samples are counted in the collapsed format of flame graphs, where a line is the name
+    of the thread and the frames from the outermost one separated by semicolons, followed by the
+    number of the samples, e.g. 'Thread-1;fileSocket.py:run;fileSocket.py:get_command 42'.
+
+    Attributes:
+        pid: A integer of the id of the process owning the sampler.
+        interval: A float of the interval time (second) between samples.
+        stacks: A collections.Counter of the collapsed stacks (keys) and the numbers of samples.
+        lock: A lock to access stacks exclusively.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.pid = os.getpid()
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.lock = threading.Lock()
+        self.daemon = True
+
+    def run(self):
+        """Start function for multithreading.
+        """
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def sample(self):
+        """Take a sample of the stacks of the other threads.
+        """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = list()
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            frames = list()
+            while frame is not None:
+                code = frame.f_code
+                frames.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            frames.append(names.get(ident, str(ident)))
+            stacks.append(';'.join(reversed(frames)))
+        with self.lock:
+            self.stacks.update(stacks)
+
+    def dump(self, path):
+        """Write the counted stacks into a file, which can be drawn by flamegraph.pl or
+        speedscope.
+
+        Args:
+            path: A string of the path of the file.
+        """
+        with self.lock:
+            lines = ['{} {}\n'.format(stack, count) for stack, count in self.stacks.items()]
+        with open(path + '.tmp', 'w') as f:
+            f.writelines(sorted(lines))
+        os.replace(path + '.tmp', path)
+
+
+class profileDumper(threading.Thread):
+    """A thread to dump the profile of a process when it is woken by SIGUSR1 through a pipe.
+
+    The handler of the signal only writes to the pipe, as it runs on the main thread between
+    any two bytecodes, where the main thread may hold the locks needed by the dumping (e.g. the
+    lock of fileMetrics.metricsRegistry in a profiled command).
+
+    Attributes:
+        pid: A integer of the id of the process owning the dumper.
+        read_fd: A integer of the file descriptor of the pipe to wait for the signals.
+        write_fd: A integer of the non-blocking file descriptor of the pipe to write by the
+        handler of the signal.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.pid = os.getpid()
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.write_fd, False)
+        self.daemon = True
+
+    def run(self):
+        """Start function for multithreading. The signals received during a dumping are
+        handled by one more dumping.
+        """
+        while True:
+            os.read(self.read_fd, 1024)
+            dump()
+
+    def wake(self):
+        """Wake the dumper, which is safe in a signal handler.
+        """
+        try:
+            os.write(self.write_fd, b'\0')
+        except BlockingIOError:
+            # The pipe is full of pending signals.
+            pass
+
+
+_main_pid = None
+_with_stacks = False
+_sampler = None
+_dumper = None
+_threads_lock = threading.Lock()
+
+
+def enable(with_stacks=False):
+    """Dump the profile on SIGUSR1. It should be called by the main thread of the main process
+    before the subprocesses are started, which inherit the handler.
+
+    Args:
+        with_stacks: A bool of whether the stacks of the threads are sampled in every process.
+    """
+    global _main_pid, _with_stacks
+    _main_pid = os.getpid()
+    _with_stacks = with_stacks
+    start_threads()
+    signal.signal(signal.SIGUSR1, _handle_signal)
+    logger.info("Profiling is enabled, and the profile is dumped by kill -USR1 %d", _main_pid)
+
+
+def start_threads():
+    """Start the dumper and the stack sampler (if the stacks are sampled) of the current
+    process, which are started once in each process.
+    """
+    global _sampler, _dumper
+    with _threads_lock:
+        if _dumper is None or _dumper.pid != os.getpid():
+            _dumper = profileDumper()
+            _dumper.start()
+        if _with_stacks and (_sampler is None or _sampler.pid != os.getpid()):
+            _sampler = stackSampler()
+            _sampler.start()
+
+
+def _handle_signal(signum, frame):
+    # The dumper of a subprocess is started by its first command, before which there is
+    # nothing to dump.
+    dumper = _dumper
+    if dumper is not None and dumper.pid == os.getpid():
+        dumper.wake()
+
+
+def format_commands(metrics):
+    """Format a table of the waiting and running time of the commands.
+
+    Args:
+        metrics: A dictionary in the format of fileMetrics.metricsRegistry.snapshot().
+
+    Returns:
+        A string of the table sorted by the total running time.
+    """
+    rows = dict()
+    for (name, labels), histogram in metrics['histograms'].items():
+        if name in ('command_wait_seconds', 'command_run_seconds'):
+            rows.setdefault(dict(labels)['command'], dict())[name] = histogram
+
+    empty = [[0], 0, 0.0]
+    lines = ['{:<32} {:>8} {:>10} {:>9} {:>9} {:>10} {:>9} {:>9}'.format(
+        'command', 'count', 'wait mean', 'wait p50', 'wait p99', 'run total', 'run p50',
+        'run p99')]
+    for command, histograms in sorted(rows.items(), key=lambda item: -item[1].get(
+            'command_run_seconds', empty)[2]):
+        wait = histograms.get('command_wait_seconds', empty)
+        run = histograms.get('command_run_seconds', empty)
+        lines.append('{:<32} {:>8} {:>10.4f} {:>9} {:>9} {:>10.3f} {:>9} {:>9}'.format(
+            command, run[1], wait[2] / max(wait[1], 1), fileMetrics.get_quantile(wait, 0.5),
+            fileMetrics.get_quantile(wait, 0.99), run[2], fileMetrics.get_quantile(run, 0.5),
+            fileMetrics.get_quantile(run, 0.99)))
+    return '\n'.join(lines)
+
+
+def dump():
+    """Dump the profile on SIGUSR1 by the profileDumper. The main process logs the table of the
+    commands of all the processes, which are reported every fileMetrics.REPORT_INTERVAL seconds,
+    and passes the signal to the subprocesses. Every process writes its stacks into PROFILE_PATH
+    if they are sampled.
+    """
+    if os.getpid() == _main_pid:
+        logger.info("Profile of the commands:\n%s",
+                    format_commands(fileMetrics.get_registry().collect()))
+        for process in multiprocessing.active_children():
+            os.kill(process.pid, signal.SIGUSR1)
+
+    if _with_stacks and _sampler is not None and _sampler.pid == os.getpid():
+        os.makedirs(PROFILE_PATH, exist_ok=True)
+        path = os.path.join(PROFILE_PATH, '{}.folded'.format(os.getpid()))
+        _sampler.dump(path)
+        logger.info("Stacks of process %d are dumped to %s", os.getpid(), path)
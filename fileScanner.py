@@ -9,7 +9,9 @@ import os
 import time
 
 import fileLoader
+import fileMetrics
 import fileSocket
+import fileWatcher
 
 
 class fileScanner(object):
@@ -17,65 +19,146 @@ class fileScanner(object):
 
     Attributes:
         listen_path: A string of the listening sync path.
-        interval_time: A integer of the interval time (second) between scanning.
+        interval_time: A integer of the interval time (second) between scanning by polling.
+        reconcile_time: A integer of the interval time (second) between full scanning when the
+        changed files are watched by events.
+        watch: A bool of whether to watch the changed files by inotify events, which falls back
+        to polling if not supported.
         main_queue: A queue to transmit message from fileScanner.fileScanner to fileSocket.fileSocket.
-        recv_dict: A inter-process dictionary of relative filepath (keys) and md5 (values) to
-        determine whether the files are from other devices.
+        recv_dict: A instance of fileState.stateTable of the received files to determine whether
+        the files are from other devices.
+        incremental: A bool of whether to hash only the files whose stat signature is changed.
+        snapshot: A dictionary of relative filepath (keys) and a set of the stat signature and
+        file_info (values) kept between scanning in incremental mode.
+        scan_time: A float of the monotonic time of the last full scanning.
     """
     interval_time = 1
+    reconcile_time = 30
+    watch = True
+    incremental = True
 
     def __init__(self, path, main_queue, recv_dict):
         self.listen_path = path
         self.main_queue = main_queue
         self.recv_dict = recv_dict
+        self.snapshot = dict() if self.incremental else None
+        self.scan_time = time.monotonic()
 
     @classmethod
-    def load_file(cls, root, recv_dict):
+    def load_file(cls, root, recv_dict, snapshot=None):
         """Load all files' information in a root path.
 
         Args:
             root: A string of the root path to load files.
-            recv_dict: A whitelist-like dictionary of relative filepath (keys) and block number
-            (e.g. md5) (values) to filter files.
+            recv_dict: A whitelist-like fileState.stateTable of relative filepath (keys) and block
+            number or md5 (values) to filter files.
+            snapshot: None or a dictionary of the stat snapshot to skip hashing unchanged files.
 
         Returns:
             A dictionary of all files' relative filepath (keys) and file_info (e.g. md5) (values).
         """
         file_dict = dict()
+        visited = set()
         for path, dirs, files, in os.walk(root, topdown=False):
             for name in files:
+                # Skip the temporary files which are being rebuilt by fileLoader.fileWriter.
+                if name.endswith(fileLoader.PART_SUFFIX):
+                    continue
                 filepath = os.path.join(path, name)
-                file_info = cls.filter_file(filepath, recv_dict)
+                visited.add(filepath)
+                file_info = cls.filter_file(filepath, recv_dict, snapshot)
                 # If the returned file_info is None, this file can be simply ignored.
                 if file_info is not None:
                     file_dict[filepath] = file_info
+
+        # Forget the removed files so that a recreated file is always hashed again.
+        if snapshot is not None:
+            for filepath in snapshot.keys() - visited:
+                snapshot.pop(filepath)
+        return file_dict
+
+    @classmethod
+    def update_file(cls, file_dict, paths, recv_dict, snapshot=None):
+        """Update the files' information of the changed paths reported by events.
+
+        Args:
+            file_dict: A dictionary of files' relative filepath (keys) and file_info (values) to
+            update in place.
+            paths: A set of the changed paths of files or directories.
+            recv_dict: A whitelist-like fileState.stateTable of relative filepath (keys) and block
+            number or md5 (values) to filter files.
+            snapshot: None or a dictionary of the stat snapshot to skip hashing unchanged files.
+
+        Returns:
+            The updated file_dict.
+        """
+        filepaths = set()
+        for path in paths:
+            # A changed directory covers all the files in it before and after the change.
+            filepaths.update(i for i in file_dict if i.startswith(path + os.sep))
+            if os.path.isdir(path):
+                for sub_path, dirs, files in os.walk(path):
+                    filepaths.update(os.path.join(sub_path, name) for name in files)
+            else:
+                filepaths.add(path)
+
+        for filepath in filepaths:
+            file_dict.pop(filepath, None)
+            if filepath.endswith(fileLoader.PART_SUFFIX):
+                continue
+            try:
+                file_info = cls.filter_file(filepath, recv_dict, snapshot)
+            except FileNotFoundError:
+                if snapshot is not None:
+                    snapshot.pop(filepath, None)
+                continue
+            if file_info is not None:
+                file_dict[filepath] = file_info
         return file_dict
 
     @staticmethod
-    def filter_file(filepath, recv_dict):
-        """Filter the files in the recv_dict by given rules.
+    def get_file_info(filepath, snapshot=None):
+        """Get the file_info of a file, which is reused from the snapshot if its stat signature
+        is not changed.
 
         Args:
             filepath: A string of the relative path of the file.
-            recv_dict: A whitelist-like dictionary of relative filepath (keys) and block number
-            (values) to filter files.
+            snapshot: None or a dictionary of the stat snapshot.
 
         Returns:
-            None or specific file identification mark (e.g. md5).
+            A string of specific file identification mark (e.g. md5).
         """
+        if snapshot is None:
+            return fileLoader.get_file_info(filepath)
+
+        signature = fileLoader.get_signature(filepath)
+        if filepath in snapshot and snapshot[filepath][0] == signature:
+            return snapshot[filepath][1]
+
         file_info = fileLoader.get_file_info(filepath)
+        snapshot[filepath] = (signature, file_info)
+        return file_info
+
+    @classmethod
+    def filter_file(cls, filepath, recv_dict, snapshot=None):
+        """Filter the files in the recv_dict by given rules.
+
+        Args:
+            filepath: A string of the relative path of the file.
+            recv_dict: A whitelist-like fileState.stateTable of relative filepath (keys) and block
+            number or md5 (values) to filter files.
+            snapshot: None or a dictionary of the stat snapshot.
 
-        # If the filepath in the dict, the filepath can be seen as protected in the whitelist.
-        if filepath in recv_dict:
-            # If the file_info is an integer, the transmission is not finished.
-            if isinstance(recv_dict[filepath], int):
-                return None
-            # If the file_info is not changed, the file should be neglected to prevent add detection.
-            if recv_dict[filepath] == file_info:
-                return None
-            # If the file_info is changed, the file should be removed from the whitelist.
-            recv_dict.pop(filepath)
+        Returns:
+            None or specific file identification mark (e.g. md5).
+        """
+        file_info = cls.get_file_info(filepath, snapshot)
 
+        # If the filepath in the table, the filepath can be seen as protected in the whitelist
+        # while the transmission is not finished or the file_info is not changed. If the file_info
+        # is changed, the file is removed from the whitelist.
+        if recv_dict.protect(filepath, file_info):
+            return None
         return file_info
 
     @staticmethod
@@ -99,27 +182,77 @@ class fileScanner(object):
     @staticmethod
     def send_file(result, queue):
         """Send the filepath of the needed files into the main_queue to activate
-        fileSocket.fileSocket.send_file().
+        fileSocket.fileSocket.send_files() for added files and updated files, so that the small
+        files of a scanning are sent together.
 
         Args:
             result: A set of the return of compare_file().
             queue: A queue to transmit message to fileSocket.fileSocket.
         """
-        for filename in result[0] | result[3]:  # Files in add and update.
-            fileSocket.command.put(fileSocket.fileSocket.send_file, queue, filename)
+        added = sorted(result[0])  # Files in add.
+        updated = sorted(result[3])  # Files in update.
+        if added or updated:
+            fileSocket.command.put(fileSocket.fileSocket.send_files, queue, added, updated)
+
+    def get_watcher(self):
+        """Get a watcher of the listening path.
+
+        Returns:
+            None if events are not supported, or a instance of fileWatcher.inotifyWatcher.
+        """
+        if not self.watch:
+            return None
+        try:
+            return fileWatcher.inotifyWatcher(self.listen_path)
+        except (AttributeError, OSError):
+            return None
+
+    def wait_file(self, watcher, old_file):
+        """Wait for the changed files by polling or events.
+
+        Args:
+            watcher: None or a instance of fileWatcher.inotifyWatcher.
+            old_file: A dictionary of old files' relative filepath (keys) and file_info (values).
+
+        Returns:
+            A dictionary of new files' relative filepath (keys) and file_info (values).
+        """
+        if watcher is None:
+            time.sleep(self.interval_time)
+            with fileMetrics.timer('scan_seconds', mode='poll'):
+                return self.load_file(self.listen_path, self.recv_dict, self.snapshot)
+
+        # The periodic reconciliation is due by the time of the last full scanning, so that it is
+        # not held back by the continuous events.
+        timeout = max(self.scan_time + self.reconcile_time - time.monotonic(), 0)
+        paths = watcher.read(timeout)
+        # Scan all the files if the events are overflowed or for periodic reconciliation.
+        if not paths or time.monotonic() - self.scan_time >= self.reconcile_time:
+            self.scan_time = time.monotonic()
+            with fileMetrics.timer('scan_seconds', mode='full'):
+                return self.load_file(self.listen_path, self.recv_dict, self.snapshot)
+        with fileMetrics.timer('scan_seconds', mode='events'):
+            return self.update_file(old_file.copy(), paths, self.recv_dict, self.snapshot)
 
     def main_loop(self):
         """Main loop to scan files.
         """
-        old_file = self.load_file(self.listen_path, self.recv_dict)
+        # Start watching before the first scanning to avoid missing changes.
+        watcher = self.get_watcher()
+        self.scan_time = time.monotonic()
+        with fileMetrics.timer('scan_seconds', mode='full'):
+            old_file = self.load_file(self.listen_path, self.recv_dict, self.snapshot)
+        fileLoader.get_hash_cache().flush()
         while True:
-            time.sleep(self.interval_time)
-            new_file = self.load_file(self.listen_path, self.recv_dict)
+            new_file = self.wait_file(watcher, old_file)
             result = self.compare_file(old_file, new_file)
             old_file = new_file.copy()
+            # Flush the hash cache first so that the other processes can reuse the md5.
+            fileLoader.get_hash_cache().flush()
             self.send_file(result, self.main_queue)
 
     def start(self):
         """Start function for multiprocess.
         """
+        fileSocket.fileSocket.report_metrics(self.main_queue, 'scan')
         self.main_loop()
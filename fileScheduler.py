@@ -0,0 +1,231 @@
+# -*- coding: UTF-8 -*-
+"""
+Scheduling of the queued send commands by priority and fairness.
+"""
+
+import collections
+import fnmatch
+import heapq
+import itertools
+import threading
+
+import fileLoader
+import fileMetrics
+
+POLICIES = ('fifo', 'srf', 'rr')
+DEFAULT_POLICY = 'srf'
+
+
+def parse_rule(text):
+    """Parse a priority rule of the command line.
+
+    Args:
+        text: A string of 'pattern=priority', e.g. '*.conf=1'.
+
+    Returns:
+        A set of the string of the pattern and the integer of the priority.
+    """
+    pattern, sep, priority = text.rpartition('=')
+    if not sep or not pattern:
+        raise ValueError("The priority rule should be pattern=priority: {}".format(text))
+    return pattern, int(priority)
+
+
+class _fileEntry(object):
+    """A auxiliary class of the queued blocks of a file.
+
+    Attributes:
+        filename: A string of the relative path of the file.
+        priority: A integer of the priority of the file.
+        seq: A integer of the order in which the file is queued, which breaks the ties.
+        cmds: A deque of the queued commands of the blocks.
+        remaining: A integer of the size of the queued blocks.
+    """
+    def __init__(self, filename, priority, seq):
+        self.filename = filename
+        self.priority = priority
+        self.seq = seq
+        self.cmds = collections.deque()
+        self.remaining = 0
+
+
+class sendScheduler(object):
+    """A queue of the commands from fileSocket.sendSocket to the sending threads, which has the
+    put() and get() of multiprocessing.Queue for fileSocket.command.
+
+    The blocks of the files are queued per file and taken by a policy, so that a large file does
+    not hold back the files behind it:
+        'fifo': the blocks in the order they are put.
+        'srf': the blocks of the file with the shortest remaining queued size first.
+        'rr': a block of each file in turn.
+    The files with a higher priority by the rules are always taken first, and the other commands
+    (e.g. CONT) are taken before any block.
+
+    Attributes:
+        policy: A string of the policy in POLICIES.
+        rules: A list of sets of the fnmatch pattern of the relative path and the priority, where
+        the first matched rule is used and the priority is 0 if none is matched.
+        cmds: A deque of the queued commands other than the blocks.
+        files: A dictionary of priorities (keys) and ordered dictionaries of relative filepath
+        (keys) and _fileEntry (values).
+        heaps: A dictionary of priorities (keys) and heaps of [remaining, seq, filename] of the
+        files for 'srf' policy, where the outdated items are skipped.
+        file_sizes: A dictionary of relative filepath (keys) and the size of the file (values) to
+        get the size of the blocks.
+        size: A integer of the number of queued commands.
+        seq: A iterator of the order of the files.
+        cond: A condition to wait for the commands.
+    """
+    block_commands = ('send_file', 'send_part')
+
+    def __init__(self, policy=DEFAULT_POLICY, rules=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown scheduling policy: {}".format(policy))
+        self.policy = policy
+        self.rules = list(rules or ())
+        self.cmds = collections.deque()
+        self.files = dict()
+        self.heaps = dict()
+        self.file_sizes = dict()
+        self.size = 0
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+    def get_priority(self, filename):
+        """Get the priority of a file by the rules.
+
+        Args:
+            filename: A string of the relative path of the file.
+
+        Returns:
+            A integer of the priority, where a larger one is sent first.
+        """
+        for pattern, priority in self.rules:
+            if fnmatch.fnmatch(filename, pattern):
+                return priority
+        return 0
+
+    def renew(self, filename, file_size):
+        """Start a new transmission of a file. The queued blocks of the previous transmission
+        are stale and removed, as the file is changed before they are sent.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the current size of the file.
+        """
+        with self.cond:
+            self.file_sizes[filename] = file_size
+            priority = self.get_priority(filename)
+            files = self.files.get(priority, dict())
+            entry = files.pop(filename, None)
+            if entry is None:
+                return
+            self.size -= len(entry.cmds)
+            fileMetrics.inc('cancelled_blocks', len(entry.cmds))
+            if not files:
+                del self.files[priority]
+                self.heaps.pop(priority, None)
+
+    def put(self, obj, block=True):
+        """Put a command into the queue.
+
+        Args:
+            obj: A set of the function and the arguments of the command, where the arguments of
+            a block are (send_addr, (filename, block_index), ...), including the blocks
+            requested by the swarm peers.
+            block: A bool kept for the interface of multiprocessing.Queue, as the queue is
+            unbounded.
+        """
+        with self.cond:
+            if obj[0].__name__ in self.block_commands:
+                self._put_block(obj)
+            else:
+                self.cmds.append(obj)
+            self.size += 1
+            self.cond.notify()
+
+    def get(self, block=True):
+        """Get the next command by the policy, waiting until there is one.
+
+        Args:
+            block: A bool kept for the interface of multiprocessing.Queue.
+
+        Returns:
+            A set of the function and the arguments of the command.
+        """
+        with self.cond:
+            while self.size == 0:
+                self.cond.wait()
+            return self.pop()
+
+    def pop(self):
+        """Take the next command by the policy without waiting. The lock should be held if the
+        queue is shared by threads.
+
+        Returns:
+            None or a set of the function and the arguments of the command.
+        """
+        if self.cmds:
+            self.size -= 1
+            return self.cmds.popleft()
+        if not self.files:
+            return None
+
+        priority = max(self.files)
+        files = self.files[priority]
+        if self.policy == 'srf':
+            entry = self._pop_shortest(priority)
+        else:
+            entry = files[next(iter(files))]
+
+        cmd = entry.cmds.popleft()
+        entry.remaining -= self._get_block_size(cmd)
+        self.size -= 1
+        if not entry.cmds:
+            del files[entry.filename]
+            if not files:
+                del self.files[priority]
+                self.heaps.pop(priority, None)
+        elif self.policy == 'rr':
+            files.move_to_end(entry.filename)
+        elif self.policy == 'srf':
+            heapq.heappush(self.heaps[priority], [entry.remaining, entry.seq, entry.filename])
+        return cmd
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return self.size == 0
+
+    def _put_block(self, cmd):
+        filename = cmd[2][0]
+        priority = self.get_priority(filename)
+        files = self.files.setdefault(priority, collections.OrderedDict())
+        entry = files.get(filename)
+        if entry is None:
+            entry = files[filename] = _fileEntry(filename, priority, next(self.seq))
+        entry.cmds.append(cmd)
+        entry.remaining += self._get_block_size(cmd)
+        if self.policy == 'srf':
+            heapq.heappush(self.heaps.setdefault(priority, list()),
+                           [entry.remaining, entry.seq, filename])
+
+    def _pop_shortest(self, priority):
+        # The items are pushed again when the remaining size is changed, so the outdated ones
+        # are skipped.
+        heap = self.heaps[priority]
+        files = self.files[priority]
+        while True:
+            remaining, seq, filename = heapq.heappop(heap)
+            entry = files.get(filename)
+            if entry is not None and entry.seq == seq and entry.remaining == remaining:
+                return entry
+
+    def _get_block_size(self, cmd):
+        filename, block_index = cmd[2]
+        file_size = self.file_sizes.get(filename)
+        if file_size is None:
+            return fileLoader.TEMP_FILE_SIZE
+        return max(min(file_size - block_index * fileLoader.TEMP_FILE_SIZE,
+                       fileLoader.TEMP_FILE_SIZE), 0)
@@ -5,71 +5,144 @@
 # @Contact: zirui.zhou19@student.xjtlu.edu.cn
 """
 
+import abc
+import functools
+import inspect
+import itertools
+import json
+import logging
+import math
 import multiprocessing
+import os
+import queue
+import select
 import socket
 import struct
 import threading
+import time
+import zlib
 
 import fileLoader
+import fileMerkle
+import fileMetrics
+import fileProfiler
 import fileScanner
+import fileScheduler
+import fileState
+import fileSwarm
 
+logger = logging.getLogger(__name__)
 
-class _sendThread(threading.Thread):
-    """A thread to send messages to dynamic sockets.
+
+class _sendHandler(object):
+    """A base class of the messages sent by the engines, which is shared by
+    fileSocket._sendThread and fileAsync._sendTask.
+
+    The send commands are generators of the actions on the connection (connecting, sending a
+    message, receiving a reply and pausing), which are run by the transmit() of the engine on its
+    sockets or event loop, so that the protocol is written once for both engines. The error of an
+    action is raised at the yield of the action.
+
+    The features negotiated with the target are used only for the connections to the target,
+    and the other peers (e.g. relay peers and swarm peers) are sent messages without features, as
+    they are not negotiated with them.
 
     Attributes:
-        sock: A socket to send message to a target address which can reconnect.
-        cmd_queue: A queue to read message from fileSocket.sendSocket.
+        parent: A instance of fileSocket.sendSocket which owns the engine.
+        name: A string of the name of the sender in the metrics.
+        features: A set of strings of the _protocol.features used on the current connection.
+        codec: None or a string of the codec used on the current connection.
     """
-    def __init__(self, cmd_queue):
-        threading.Thread.__init__(self)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.cmd_queue = cmd_queue
-        self.daemon = True
+    features = frozenset()
+    codec = None
 
-    def run(self):
-        """Start function for multithreading.
-        """
-        while True:
-            self.get_command()
+    @staticmethod
+    def next_action(actions, result=None, error=None):
+        """Resume a send command by the result or the error of its last action.
 
-    def get_command(self):
-        """Get command from cmd_queue.
+        Args:
+            actions: A generator returned by a send command.
+            result: The return of the last action.
+            error: None or a socket.error raised by the last action.
+
+        Returns:
+            None if the command is finished, or a set of the name of the method of the engine to
+            run the next action and its arguments.
         """
-        command.get(self, self.cmd_queue, retry=socket.error)
+        try:
+            if error is not None:
+                return actions.throw(error)
+            return actions.send(result)
+        except StopIteration:
+            return None
 
-    def connect(self, send_addr):
-        """Connect to a target socket by infinite retrying.
+    def connect(self, send_addr, max_retries=None, is_link=True):
+        """Connect to a target address by the open_connection() of the engine.
 
         Args:
             send_addr: A address-like set of the target ip and port.
+            max_retries: None or a integer of the connecting attempts to a swarm peer.
+            is_link: A bool of whether the message may be sent in a persistent link.
+
+        Returns:
+            A set of the action.
         """
-        while True:
-            try:
-                self.sock.connect(send_addr)
-                break
-            except socket.error as e:
-                pass
+        is_target = send_addr == self.parent.send_addr
+        self.features = self.parent.features if is_target else frozenset()
+        self.codec = self.parent.codec if is_target else None
+        return 'open_connection', send_addr, max_retries, is_link
+
+    def receive(self):
+        """Receive a reply on the connection by the read_package() of the engine, which is None
+        if the connection is closed by the target.
+
+        Returns:
+            A set of the action.
+        """
+        return 'read_package',
 
     def pause(self):
-        """Pause the socket by closing connection.
+        """Pause the connection by the close_connection() of the engine.
+
+        Returns:
+            A set of the action.
         """
-        self.sock.close()
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        return 'close_connection',
 
-    def send_cont(self, send_addr, sock_num, is_echo):
-        """Send CONT command to a target address.
+    def send_cont(self, send_addr, sock_num, is_echo, features, root, seq=None):
+        """Send CONT command to a target address, followed by FEAT command with the features if
+        the target asks for them.
+
+        CONT command carries only the arguments of the baseline sockets. A socket with optional
+        features replies FEAT command on the connection, while a baseline socket closes it, so
+        that the baseline sockets never receive the arguments or the commands unknown to them.
 
         Args:
             send_addr: A address-like set of the target ip and port.
             sock_num: A integer of accepted number of sockets.
             is_echo: A bool of whether this command is an echo (send after receiving CONT).
+            features: A set of strings of the supported _protocol.features.
+            root: A string of the root hash of the local fileMerkle.merkleTree.
+            seq: None or a integer of the order of the command in sendSocket.cont_seq.
         """
-        self.connect(send_addr)
-        self._send_cont(sock_num, is_echo)
-        self.pause()
-
-    def send_file(self, send_addr, block, block_num):
+        # The reply is received in a new connection, as the receiver of a persistent link never
+        # sends data.
+        yield self.connect(send_addr, is_link=False)
+        # A CONT command queued before the target is up is dropped if a later one is queued or
+        # the CONT of the target is received meanwhile, as its root hash is outdated and the
+        # target would compare the trees and request its journal by it again. It is still sent
+        # to a baseline socket, whose receiving thread never leaves a connection without
+        # messages.
+        if seq is not None and seq != self.parent.cont_seq and self.features:
+            yield self.pause()
+            return
+        yield self._send_cont(sock_num, is_echo)
+        reply = yield self.receive()
+        if reply is not None and reply[0] == _protocol.code.FEAT:
+            yield self._send_feat(','.join(sorted(features)), root)
+        yield self.pause()
+
+    def send_file(self, send_addr, block, block_num, file_hash=None, max_retries=None):
         """Send a block by continuous transmission to a target address.
 
         Args:
@@ -77,221 +150,2036 @@ class _sendThread(threading.Thread):
             block: A set of the arguments (filename, block_index) for fileLoader.blockLoader
             returned by fileLoader.fileLoader.
             block_num: A integer of the number of split blocks.
+            file_hash: None or a string of the md5 of the file to journal the block by the target.
+            max_retries: None or a integer of the connecting attempts to a swarm peer.
         """
         block = fileLoader.blockLoader(*block)
         filename = block.filename
 
-        self.connect(send_addr)
+        yield self.connect(send_addr, max_retries)
+
+        # Send a SEND command as the start mark of a block. Whether the file is sparse follows
+        # the journal arguments, so that the target does not preallocate the holes.
+        if file_hash is None:
+            yield self._send_send(filename, block_num, block.file_size)
+        elif 'sparse' in self.features:
+            yield self._send_send(filename, block_num, block.file_size, block.block_index,
+                                  file_hash, block.is_sparse())
+        else:
+            yield self._send_send(filename, block_num, block.file_size, block.block_index,
+                                  file_hash)
+        start_time = time.time()
+        start_info = self.get_tcp_info()
+
+        # Send HOLE commands instead of the zero data of the holes in a sparse file.
+        if 'sparse' in self.features:
+            for position, size in block.find_holes():
+                yield self._send_hole(position, size)
+
+        sent_size, cpu_time, crc = yield from self._send_data(block)
+
+        # Send a VRFY command as the end mark of a block, with the CRC32 of the block to check
+        # it before it is counted.
+        if crc is None:
+            yield self._send_vrfy()
+        else:
+            yield self._send_vrfy(crc)
 
-        # Send a SEND command as the start mark of a block.
-        self._send_send(filename, block_num, block.file_size)
+        elapsed = time.time() - start_time
+        self.parent.controller.record(block.size, elapsed, start_info, self.get_tcp_info())
+        # Only the blocks sent to the target are compressed and counted in the stats.
+        if self.codec is not None:
+            self.parent.report(filename, block.size, sent_size, cpu_time)
+        self.record(block.size, sent_size, elapsed, 'block')
+        yield self.pause()
+        self.parent.release(send_addr, [filename])
 
-        for position, data in block:
-            self._send_pakg(position, data)
+    def send_bundle(self, send_addr, filenames, with_hash=False):
+        """Send small files in a bundle by continuous transmission to a target address.
 
-        # Send a VRFY command as the end mark of a block.
-        self._send_vrfy()
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            filenames: A list of strings of the relative paths of the files.
+            with_hash: A bool of whether the md5 of the files are sent to journal them.
+        """
+        bundle = fileLoader.bundleLoader(filenames, with_hash)
+        # All the files are removed meanwhile.
+        if not bundle.manifest:
+            self.parent.release(send_addr, filenames)
+            return
 
-        self.pause()
+        yield self.connect(send_addr)
 
-    def _send_package(self, code, *args):
-        """Send a message by given code and arguments.
+        # Send a BNDL command with the manifest as the start mark of a bundle.
+        yield self._send_bndl(json.dumps(bundle.manifest))
+        start_time = time.time()
+        start_info = self.get_tcp_info()
+
+        sent_size, _, crc = yield from self._send_data(bundle)
+
+        # Send a VRFY command as the end mark of a bundle, with the CRC32 of each file, so that
+        # only the corrupt files are sent again.
+        if crc is None:
+            yield self._send_vrfy()
+        else:
+            yield self._send_vrfy(bundle.checksums())
+
+        elapsed = time.time() - start_time
+        self.parent.controller.record(bundle.size, elapsed, start_info, self.get_tcp_info())
+        self.record(bundle.size, sent_size, elapsed, 'bundle')
+        yield self.pause()
+        self.parent.release(send_addr, filenames)
+
+    def send_offr(self, send_addr, filename):
+        """Send OFFR command to offer the block hashes of a file, so that the target copies the
+        blocks held locally and requests the other blocks.
 
         Args:
-            code: A _protocol.code of the sending package code.
-            *args: The arguments of the message.
+            send_addr: A address-like set of the target ip and port.
+            filename: A string of the relative path of the file.
         """
-        package = _protocol.pack(code, *args)
-        # Send a guide package of a fixed length to tell the length of the message.
-        self.sock.send(struct.pack(_protocol.guide_format, len(package)))
-        self.sock.send(package)
+        file_size = os.path.getsize(filename)
+        file_hash = fileLoader.get_file_info(filename)
+        block_hashes = fileLoader.get_block_hashes(filename)
 
-    def _send_cont(self, sock_num, is_echo):
-        self._send_package(_protocol.code.CONT, sock_num, is_echo)
+        yield self.connect(send_addr)
+        yield self._send_offr(filename, file_size, file_hash, block_hashes)
+        yield self.pause()
+        self.parent.release(send_addr, [filename])
 
-    def _send_send(self, filename, block_num, file_size):
-        self._send_package(_protocol.code.SEND, filename, block_num, file_size)
+    def send_rsum(self, send_addr, filename, file_size, file_hash, bitmap):
+        """Send RSUM command to request the blocks of a file which are not verified.
 
-    def _send_pakg(self, position, data):
-        self._send_package(_protocol.code.PAKG, position, data)
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            filename: A string of the relative path of the file.
+            file_size: A integer of the expected size of the file.
+            file_hash: A string of the expected md5 of the file.
+            bitmap: A bytes of the bitmap of the verified blocks.
+        """
+        yield self.connect(send_addr)
+        yield self._send_rsum(filename, file_size, file_hash, bitmap)
+        yield self.pause()
 
-    def _send_vrfy(self):
-        self._send_package(_protocol.code.VRFY)
+    def send_gone(self, send_addr, filename, file_hash):
+        """Send GONE command to reply RSUM command for a file which is not held anymore.
 
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the file requested by RSUM command.
+        """
+        yield self.connect(send_addr)
+        yield self._send_gone(filename, file_hash)
+        yield self.pause()
 
-class sendSocket(object):
-    """A subprocess-based class to send messages.
+    def send_sigr(self, send_addr, filename):
+        """Send SIGR command to request the block signatures of the old copy of a file.
 
-    Attributes:
-        thread_queue: A queue to transmit message from fileSocket.sendSocket to sub-threads.
-        thread_list: A list of the _sendThread sub-threads.
-        send_addr: A address-like set of the target ip and port.
-        send_queue: A queue to transmit message to fileSocket.sendSocket.
-    """
-    thread_queue = multiprocessing.Queue()
-    thread_list = list()
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            filename: A string of the relative path of the file.
+        """
+        yield self.connect(send_addr)
+        yield self._send_sigr(filename)
+        yield self.pause()
+        self.parent.release(send_addr, [filename])
 
-    def __init__(self, send_addr, send_queue):
-        self.send_addr = send_addr
-        self.send_queue = send_queue
+    def send_sigs(self, send_addr, filename):
+        """Send SIGS command with the block signatures of a file, which is empty if the file is
+        not existed.
 
-    def start(self):
-        """Start function for multiprocess.
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            filename: A string of the relative path of the file.
         """
-        while True:
-            self.get_command()
+        signatures = bytes()
+        if os.path.isfile(filename):
+            signatures = fileLoader.get_signatures(filename, fileLoader.DELTA_BLOCK_SIZE)
 
-    def get_command(self):
-        """Get command from send_queue.
+        yield self.connect(send_addr)
+        yield self._send_sigs(filename, fileLoader.DELTA_BLOCK_SIZE, signatures)
+        yield self.pause()
+
+    def send_delta(self, send_addr, filename, block_size, signatures):
+        """Send the delta of a file against the block signatures of its old copy in the target.
+        Fall back to sending the whole file if the delta is not small enough.
+
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            filename: A string of the relative path of the file.
+            block_size: A integer of the block size of the signatures.
+            signatures: A bytes of the block signatures.
         """
-        command.get(self, self.send_queue)
+        delta = fileLoader.deltaLoader(filename, signatures, block_size)
+        if delta.instructions is None:
+            delta.close()
+            self.parent.send_file(filename)
+            self.parent.release(send_addr, [filename])
+            return
 
-    def init_thread(self, num):
-        """Initiate the socket threads for sending message.
+        yield self.connect(send_addr)
+
+        # Send a DLTA command as the start mark of the delta.
+        yield self._send_dlta(filename, delta.file_size)
+
+        for position, size, offset, data in delta:
+            if data is None:
+                yield self._send_copy(position, offset, size)
+            else:
+                yield self._send_pakg(position, data)
+
+        # Send a VRFY command as the end mark of the delta.
+        yield self._send_vrfy()
+
+        yield self.pause()
+        self.parent.release(send_addr, [filename])
+
+    def send_part(self, send_addr, block, block_num, file_hash):
+        """Send a block requested by GETB command to a swarm peer. The block is dropped if the
+        peer is unreachable, and it is requested again by the peer after a timeout.
 
         Args:
-            num: A integer of the number of initiated threads.
+            send_addr: A address-like set of the ip and port of the swarm peer.
+            block: A set of the arguments (filename, block_index) for fileLoader.blockLoader.
+            block_num: A integer of the number of split blocks.
+            file_hash: A string of the md5 of the file to journal the block by the peer.
         """
-        for i in range(num):
-            self.thread_list.append(_sendThread(self.thread_queue))
-            self.thread_list[-1].start()
+        try:
+            yield from self.send_file(send_addr, block, block_num, file_hash,
+                                      fileSwarm.CONNECT_RETRIES)
+        except socket.error as e:
+            fileMetrics.inc('swarm_errors')
+            logger.debug("Drop block %s for %s:%d after %r", block, *send_addr, e)
 
-    def send_cont(self, sock_num, is_echo):
-        """Send CONT command to the sending address.
+    def send_have(self, send_addr, manifest, port, is_echo, is_update):
+        """Send HAVE command to announce the held files to a swarm peer.
 
         Args:
-            sock_num: A integer of accepted number of sockets.
-            is_echo: A bool of whether this command is an echo (send after receiving CONT).
+            send_addr: A address-like set of the ip and port of the swarm peer.
+            manifest: A string of the JSON list of [filename, size, md5] of the files.
+            port: A integer of the local port, to which the peer sends back.
+            is_echo: A bool of whether this command is an echo (send after receiving HAVE).
+            is_update: A bool of whether the files are finished or changed just now.
         """
-        command.put(_sendThread.send_cont, self.thread_queue, self.send_addr, sock_num, is_echo)
+        try:
+            yield self.connect(send_addr, fileSwarm.CONNECT_RETRIES)
+            yield self._send_have(manifest, port, is_echo, is_update)
+        except socket.error:
+            self.parent.drop_peer(send_addr)
+        yield self.pause()
 
-    def send_file(self, filename):
-        """Send a file to the sending address.
+    def send_getb(self, send_addr, filename, file_hash, block_index, port):
+        """Send GETB command to request a block of a file version from a swarm peer.
 
         Args:
+            send_addr: A address-like set of the ip and port of the swarm peer.
             filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the file.
+            block_index: A integer of the index of the block.
+            port: A integer of the local port, to which the peer sends the block.
         """
-        block_num = fileLoader.fileLoader(filename).block_num
+        try:
+            yield self.connect(send_addr, fileSwarm.CONNECT_RETRIES)
+            yield self._send_getb(filename, file_hash, block_index, port)
+        except socket.error:
+            self.parent.drop_peer(send_addr)
+        yield self.pause()
 
-        for block in fileLoader.fileLoader(filename):
-            # Mark the start of sending a block.
-            command.put(_sendThread.send_file, self.thread_queue, self.send_addr, block, block_num)
+    def send_rtry(self, send_addr, filename, block_index, file_hash):
+        """Send RTRY command to request a corrupt block again.
+
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            filename: A string of the relative path of the file.
+            block_index: A integer of the index of the block.
+            file_hash: None or a string of the md5 of the journaled file.
+        """
+        yield self.connect(send_addr)
+        if file_hash is None:
+            yield self._send_rtry(filename, block_index)
+        else:
+            yield self._send_rtry(filename, block_index, file_hash)
+        yield self.pause()
 
+    def send_pool(self, send_addr, sock_num):
+        """Send POOL command to synchronize the number of sending threads.
 
-class _recvThread(threading.Thread):
-    """A thread to receive messages from dynamic sockets.
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            sock_num: A integer of the number of sending threads.
+        """
+        yield self.connect(send_addr)
+        yield self._send_pool(sock_num)
+        yield self.pause()
+
+    def send_mrkq(self, send_addr, prefixes):
+        """Send MRKQ command to request the nodes of the Merkle tree of a target address.
+
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            prefixes: A string of the JSON list of the prefixes of the nodes.
+        """
+        yield self.connect(send_addr)
+        yield self._send_mrkq(prefixes)
+        yield self.pause()
+
+    def send_mrkr(self, send_addr, nodes):
+        """Send MRKR command to reply the requested nodes of the local Merkle tree.
+
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            nodes: A string of the JSON list of the nodes returned by
+            fileMerkle.merkleTree.get_node().
+        """
+        yield self.connect(send_addr)
+        yield self._send_mrkr(nodes)
+        yield self.pause()
+
+    def record(self, size, sent_size, elapsed, kind):
+        """Record the metrics of a sent block or bundle.
+
+        Args:
+            size: A integer of the size of the data.
+            sent_size: A integer of the sent size of the data.
+            elapsed: A float of the time (second) to send the data.
+            kind: A string of 'block' or 'bundle'.
+        """
+        fileMetrics.observe('block_send_seconds', elapsed, kind=kind)
+        fileMetrics.inc('sent_bytes', sent_size)
+        fileMetrics.set_gauge('send_bytes_per_second', size / max(elapsed, 1e-9),
+                              thread=self.name)
+
+    def _send_data(self, block):
+        """Send the data of a block or a bundle by the negotiated features.
+
+        Args:
+            block: A instance of fileLoader.blockLoader or fileLoader.bundleLoader.
+
+        Returns:
+            A integer of the sent size of data.
+            A float of the CPU time (second) of compression.
+            None or a integer of the CRC32 of the data if 'crc' feature is negotiated.
+        """
+        # Compress the block if a codec is negotiated and a sample of the block shrinks, so that
+        # the compressed media are sent raw without wasting CPU time.
+        codec = self.codec
+        cpu_time = time.thread_time()
+        is_compressible = codec is not None and fileLoader.is_compressible(
+            codec, block.sample(fileLoader.COMPRESS_SAMPLE_SIZE))
+        cpu_time = time.thread_time() - cpu_time
+
+        is_block = isinstance(block, fileLoader.blockLoader)
+        is_sendfile = is_block and not is_compressible and 'sendfile' in self.features
+        # The CRC32 is counted from the sent data, unless the data is not read by the sendfile or
+        # the holes are skipped, where the block is read from the page cache once more.
+        crc = checksum = None
+        if 'crc' in self.features:
+            if is_sendfile or is_block and block.holes:
+                checksum = block.checksum()
+            else:
+                crc = 0
+
+        if is_compressible:
+            sent_size, compress_time, crc = yield from self._send_compressed(block, codec, crc)
+            return sent_size, cpu_time + compress_time, crc if checksum is None else checksum
+
+        if is_sendfile:
+            # Send BLCK commands as the headers of the raw block data, which is copied from the
+            # page cache to the socket by the kernel.
+            for start, size in block.get_ranges():
+                for position in range(start, start + size, _link.sendfile_size):
+                    yield self._send_blck(position, min(start + size - position,
+                                                        _link.sendfile_size), block.fp)
+            block.close()
+        else:
+            for position, data in block:
+                if crc is not None:
+                    crc = zlib.crc32(data, crc)
+                yield self._send_pakg(position, data)
+        sent_size = block.size - sum(size for _, size in block.holes) if is_block else block.size
+        return sent_size, cpu_time, crc if checksum is None else checksum
+
+    def _send_compressed(self, block, codec, crc=None):
+        """Send a block by compressed data. The data which does not shrink is sent raw.
+
+        Args:
+            block: A instance of fileLoader.blockLoader or fileLoader.bundleLoader.
+            codec: A string of the codec in fileLoader.CODECS.
+            crc: None or a integer of the initial CRC32 to count the data.
+
+        Returns:
+            A integer of the sent size of data.
+            A float of the CPU time (second) of compression.
+            None or a integer of the CRC32 of the uncompressed data.
+        """
+        sent_size = 0
+        cpu_time = 0.0
+        block.data_size = fileLoader.COMPRESS_SIZE
+        for position, data in block:
+            if crc is not None:
+                crc = zlib.crc32(data, crc)
+            start_time = time.thread_time()
+            compressed = fileLoader.compress(codec, data)
+            cpu_time += time.thread_time() - start_time
+            if len(compressed) < len(data):
+                yield self._send_zpkg(position, codec, compressed)
+                sent_size += len(compressed)
+            else:
+                yield self._send_pakg(position, data)
+                sent_size += len(data)
+        return sent_size, cpu_time, crc
+
+    def get_version(self, code):
+        """Get the version of the framing to send a message.
+
+        Args:
+            code: A _protocol.code of the message.
+
+        Returns:
+            A integer of the version, which is 1 for CONT and FEAT commands, as they negotiate the
+            version.
+        """
+        if 'v2' in self.features and code not in (_protocol.code.CONT, _protocol.code.FEAT):
+            return _protocol.version
+        return 1
+
+    def _send_package(self, code, *args, fp=None):
+        """Send a message by given code and arguments by the write_package() of the engine.
+
+        Args:
+            code: A _protocol.code of the sending package code.
+            *args: The arguments of the message.
+            fp: None or a file pointer to send the raw data following the message, where the
+            position and size of the data are the first two arguments.
+
+        Returns:
+            A set of the action.
+        """
+        return 'write_package', code, args, fp
+
+    def _send_cont(self, sock_num, is_echo):
+        return self._send_package(_protocol.code.CONT, sock_num, is_echo)
+
+    def _send_feat(self, features, root):
+        return self._send_package(_protocol.code.FEAT, features, root)
+
+    def _send_send(self, filename, block_num, file_size, *journal_args):
+        return self._send_package(_protocol.code.SEND, filename, block_num, file_size,
+                                  *journal_args)
+
+    def _send_bndl(self, manifest):
+        return self._send_package(_protocol.code.BNDL, manifest)
+
+    def _send_pakg(self, position, data):
+        return self._send_package(_protocol.code.PAKG, position, data)
+
+    def _send_zpkg(self, position, codec, data):
+        return self._send_package(_protocol.code.ZPKG, position, codec, data)
+
+    def _send_blck(self, position, size, fp):
+        return self._send_package(_protocol.code.BLCK, position, size, fp=fp)
+
+    def _send_hole(self, position, size):
+        return self._send_package(_protocol.code.HOLE, position, size)
+
+    def _send_vrfy(self, *crc_args):
+        return self._send_package(_protocol.code.VRFY, *crc_args)
+
+    def _send_offr(self, filename, file_size, file_hash, block_hashes):
+        return self._send_package(_protocol.code.OFFR, filename, file_size, file_hash,
+                                  block_hashes)
+
+    def _send_rsum(self, filename, file_size, file_hash, bitmap):
+        return self._send_package(_protocol.code.RSUM, filename, file_size, file_hash, bitmap)
+
+    def _send_gone(self, filename, file_hash):
+        return self._send_package(_protocol.code.GONE, filename, file_hash)
+
+    def _send_sigr(self, filename):
+        return self._send_package(_protocol.code.SIGR, filename)
+
+    def _send_sigs(self, filename, block_size, signatures):
+        return self._send_package(_protocol.code.SIGS, filename, block_size, signatures)
+
+    def _send_dlta(self, filename, file_size):
+        return self._send_package(_protocol.code.DLTA, filename, file_size)
+
+    def _send_copy(self, position, offset, size):
+        return self._send_package(_protocol.code.COPY, position, offset, size)
+
+    def _send_rtry(self, filename, block_index, *journal_args):
+        return self._send_package(_protocol.code.RTRY, filename, block_index, *journal_args)
+
+    def _send_pool(self, sock_num):
+        return self._send_package(_protocol.code.POOL, sock_num)
+
+    def _send_have(self, manifest, port, is_echo, is_update):
+        return self._send_package(_protocol.code.HAVE, manifest, port, is_echo, is_update)
+
+    def _send_getb(self, filename, file_hash, block_index, port):
+        return self._send_package(_protocol.code.GETB, filename, file_hash, block_index, port)
+
+    def _send_mrkq(self, prefixes):
+        return self._send_package(_protocol.code.MRKQ, prefixes)
+
+    def _send_mrkr(self, nodes):
+        return self._send_package(_protocol.code.MRKR, nodes)
+
+
+class _sendThread(_sendHandler, threading.Thread):
+    """A thread to send messages to dynamic sockets.
 
     Attributes:
-        recv_sock: A socket to bind the local address and accept connections.
-        main_queue: A queue to transmit message from this thread to fileSocket.fileSocket.
+        sock: A socket to send message to a target address which can reconnect.
+        cmd_queue: A queue to read message from fileSocket.sendSocket.
+        parent: A instance of fileSocket.sendSocket which owns this thread.
+        link: None or a instance of fileSocket._link which carries the current stream.
+        stream_id: A integer of the stream id of the current message in the link.
     """
-    def __init__(self, recv_sock, main_queue):
+    def __init__(self, cmd_queue, parent):
         threading.Thread.__init__(self)
-        self.recv_sock = recv_sock
-        self.main_queue = main_queue
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.cmd_queue = cmd_queue
+        self.parent = parent
+        self.link = None
+        self.stream_id = 0
         self.daemon = True
 
     def run(self):
-        """Start function for multithreading. Keep listening if connection is established.
+        """Start function for multithreading. The thread is ended if the pool is shrunk.
         """
-        self.sock, addr = self.recv_sock.accept()
+        while self.parent.keep_thread(self):
+            self.get_command()
+        fileMetrics.remove_gauge('send_bytes_per_second', thread=self.name)
+
+    def get_command(self):
+        """Get command from cmd_queue.
+        """
+        command.get(self, self.cmd_queue, retry=socket.error)
+
+    def transmit(self, actions):
+        """Run the actions of a send command on the sockets.
+
+        Args:
+            actions: A generator returned by a send command of fileSocket._sendHandler.
+        """
+        result = error = None
         while True:
-            package = self._recv_package()
-            # Discard empty package in some conditions.
-            if package is None:
-                continue
-            self.recv_package(package)
+            action = self.next_action(actions, result, error)
+            if action is None:
+                return
+            result = error = None
+            try:
+                result = getattr(self, action[0])(*action[1:])
+            except socket.error as e:
+                error = e
 
-    def pause(self):
-        """Pause the socket by closing connection.
+    def open_connection(self, send_addr, max_retries=None, is_link=True):
+        """Connect to a target socket by infinite retrying, or open a new stream in a persistent
+        link if it is supported by the target. The other peers (e.g. relay peers) are connected
+        without a persistent link, as the features are negotiated with the target only.
+
+        Args:
+            send_addr: A address-like set of the target ip and port.
+            max_retries: None or a integer of the connecting attempts to a swarm peer, which is
+            connected without a persistent link as it may be unreachable.
+            is_link: A bool of whether the message may be sent in a persistent link.
+        """
+        # Release the stream of the last failed transmission.
+        self.close_connection()
+        if is_link and 'mux' in self.parent.features and max_retries is None and \
+                send_addr == self.parent.send_addr:
+            self.link = self.parent.get_link(send_addr)
+            self.stream_id = self.link.open_stream()
+            return
+        self.sock = _link.open_socket(send_addr, max_retries)
+
+    def close_connection(self):
+        """Pause the socket by closing connection, or close the stream in the persistent link.
         """
+        if self.link is not None:
+            self.link.close_stream(self.stream_id)
+            self.link = None
+            return
         self.sock.close()
-        self.sock, addr = self.recv_sock.accept()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-    def _recv_package(self):
-        """Receive a message by a guide package.
+    def write_package(self, code, args, fp=None):
+        """Send a message by given code and arguments.
+
+        Args:
+            code: A _protocol.code of the sending package code.
+            args: A tuple of the arguments of the message.
+            fp: None or a file pointer to send the raw data following the message, where the
+            position and size of the data are the first two arguments.
+        """
+        buffers = _protocol.pack_buffers(code, *args, version=self.get_version(code))
+        if self.link is not None:
+            self.link.send(self.stream_id, buffers, fp, *args[:2])
+            return
+        # Send a guide package of a fixed length to tell the length of the message, which is sent
+        # together with the message by one syscall.
+        _link.send_buffers(self.sock, [_protocol.guide_struct.pack(sum(map(len, buffers))),
+                                       *buffers])
+        if fp is not None:
+            _link.send_raw(self.sock, fp, *args[:2])
+
+    def read_package(self):
+        """Receive a reply on the connection in _link.reply_timeout.
 
         Returns:
-            None or A bytes of raw message.
+            None if the connection is closed by the target, or a set of the code and arguments.
+
+        Raises:
+            socket.timeout: The target does not reply or close the connection.
         """
-        # Receive the fixed-length guide package to decide the buffer size for message.
-        # Apply socket.MSG_WAITALL to avoid receiving only half package.
-        msg = self.sock.recv(struct.calcsize(_protocol.guide_format), socket.MSG_WAITALL)
-        # Discard empty package in some conditions.
-        if len(msg) == 0:
-            return None
-        buffer_size = struct.unpack(_protocol.guide_format, msg)[0]
-        package = self.sock.recv(buffer_size, socket.MSG_WAITALL)
-        return package
+        self.sock.settimeout(_link.reply_timeout)
+        try:
+            guide = _link.recv_exactly(self.sock, _protocol.guide_struct.size)
+            if guide is None:
+                return None
+            package = _link.recv_exactly(self.sock, _protocol.guide_struct.unpack(guide)[0])
+        finally:
+            self.sock.settimeout(None)
+        return None if package is None else _protocol.unpack(package)
 
-    def recv_package(self, package):
-        """Parse a given message package.
+    def get_tcp_info(self):
+        sock = self.sock if self.link is None else self.link.sock
+        return _poolController.get_tcp_info(sock)
+
+
+class _link(object):
+    """A persistent connection to a target address, which is shared by send threads.
+
+    Messages are framed with stream ids, so that several transmissions interleave on one
+    connection and the connection is not reestablished for each block. The connection is
+    reestablished with exponential backoff if it is broken.
+
+    Attributes:
+        backoff_time: A float of the initial waiting time (second) before reconnecting.
+        max_backoff_time: A float of the maximum waiting time (second) before reconnecting.
+        sendfile_size: A integer of the maximum size of raw data sent after one BLCK command, so
+        that other streams can interleave between them.
+        reply_timeout: A float of the maximum waiting time (second) for the reply to CONT command.
+        send_addr: A address-like set of the target ip and port.
+        sock: None or a socket connected to the target address.
+        lock: A lock to send a frame exclusively.
+        streams: A set of the ids of the open streams, which are closed with the connection.
+        _ids: A protected iterator of new stream ids.
+    """
+    backoff_time = 0.05
+    max_backoff_time = 2.0
+    sendfile_size = 1024 * 1024
+    reply_timeout = 10.0
+
+    def __init__(self, send_addr):
+        self.send_addr = send_addr
+        self.sock = None
+        self.lock = threading.Lock()
+        self.streams = set()
+        self._ids = itertools.count(1)
+
+    @classmethod
+    def open_socket(cls, send_addr, max_retries=None):
+        """Connect to a target socket by retrying with exponential backoff.
 
         Args:
-            package: A bytes of received message.
+            send_addr: A address-like set of the target ip and port.
+            max_retries: None or a integer of the connecting attempts, which is infinite if None.
+
+        Returns:
+            A socket connected to the target address.
 
         Raises:
-            Exception: A custom exception to receive unknown code.
+            socket.error: The target is not connected in max_retries attempts.
         """
-        package = _protocol.unpack(package)
-        code = package[0]
-        args = package[1:]
-        if code == _protocol.code.CONT:
-            self.recv_cont(*args)
-        elif code == _protocol.code.SEND:
-            self.recv_send(*args)
-        elif code == _protocol.code.PAKG:
-            self.recv_pakg(*args)
+        wait_time = cls.backoff_time
+        attempts = 0
+        while True:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.connect(send_addr)
+                return sock
+            except socket.error:
+                sock.close()
+            fileMetrics.inc('reconnects')
+            attempts += 1
+            if max_retries is not None and attempts >= max_retries:
+                raise socket.error("Failed to connect to {}:{}".format(*send_addr))
+            time.sleep(wait_time)
+            wait_time = min(wait_time * 2, cls.max_backoff_time)
+
+    @staticmethod
+    def send_buffers(sock, buffers):
+        """Send buffers by gathering them in sendmsg, which is repeated for the rest if the
+        buffers are sent partially.
+
+        Args:
+            sock: A socket to send data.
+            buffers: A list of bytes-like objects.
+        """
+        buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+        while buffers:
+            sent = sock.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent:
+                buffers[0] = buffers[0][sent:]
+
+    @staticmethod
+    def recv_exactly(sock, size):
+        """Receive data of a given size.
+
+        Args:
+            sock: A socket to receive data.
+            size: A integer of the size of data.
+
+        Returns:
+            None if the connection is closed before the data, or a bytearray of the data.
+        """
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            length = sock.recv_into(view[received:], size - received)
+            if length == 0:
+                return None
+            received += length
+        return data
+
+    @staticmethod
+    def send_raw(sock, fp, position, size):
+        """Send raw data of a file copied from the page cache to the socket by the kernel.
+
+        Args:
+            sock: A socket to send data.
+            fp: A file pointer of the file.
+            position: A integer of the start position of the data.
+            size: A integer of the size of the data.
+        """
+        sent = sock.sendfile(fp, position, size)
+        # Pad the data if the file is truncated meanwhile to keep the stream aligned. The changed
+        # file will be sent again after the next scanning.
+        if sent < size:
+            sock.sendall(bytes(size - sent))
+
+    def open_stream(self):
+        """Open a new stream in the link.
+
+        Returns:
+            A integer of the stream id.
+        """
+        with self.lock:
+            stream_id = next(self._ids)
+            self.streams.add(stream_id)
+            return stream_id
+
+    def close_stream(self, stream_id):
+        with self.lock:
+            self.streams.discard(stream_id)
+
+    def send(self, stream_id, buffers, fp=None, position=0, size=0):
+        """Send a framed message, followed by raw data of a file if given.
+
+        Args:
+            stream_id: A integer of the stream id.
+            buffers: A list of bytes-like objects of the packed message.
+            fp: None or a file pointer to send the raw data following the message.
+            position: A integer of the start position of the raw data.
+            size: A integer of the size of the raw data.
+
+        Raises:
+            socket.error: The connection is broken and will be reestablished by the next sending,
+            or the stream is closed with the last connection.
+        """
+        with self.lock:
+            # The streams sent on a broken connection are closed with it before reconnecting, so
+            # that the rest of their messages are never sent on the new connection.
+            if self.sock is not None and self._is_closed():
+                self._close()
+            if stream_id not in self.streams:
+                raise socket.error("Stream %d closed with the connection" % stream_id)
+            if self.sock is None:
+                self._connect()
+            try:
+                guide = _protocol.mux_guide_struct.pack(sum(map(len, buffers)), stream_id)
+                self.send_buffers(self.sock, [guide, *buffers])
+                if fp is not None:
+                    self.send_raw(self.sock, fp, position, size)
+            except socket.error:
+                self._close()
+                raise
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _connect(self):
+        self.sock = self.open_socket(self.send_addr)
+        # Send a LINK command in the basic framing to mark the connection as persistent.
+        package = _protocol.pack(_protocol.code.LINK)
+        self.sock.sendall(struct.pack(_protocol.guide_format, len(package)) + package)
+
+    def _close(self):
+        # The streams in transmission are sent again in new streams.
+        self.streams.clear()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _is_closed(self):
+        # The receiver never sends data, so a readable socket means the connection is closed.
+        return bool(select.select([self.sock], [], [], 0)[0])
+
+
+class _threadPool(abc.ABC):
+    """A base class of the processes which own a resizable pool of sub-threads, which are created
+    by the new_thread() of the subclasses.
+
+    Attributes:
+        thread_num: A integer of the target number of sub-threads.
+        thread_list: A list of the sub-threads in the pool.
+        pool_lock: A lock to resize the pool exclusively.
+    """
+    thread_num = 0
+    thread_list = list()
+    pool_lock = threading.Lock()
+
+    def init_thread(self, num):
+        """Resize the pool of sub-threads. New threads are started if the pool is grown, and the
+        extra threads are ended after their current messages if the pool is shrunk.
+
+        Args:
+            num: A integer of the number of threads.
+        """
+        with self.pool_lock:
+            self.thread_num = num
+            for i in range(num - len(self.thread_list)):
+                self.thread_list.append(self.new_thread())
+                self.thread_list[-1].start()
+
+    def keep_thread(self, thread):
+        """Decide whether a sub-thread is kept in the pool. The thread is removed from the pool if
+        the pool is shrunk, while the threads out of the pool are always kept.
+
+        Args:
+            thread: A sub-thread in the pool.
+
+        Returns:
+            A bool of whether the thread is kept.
+        """
+        with self.pool_lock:
+            if thread not in self.thread_list or len(self.thread_list) <= self.thread_num:
+                return True
+            self.thread_list.remove(thread)
+            return False
+
+    def release_thread(self, thread):
+        """Remove a sub-thread from the pool, which is replaced by a new thread.
+
+        Args:
+            thread: A sub-thread in the pool.
+        """
+        with self.pool_lock:
+            self.thread_list.remove(thread)
+        self.init_thread(self.thread_num)
+
+    @abc.abstractmethod
+    def new_thread(self):
+        """Create a sub-thread of the pool, which is not started yet.
+
+        Returns:
+            A sub-thread with a start() method.
+        """
+
+
+class _poolController(threading.Thread):
+    """A thread to adapt the number of sending threads to the measured goodput by hill climbing.
+
+    The number is changed by one in each measurement window. The direction is kept while the
+    goodput increases and reversed when it decreases. Fewer threads are preferred if the goodput
+    is not changed, and the number is decreased directly if the streams retransmit or their RTT
+    is inflated, so that a lossy link is not congested by more streams. The windows in which
+    the threads are idle are not measured.
+
+    Attributes:
+        interval_time: A float of the time (second) of a measurement window.
+        busy_ratio: A float of the minimum ratio of busy time of the threads in a window.
+        tolerance: A float of the relative change of goodput regarded as noise.
+        max_loss_rate: A float of the maximum ratio of retransmitted segments.
+        max_rtt_ratio: A float of the maximum ratio of the RTT to the minimum RTT.
+        min_rtt: A integer of the lower bound (microsecond) of the minimum RTT.
+        segment_size: A integer of the estimated size of a TCP segment.
+        parent: A instance of fileSocket.sendSocket whose pool is adapted.
+        min_num: A integer of the minimum number of sending threads.
+        max_num: A integer of the maximum number of sending threads.
+        lock: A lock to record samples exclusively.
+        sample: A list of the block size, busy time, RTT sum, RTT count and retransmissions in
+        the current window.
+        base_rtt: None or a integer of the minimum RTT (microsecond) ever measured.
+        last_goodput: None or a float of the goodput (bytes/second) of the last window.
+        direction: A integer of the direction (1 or -1) of the last change.
+    """
+    interval_time = 2.0
+    busy_ratio = 0.8
+    tolerance = 0.05
+    max_loss_rate = 0.01
+    max_rtt_ratio = 4
+    min_rtt = 1000
+    segment_size = 1448
+
+    def __init__(self, parent, min_num, max_num):
+        threading.Thread.__init__(self)
+        self.parent = parent
+        self.min_num = min_num
+        self.max_num = max_num
+        self.lock = threading.Lock()
+        self.sample = [0, 0.0, 0, 0, 0]
+        self.base_rtt = None
+        self.last_goodput = None
+        self.direction = 1
+        self.daemon = True
+
+    @staticmethod
+    def get_tcp_info(sock):
+        """Get the RTT and retransmissions of a socket from TCP_INFO of Linux.
+
+        Args:
+            sock: None or a socket.
+
+        Returns:
+            None or a set of (rtt, total_retrans), where rtt is a integer of the smoothed RTT
+            (microsecond) and total_retrans is a integer of the retransmitted segments.
+        """
+        if sock is None or not hasattr(socket, 'TCP_INFO'):
+            return None
+        try:
+            info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+        except (OSError, ValueError):
+            return None
+        if len(info) < 104:
+            return None
+        # The offsets of tcpi_rtt and tcpi_total_retrans in struct tcp_info.
+        return struct.unpack_from('I', info, 68)[0], struct.unpack_from('I', info, 100)[0]
+
+    def record(self, size, elapsed, start_info, end_info):
+        """Record the transmission of a block.
+
+        Args:
+            size: A integer of the size of the block.
+            elapsed: A float of the time (second) to send the block.
+            start_info: None or a set of TCP_INFO when the transmission is started.
+            end_info: None or a set of TCP_INFO when the transmission is finished.
+        """
+        with self.lock:
+            self.sample[0] += size
+            self.sample[1] += elapsed
+            if end_info is not None:
+                self.sample[2] += end_info[0]
+                self.sample[3] += 1
+                if start_info is not None:
+                    self.sample[4] += max(end_info[1] - start_info[1], 0)
+
+    def run(self):
+        """Start function for multithreading. Adapt the pool after each measurement window.
+        """
+        while True:
+            time.sleep(self.interval_time)
+            with self.lock:
+                size, elapsed, rtt_sum, rtt_num, retrans = self.sample
+                self.sample = [0, 0.0, 0, 0, 0]
+            num = self.parent.thread_num
+            if 'pool' not in self.parent.features or \
+                    elapsed < num * self.interval_time * self.busy_ratio:
+                self.last_goodput = None
+                continue
+            rtt = rtt_sum // rtt_num if rtt_num else None
+            self.adapt(num, size / self.interval_time, rtt,
+                       retrans / (size / self.segment_size + 1))
+
+    def adapt(self, num, goodput, rtt, loss_rate):
+        """Change the number of sending threads by the measurement of a window.
+
+        Args:
+            num: A integer of the current number of sending threads.
+            goodput: A float of the goodput (bytes/second) of all the threads.
+            rtt: None or a integer of the average RTT (microsecond) of the streams.
+            loss_rate: A float of the ratio of retransmitted segments.
+        """
+        if rtt is not None:
+            self.base_rtt = rtt if self.base_rtt is None else min(self.base_rtt, rtt)
+        is_congested = loss_rate > self.max_loss_rate or (
+            rtt is not None and rtt > self.max_rtt_ratio * max(self.base_rtt, self.min_rtt))
+
+        if is_congested:
+            self.direction = -1
+        elif self.last_goodput is None or goodput > self.last_goodput * (1 + self.tolerance):
+            pass
+        elif goodput < self.last_goodput * (1 - self.tolerance):
+            self.direction = -self.direction
+        else:
+            self.direction = -1
+        self.last_goodput = goodput
+
+        new_num = min(max(num + self.direction, self.min_num), self.max_num)
+        if new_num != num:
+            self.parent.set_pool(new_num)
+
+
+class sendSocket(_threadPool):
+    """A subprocess-based class to send messages.
+
+    Attributes:
+        thread_queue: A instance of fileScheduler.sendScheduler to transmit message from
+        fileSocket.sendSocket to sub-threads.
+        thread_list: A list of the _sendThread sub-threads.
+        peer_queue: A instance of fileScheduler.sendScheduler to transmit message to the swarm
+        peers from fileSocket.sendSocket to peer_threads.
+        peer_threads: A list of the _sendThread sub-threads out of the pool for the swarm peers,
+        so that the swarm traffic is not held back by the target, e.g. when it is unreachable.
+        send_addr: A address-like set of the target ip and port.
+        main_queue: A queue to transmit message from fileSocket.sendSocket to
+        fileSocket.fileSocket.
+        send_queue: A queue to transmit message to fileSocket.sendSocket.
+        min_sock_num: A integer of the minimum number of sending threads.
+        max_sock_num: A integer of the maximum number of sending threads.
+        features: A set of strings of the _protocol.features negotiated with the target.
+        links: A dictionary of target addresses (keys) and lists of fileSocket._link (values),
+        where the first thread_num links are used.
+        link_lock: A lock to create links exclusively.
+        controller: A instance of fileSocket._poolController to adapt the number of threads.
+        codec: None or a string of the negotiated codec in fileLoader.CODECS to compress blocks.
+        compress_stats: A dictionary of relative filepath (keys) and lists of [the number of
+        blocks in transmission, the size of data, the sent size of data, the CPU time] (values).
+        stats_lock: A lock to update compress_stats exclusively.
+        cont_seq: A integer of the number of CONT commands put and received, so that only the
+        last one is sent if they are queued while the target is down.
+        pending: A dictionary of relative filepath (keys) and the number of the commands queued
+        or in transmission to the target (values), so that the comparison of the trees does not
+        send the files again.
+        sent_times: A dictionary of relative filepath (keys) and the time (values) when the
+        last command of the files is sent to the target.
+        pending_lock: A lock to update pending and sent_times exclusively.
+    """
+    thread_list = list()
+    pool_lock = threading.Lock()
+
+    def __init__(self, send_addr, main_queue, send_queue, min_sock_num=1, max_sock_num=1,
+                 policy=fileScheduler.DEFAULT_POLICY, rules=None):
+        self.thread_queue = fileScheduler.sendScheduler(policy, rules)
+        self.peer_queue = fileScheduler.sendScheduler(policy, rules)
+        self.peer_threads = list()
+        self.send_addr = send_addr
+        self.main_queue = main_queue
+        self.send_queue = send_queue
+        self.min_sock_num = min_sock_num
+        self.max_sock_num = max_sock_num
+        self.features = set()
+        self.links = dict()
+        self.link_lock = threading.Lock()
+        self.codec = None
+        self.compress_stats = dict()
+        self.stats_lock = threading.Lock()
+        self.cont_seq = 0
+        self.pending = dict()
+        self.sent_times = dict()
+        self.pending_lock = threading.Lock()
+
+    def start(self):
+        """Start function for multiprocess.
+        """
+        self.controller = _poolController(self, self.min_sock_num, self.max_sock_num)
+        if self.max_sock_num > self.min_sock_num:
+            self.controller.start()
+        fileMetrics.set_gauge_function('queue_depth', self.thread_queue.qsize, queue='thread')
+        fileMetrics.set_gauge_function('send_threads', lambda: self.thread_num)
+        fileSocket.report_metrics(self.main_queue, 'send')
+        while True:
+            self.get_command()
+
+    def get_command(self):
+        """Get command from send_queue.
+        """
+        command.get(self, self.send_queue)
+
+    def new_thread(self, cmd_queue=None):
+        return _sendThread(self.thread_queue if cmd_queue is None else cmd_queue, self)
+
+    def put_peer(self, func, *args):
+        """Give command to peer_threads, which are started at the first command.
+
+        Args:
+            func: A function of the send command.
+            *args: Arguments for the given function.
+        """
+        if not self.peer_threads:
+            for i in range(fileSwarm.SWARM_SEND_NUM):
+                self.peer_threads.append(self.new_thread(self.peer_queue))
+                self.peer_threads[-1].start()
+        command.put(func, self.peer_queue, *args)
+
+    def set_pool(self, num):
+        """Resize the pool of sending threads and synchronize the number with the target.
+
+        Args:
+            num: A integer of the number of threads.
+        """
+        self.init_thread(num)
+        command.put(_sendThread.send_pool, self.thread_queue, self.send_addr, num)
+
+    def set_features(self, features):
+        """Set the negotiated features which are shared by all the sub-threads.
+
+        Args:
+            features: A set of strings of the negotiated _protocol.features.
+        """
+        self.features.clear()
+        self.features.update(features)
+        self.codec = next((codec for codec in fileLoader.CODECS if codec in features), None)
+        # The target is up as it has sent CONT command, so the CONT commands queued before are
+        # dropped and the echo is sent instead.
+        self.cont_seq += 1
+
+    def get_link(self, send_addr):
+        """Get the least loaded persistent link to a target address.
+
+        Args:
+            send_addr: A address-like set of the target ip and port.
+
+        Returns:
+            A instance of fileSocket._link.
+        """
+        with self.link_lock:
+            links = self.links.setdefault(send_addr, list())
+            while len(links) < self.thread_num:
+                links.append(_link(send_addr))
+            # The extra links are closed after their streams if the pool is shrunk.
+            for link in links[self.thread_num:]:
+                if not link.streams:
+                    link.close()
+            return min(links[:max(self.thread_num, 1)], key=lambda link: len(link.streams))
+
+    def send_cont(self, sock_num, is_echo, features, root):
+        """Send CONT command to the sending address.
+
+        Args:
+            sock_num: A integer of accepted number of sockets.
+            is_echo: A bool of whether this command is an echo (send after receiving CONT).
+            features: A set of strings of the supported _protocol.features.
+            root: A string of the root hash of the local fileMerkle.merkleTree.
+        """
+        self.cont_seq += 1
+        command.put(_sendThread.send_cont, self.thread_queue, self.send_addr, sock_num, is_echo,
+                    features, root, self.cont_seq)
+
+    def send_mrkq(self, prefixes):
+        """Request the nodes of the Merkle tree of the sending address.
+
+        Args:
+            prefixes: A string of the JSON list of the prefixes of the nodes.
+        """
+        command.put(_sendThread.send_mrkq, self.thread_queue, self.send_addr, prefixes)
+
+    def send_mrkr(self, nodes):
+        """Reply the requested nodes of the local Merkle tree to the sending address.
+
+        Args:
+            nodes: A string of the JSON list of the nodes.
+        """
+        command.put(_sendThread.send_mrkr, self.thread_queue, self.send_addr, nodes)
+
+    def send_file(self, filename, bitmap=None):
+        """Send a file to the sending address.
+
+        Args:
+            filename: A string of the relative path of the file.
+            bitmap: None or a bytes of the bitmap of the blocks verified by the sending address.
+        """
+        # The blocks of the file which are not sent yet are stale if the file is sent again.
+        try:
+            file_size = os.path.getsize(filename)
+        except OSError:
+            # The file is removed meanwhile, e.g. a temporary file reported by the watcher.
+            return
+        self.thread_queue.renew(filename, file_size)
+
+        # Offer the block hashes of the file first, and the blocks not held by the sending address
+        # are requested by RSUM command.
+        if bitmap is None and {'dedup', 'resume'} <= self.features and \
+                file_size >= fileLoader.DEDUP_MIN_SIZE:
+            self.hold([filename], is_renewed=True)
+            command.put(_sendThread.send_offr, self.thread_queue, self.send_addr, filename)
+            return
+
+        try:
+            loader = fileLoader.fileLoader(filename, bitmap)
+            block_num = loader.block_num
+            # The md5 lets the sending address journal the blocks to resume after a restart.
+            file_hash = fileLoader.get_file_info(filename) if 'resume' in self.features else None
+        except OSError:
+            return
+
+        blocks = list(loader)
+        self.hold([filename], len(blocks), is_renewed=True)
+        if self.codec is not None:
+            with self.stats_lock:
+                self.compress_stats[filename] = [len(blocks), 0, 0, 0.0]
+
+        for block in blocks:
+            # Mark the start of sending a block.
+            command.put(_sendThread.send_file, self.thread_queue, self.send_addr, block, block_num,
+                        file_hash)
+
+    def send_bundle(self, filenames):
+        """Send small files in a bundle to the sending address.
+
+        Args:
+            filenames: A list of strings of the relative paths of the files.
+        """
+        self.hold(filenames)
+        command.put(_sendThread.send_bundle, self.thread_queue, self.send_addr, filenames,
+                    'resume' in self.features)
+
+    def hold(self, filenames, num=1, is_renewed=False):
+        """Count the commands of files queued to the sending address.
+
+        Args:
+            filenames: A list of strings of the relative paths of the files.
+            num: A integer of the number of the commands of each file.
+            is_renewed: A bool of whether the queued commands of the files are cancelled.
+        """
+        with self.pending_lock:
+            for filename in filenames:
+                self.pending[filename] = num + (0 if is_renewed else self.pending.get(filename, 0))
+
+    def release(self, send_addr, filenames):
+        """Count down a finished command of files, if it is sent to the sending address.
+
+        Args:
+            send_addr: A address-like set of the address which the command is sent to.
+            filenames: A list of strings of the relative paths of the files.
+        """
+        if send_addr != self.send_addr:
+            return
+        with self.pending_lock:
+            for filename in filenames:
+                if self.pending.get(filename, 0) > 1:
+                    self.pending[filename] -= 1
+                else:
+                    self.pending.pop(filename, None)
+                    self.sent_times[filename] = time.time()
+
+    def send_missing(self, added, updated, start_time):
+        """Send back the files found by the comparison of the trees to fileSocket.fileSocket,
+        except the files queued or in transmission to the sending address, and the files sent
+        after the comparison is started, which the nodes of the sending address may miss. A
+        send into the sending address while it is going down is lost, so the file is sent again
+        by the next comparison.
+
+        Args:
+            added: A list of strings of the relative paths of the missing files.
+            updated: A list of strings of the relative paths of the newer files.
+            start_time: A float of the time when the comparison is started.
+        """
+        def is_missing(filename):
+            return filename not in self.pending and \
+                self.sent_times.get(filename, 0) < start_time
+
+        with self.pending_lock:
+            added = [filename for filename in added if is_missing(filename)]
+            updated = [filename for filename in updated if is_missing(filename)]
+        if added or updated:
+            logger.info("Reconcile %d missing and %d newer files with the sending address",
+                        len(added), len(updated))
+            command.put(fileSocket.send_files, self.main_queue, added, updated)
+
+    def report(self, filename, size, sent_size, cpu_time):
+        """Record the compression of a sent block. Report the bytes saved and the CPU time of a
+        file after all the blocks are sent.
+
+        Args:
+            filename: A string of the relative path of the file.
+            size: A integer of the size of the block.
+            sent_size: A integer of the sent size of the block.
+            cpu_time: A float of the CPU time (second) of compression.
+        """
+        with self.stats_lock:
+            stats = self.compress_stats.get(filename)
+            if stats is None:
+                return
+            stats[0] -= 1
+            stats[1] += size
+            stats[2] += sent_size
+            stats[3] += cpu_time
+            if stats[0] > 0:
+                return
+            del self.compress_stats[filename]
+        logger.info("Sent %s by %s: %d of %d bytes saved (%.1f%%), %.3fs CPU time", filename,
+                    self.codec, stats[1] - stats[2], stats[1],
+                    100 * (stats[1] - stats[2]) / max(stats[1], 1), stats[3])
+
+    def send_rsum(self, filename, file_size, file_hash, bitmap):
+        """Request the blocks of a file which are not verified from the sending address.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the expected size of the file.
+            file_hash: A string of the expected md5 of the file.
+            bitmap: A bytes of the bitmap of the verified blocks.
+        """
+        command.put(_sendThread.send_rsum, self.thread_queue, self.send_addr, filename, file_size,
+                    file_hash, bitmap)
+
+    def send_gone(self, filename, file_hash):
+        """Tell the sending address that a file requested by RSUM command is not held anymore.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the file requested by RSUM command.
+        """
+        command.put(_sendThread.send_gone, self.thread_queue, self.send_addr, filename, file_hash)
+
+    def send_rtry(self, filename, block_index, file_hash):
+        """Request a corrupt block of a file again from the sending address.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_index: A integer of the index of the block.
+            file_hash: None or a string of the md5 of the journaled file.
+        """
+        command.put(_sendThread.send_rtry, self.thread_queue, self.send_addr, filename,
+                    block_index, file_hash)
+
+    def send_block(self, filename, block_index, file_hash):
+        """Send a block of a file again to the sending address, while the other queued blocks of
+        the file are kept.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_index: A integer of the index of the block.
+            file_hash: None or a string of the md5 of the file to journal the block.
+        """
+        try:
+            block_num = math.ceil(os.path.getsize(filename) / fileLoader.TEMP_FILE_SIZE)
+        except OSError:
+            # The file is removed meanwhile.
+            return
+        self.hold([filename])
+        command.put(_sendThread.send_file, self.thread_queue, self.send_addr,
+                    (filename, block_index), block_num, file_hash)
+
+    def send_sigr(self, filename):
+        """Request the block signatures of the old copy of a file from the sending address.
+
+        Args:
+            filename: A string of the relative path of the file.
+        """
+        self.hold([filename])
+        command.put(_sendThread.send_sigr, self.thread_queue, self.send_addr, filename)
+
+    def send_sigs(self, filename):
+        """Send the block signatures of a file to the sending address.
+
+        Args:
+            filename: A string of the relative path of the file.
+        """
+        command.put(_sendThread.send_sigs, self.thread_queue, self.send_addr, filename)
+
+    def send_delta(self, filename, block_size, signatures):
+        """Send the delta of a file to the sending address, or the whole file if the sending
+        address has no old copy.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_size: A integer of the block size of the signatures.
+            signatures: A bytes of the block signatures.
+        """
+        if len(signatures) == 0:
+            self.send_file(filename)
+            return
+        try:
+            file_size = os.path.getsize(filename)
+        except OSError:
+            # The file is removed meanwhile.
+            return
+        self.thread_queue.renew(filename, file_size)
+        self.hold([filename], is_renewed=True)
+        command.put(_sendThread.send_delta, self.thread_queue, self.send_addr, filename,
+                    block_size, signatures)
+
+    def send_have(self, send_addr, manifest, port, is_echo, is_update):
+        """Announce the held files to a swarm peer.
+
+        Args:
+            send_addr: A address-like set of the ip and port of the swarm peer.
+            manifest: A string of the JSON list of [filename, size, md5] of the files.
+            port: A integer of the local port.
+            is_echo: A bool of whether this command is an echo (send after receiving HAVE).
+            is_update: A bool of whether the files are finished or changed just now.
+        """
+        self.put_peer(_sendThread.send_have, send_addr, manifest, port, is_echo, is_update)
+
+    def send_getb(self, send_addr, filename, file_hash, block_index, port):
+        """Request a block of a file version from a swarm peer.
+
+        Args:
+            send_addr: A address-like set of the ip and port of the swarm peer.
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the file.
+            block_index: A integer of the index of the block.
+            port: A integer of the local port.
+        """
+        self.put_peer(_sendThread.send_getb, send_addr, filename, file_hash, block_index, port)
+
+    def send_part(self, send_addr, filename, block_index, file_hash):
+        """Send a block requested by a swarm peer.
+
+        Args:
+            send_addr: A address-like set of the ip and port of the swarm peer.
+            filename: A string of the relative path of the file.
+            block_index: A integer of the index of the block.
+            file_hash: A string of the md5 of the file.
+        """
+        try:
+            block_num = math.ceil(os.path.getsize(filename) / fileLoader.TEMP_FILE_SIZE)
+        except OSError:
+            # The file is removed meanwhile.
+            return
+        self.put_peer(_sendThread.send_part, send_addr, (filename, block_index), block_num,
+                      file_hash)
+
+    def send_relay(self, send_addrs, filename, file_hash, block_num, block_indexes):
+        """Forward the received blocks of a file to the relay peers, which journal them with
+        the md5 of the file and forward them again.
+
+        Args:
+            send_addrs: A list of the addresses of the relay peers.
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the file.
+            block_num: A integer of the number of split blocks.
+            block_indexes: A list of the indexes of the blocks.
+        """
+        for send_addr in send_addrs:
+            for block_index in block_indexes:
+                command.put(_sendThread.send_file, self.thread_queue, send_addr,
+                            (filename, block_index), block_num, file_hash)
+
+    def drop_peer(self, send_addr):
+        """Report a unreachable swarm peer to fileSocket.fileSocket.
+
+        Args:
+            send_addr: A address-like set of the ip and port of the swarm peer.
+        """
+        fileMetrics.inc('swarm_errors')
+        command.put(fileSocket.drop_peer, self.main_queue, send_addr)
+
+
+class _recvStream(object):
+    """A auxiliary class of the status of a stream in a connection.
+
+    Attributes:
+        stream_id: A integer of the stream id.
+        filename: None or a string of the relative path of the file in transmission.
+        block_index: None or a integer of the index of the block in transmission.
+        file_hash: None or a string of the md5 of the journaled file in transmission.
+        manifest: None or a list of [filename, size, md5] of the bundle in transmission.
+        fw: None or a instance of fileLoader.fileWriter of the file in transmission, or
+        fileLoader.bundleWriter of the bundle in transmission.
+        cont: None or a set of the arguments (sock_num, is_echo) of the CONT command waiting for
+        the features.
+        start_time: A float of the time when the transmission is started.
+    """
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.filename = None
+        self.block_index = None
+        self.file_hash = None
+        self.manifest = None
+        self.fw = None
+        self.cont = None
+        self.start_time = time.time()
+
+    def check(self, crc):
+        """Check the written data by the CRC32 of the sent data before the stream is closed.
+
+        Args:
+            crc: None or a integer of the CRC32 of the sent block, or a bytes of the concatenated
+            CRC32 of the files of the sent bundle, which is None for the sockets without 'crc'
+            feature.
+
+        Returns:
+            A list of [filename, block_index, md5] of the corrupt blocks to request again, where
+            md5 is None if the file is not journaled.
+        """
+        if crc is None or self.fw is None:
+            return []
+        if self.manifest is not None:
+            # The corrupt files of a bundle are requested again as single blocks.
+            crc = bytes(crc)
+            crcs = self.fw.checksums()
+            return [[filename, 0, file_hash] for i, (filename, _, file_hash) in
+                    enumerate(self.manifest) if crcs[4 * i: 4 * i + 4] != crc[4 * i: 4 * i + 4]]
+        if self.fw.checksum() == crc:
+            return []
+        block_index = self.block_index
+        if block_index is None:
+            block_index = self.fw.start // fileLoader.TEMP_FILE_SIZE
+        return [[self.filename, block_index, self.file_hash]]
+
+    def close(self):
+        if self.fw is not None:
+            self.fw.close()
+            self.fw = None
+
+
+class _recvHandler(object):
+    """A base class of the messages received by the engines, which is shared by
+    fileSocket._recvThread and fileAsync._recvTask.
+
+    The messages are parsed and handled here, while the engines read them from the connections,
+    including the raw block data following BLCK command, reply on the connections, and pause or
+    close them.
+
+    Attributes:
+        main_queue: A queue to transmit message from the engine to fileSocket.fileSocket.
+        recv_dict: A instance of fileState.stateTable of the received files shared with
+        fileSocket.fileSocket and fileScanner.fileScanner.
+        share_folder: A string of the relative path of the shared folder.
+        peer_ip: None or a string of the ip of the connection.
+        streams: A dictionary of stream ids (keys) and fileSocket._recvStream (values).
+        stream: A instance of fileSocket._recvStream of the current message.
+    """
+    def select_stream(self, stream_id):
+        """Select the stream of the current message, which is opened by its first message.
+
+        Args:
+            stream_id: A integer of the stream id, which is 0 without a persistent link.
+        """
+        if stream_id not in self.streams:
+            self.streams[stream_id] = _recvStream(stream_id)
+        self.stream = self.streams[stream_id]
+
+    def recv_package(self, package):
+        """Parse a given message package.
+
+        Args:
+            package: A bytes-like object of received message.
+        """
+        self.dispatch(*_protocol.unpack(package))
+
+    def check_path(self, *filenames):
+        """Check the paths of the files in a message from another socket.
+
+        Args:
+            *filenames: Strings of the relative paths of the files.
+
+        Raises:
+            PermissionError: A file is out of the shared folder, so that the connection is closed.
+        """
+        for filename in filenames:
+            if not fileLoader.is_shared(filename, self.share_folder):
+                logger.warning("Reject %s out of the shared folder from %s", filename,
+                               self.peer_ip)
+                raise PermissionError("Out of the shared folder: {}".format(filename))
+
+    def close_streams(self):
+        """Close the streams of a closed connection. The CONT command waiting for the features is
+        from a baseline socket, which closes the connection instead of replying FEAT command.
+        """
+        for stream in self.streams.values():
+            if stream.cont is not None:
+                command.put(fileSocket.recv_cont, self.main_queue, *stream.cont)
+            stream.close()
+        self.streams = dict()
+
+    def dispatch(self, code, *args):
+        """Handle a parsed message by its code.
+
+        Args:
+            code: A _protocol.code of the message.
+            *args: The arguments of the message.
+
+        Raises:
+            Exception: A custom exception to receive unknown code.
+        """
+        if code == _protocol.code.CONT:
+            self.recv_cont(*args)
+        elif code == _protocol.code.FEAT:
+            self.recv_feat(*args)
+        elif code == _protocol.code.LINK:
+            self.recv_link(*args)
+        elif code == _protocol.code.SEND:
+            self.recv_send(*args)
+        elif code == _protocol.code.BNDL:
+            self.recv_bndl(*args)
+        elif code == _protocol.code.PAKG:
+            self.recv_pakg(*args)
+        elif code == _protocol.code.ZPKG:
+            self.recv_zpkg(*args)
+        elif code == _protocol.code.BLCK:
+            self.recv_blck(*args)
+        elif code == _protocol.code.HOLE:
+            self.recv_hole(*args)
         elif code == _protocol.code.VRFY:
             self.recv_vrfy(*args)
+        elif code == _protocol.code.OFFR:
+            self.recv_offr(*args)
+        elif code == _protocol.code.RSUM:
+            self.recv_rsum(*args)
+        elif code == _protocol.code.GONE:
+            self.recv_gone(*args)
+        elif code == _protocol.code.SIGR:
+            self.recv_sigr(*args)
+        elif code == _protocol.code.SIGS:
+            self.recv_sigs(*args)
+        elif code == _protocol.code.DLTA:
+            self.recv_dlta(*args)
+        elif code == _protocol.code.COPY:
+            self.recv_copy(*args)
+        elif code == _protocol.code.RTRY:
+            self.recv_rtry(*args)
+        elif code == _protocol.code.POOL:
+            self.recv_pool(*args)
+        elif code == _protocol.code.HAVE:
+            self.recv_have(*args)
+        elif code == _protocol.code.GETB:
+            self.recv_getb(*args)
+        elif code == _protocol.code.MRKQ:
+            self.recv_mrkq(*args)
+        elif code == _protocol.code.MRKR:
+            self.recv_mrkr(*args)
         else:
             raise Exception("Recv Unknown Code: {}".format(code))
 
     def recv_cont(self, sock_num, is_echo):
-        """Receive CONT command from another socket.
+        """Receive CONT command from another socket. Reply FEAT command to ask for the features,
+        which are not sent by a baseline socket.
 
         Args:
             sock_num: A integer of requested number of sockets.
             is_echo: A bool of whether this command is an echo (send after receiving CONT).
         """
-        command.put(fileSocket.recv_cont, self.main_queue, sock_num, is_echo)
+        self.stream.cont = (sock_num, is_echo)
+        self.reply(_protocol.code.FEAT)
+
+    def recv_feat(self, features, root):
+        """Receive FEAT command with the features following CONT command from another socket.
+
+        Args:
+            features: A string of comma-separated _protocol.features supported by another socket.
+            root: A string of the root hash of the Merkle tree of another socket, which is empty
+            for the sockets without 'merkle' feature.
+        """
+        cont, self.stream.cont = self.stream.cont, None
+        if cont is not None:
+            command.put(fileSocket.recv_cont, self.main_queue, *cont, features, root)
+        self.pause()
+
+    def recv_send(self, filename, block_num, file_size, block_index=None, file_hash=None,
+                  is_sparse=False):
+        """Receive SEND command from another socket.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_num: A integer of the number of split blocks.
+            file_size: A integer of the size of the file.
+            block_index: None or a integer of the index of the block.
+            file_hash: None or a string of the md5 of the file to journal the block.
+            is_sparse: A bool of whether the file is sparse, which is False for the sockets
+            without 'sparse' feature.
+        """
+        self.check_path(filename)
+        # Receive a SEND command as the start mark of a block.
+        recvSocket.mark_files(self.recv_dict, [filename])
+        command.put(fileSocket.recv_send, self.main_queue, filename, block_num, file_size,
+                    file_hash)
+        self.stream.filename = filename
+        self.stream.block_index = block_index
+        self.stream.file_hash = file_hash
+        self.stream.fw = fileLoader.fileWriter(filename, file_size, sparse=is_sparse)
+
+    def recv_bndl(self, manifest):
+        """Receive BNDL command from another socket. Mark the files into a transmission status.
+
+        Args:
+            manifest: A string of the JSON list of [filename, size, md5] of the files.
+        """
+        self.stream.manifest = json.loads(manifest)
+        self.check_path(*[i[0] for i in self.stream.manifest])
+        recvSocket.mark_files(self.recv_dict, [i[0] for i in self.stream.manifest])
+        command.put(fileSocket.recv_bndl, self.main_queue, self.stream.manifest)
+        self.stream.fw = fileLoader.bundleWriter(self.stream.manifest)
+
+    def recv_pakg(self, position, data):
+        """Receive PAKG command from another socket.
+
+        Args:
+            position: A integer of the written position in the file.
+            data: A bytes-like object of the file data, which may be in the receiving buffer.
+        """
+        # If the _protocol is in base64 style, the following code is needed to decode the string of
+        # file data into bytes.
+        # data = base64.b64decode(data)
+        self.stream.fw.write(position, data)
+        fileMetrics.inc('recv_bytes', len(data))
+
+    def recv_zpkg(self, position, codec, data):
+        """Receive ZPKG command from another socket.
+
+        Args:
+            position: A integer of the written position in the file.
+            codec: A string of the codec in fileLoader.CODECS.
+            data: A bytes-like object of the compressed file data.
+        """
+        self.stream.fw.write(position, fileLoader.decompress(codec, data))
+        fileMetrics.inc('recv_bytes', len(data))
+
+    def recv_hole(self, position, size):
+        """Receive HOLE command from another socket.
+
+        Args:
+            position: A integer of the position of the hole in the file.
+            size: A integer of the size of the hole.
+        """
+        self.stream.fw.fill(position, size)
+
+    def recv_vrfy(self, crc=None):
+        """Receive VRFY command from another socket.
+
+        Args:
+            crc: None or a integer of the CRC32 of the sent block or bundle, which is None for the
+            sockets without 'crc' feature.
+        """
+        # Receive a VERY command as the end mark of a block.
+        stream = self.streams.pop(self.stream.stream_id)
+        # The data is read back before it is counted, so that a corrupt block is requested again
+        # instead of the whole file.
+        blocks = stream.check(crc)
+        stream.close()
+        fileMetrics.observe('block_recv_seconds', time.time() - stream.start_time,
+                            kind='block' if stream.manifest is None else 'bundle')
+        if blocks:
+            command.put(fileSocket.retry_blocks, self.main_queue, blocks)
+        elif stream.manifest is not None:
+            command.put(fileSocket.recv_bndl_vrfy, self.main_queue, stream.manifest)
+        else:
+            command.put(fileSocket.recv_vrfy, self.main_queue, stream.filename, stream.block_index,
+                        stream.file_hash)
+        self.pause()
+
+    def recv_offr(self, filename, file_size, file_hash, block_hashes):
+        """Receive OFFR command from another socket.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the size of the file.
+            file_hash: A string of the md5 of the file.
+            block_hashes: A bytes-like object of the concatenated sha1 of the blocks.
+        """
+        self.check_path(filename)
+        command.put(fileSocket.recv_offr, self.main_queue, filename, file_size, file_hash,
+                    bytes(block_hashes))
         self.pause()
 
-    def recv_send(self, filename, block_num, file_size):
-        """Receive SEND command from another socket.
+    def recv_rsum(self, filename, file_size, file_hash, bitmap):
+        """Receive RSUM command from another socket.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the expected size of the file.
+            file_hash: A string of the expected md5 of the file.
+            bitmap: A bytes-like object of the bitmap of the verified blocks.
+        """
+        self.check_path(filename)
+        command.put(fileSocket.recv_rsum, self.main_queue, filename, file_size, file_hash,
+                    bytes(bitmap))
+        self.pause()
+
+    def recv_gone(self, filename, file_hash):
+        """Receive GONE command from another socket.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the file requested by RSUM command.
+        """
+        self.check_path(filename)
+        command.put(fileSocket.recv_gone, self.main_queue, filename, file_hash)
+        self.pause()
+
+    def recv_sigr(self, filename):
+        """Receive SIGR command from another socket.
+
+        Args:
+            filename: A string of the relative path of the file.
+        """
+        self.check_path(filename)
+        command.put(fileSocket.recv_sigr, self.main_queue, filename)
+        self.pause()
+
+    def recv_sigs(self, filename, block_size, signatures):
+        """Receive SIGS command from another socket.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_size: A integer of the block size of the signatures.
+            signatures: A bytes-like object of the block signatures.
+        """
+        self.check_path(filename)
+        command.put(fileSocket.recv_sigs, self.main_queue, filename, block_size, bytes(signatures))
+        self.pause()
+
+    def recv_dlta(self, filename, file_size):
+        """Receive DLTA command from another socket.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the size of the file.
+        """
+        self.check_path(filename)
+        # Receive a DLTA command as the start mark of a delta, which is written as one block.
+        recvSocket.mark_files(self.recv_dict, [filename])
+        command.put(fileSocket.recv_send, self.main_queue, filename, 1, file_size)
+        self.stream.filename = filename
+        self.stream.block_index = None
+        self.stream.fw = fileLoader.fileWriter(filename, file_size, basis=filename)
+
+    def recv_copy(self, position, offset, size):
+        """Receive COPY command from another socket.
+
+        Args:
+            position: A integer of the written position in the file.
+            offset: A integer of the position of the range in the old copy.
+            size: A integer of the size of the range.
+        """
+        self.stream.fw.copy(position, offset, size)
+
+    def recv_rtry(self, filename, block_index, file_hash=None):
+        """Receive RTRY command from another socket.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_index: A integer of the index of the corrupt block.
+            file_hash: None or a string of the md5 of the journaled file.
+        """
+        self.check_path(filename)
+        command.put(fileSocket.recv_rtry, self.main_queue, filename, block_index, file_hash)
+        self.pause()
+
+    def recv_pool(self, sock_num):
+        """Receive POOL command from another socket.
+
+        Args:
+            sock_num: A integer of the number of sending threads of another socket.
+        """
+        command.put(fileSocket.recv_pool, self.main_queue, sock_num)
+        self.pause()
+
+    def recv_mrkq(self, prefixes):
+        """Receive MRKQ command from another socket.
+
+        Args:
+            prefixes: A string of the JSON list of the prefixes of the requested nodes.
+        """
+        command.put(fileSocket.recv_mrkq, self.main_queue, json.loads(prefixes))
+        self.pause()
+
+    def recv_mrkr(self, nodes):
+        """Receive MRKR command from another socket.
+
+        Args:
+            nodes: A string of the JSON list of the nodes of the Merkle tree of another socket.
+        """
+        command.put(fileSocket.recv_mrkr, self.main_queue, json.loads(nodes))
+        self.pause()
+
+    def recv_have(self, manifest, port, is_echo, is_update):
+        """Receive HAVE command from a swarm peer.
+
+        Args:
+            manifest: A string of the JSON list of [filename, size, md5] of the held files.
+            port: A integer of the port of the peer.
+            is_echo: A bool of whether this command is an echo (send after receiving HAVE).
+            is_update: A bool of whether the files are finished or changed just now.
+        """
+        manifest = json.loads(manifest)
+        self.check_path(*[i[0] for i in manifest])
+        command.put(fileSocket.recv_have, self.main_queue, (self.peer_ip, port), manifest,
+                    is_echo, is_update)
+        self.pause()
+
+    def recv_getb(self, filename, file_hash, block_index, port):
+        """Receive GETB command from a swarm peer.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the requested version of the file.
+            block_index: A integer of the index of the block.
+            port: A integer of the port of the peer.
+        """
+        self.check_path(filename)
+        command.put(fileSocket.recv_getb, self.main_queue, (self.peer_ip, port), filename,
+                    file_hash, block_index)
+        self.pause()
+
+
+class _recvThread(_recvHandler, threading.Thread):
+    """A thread to receive messages from dynamic sockets.
+
+    Attributes:
+        buffer_size: A integer of the initial size of the receiving buffer.
+        recv_sock: A socket to bind the local address and accept connections.
+        main_queue: A queue to transmit message from this thread to fileSocket.fileSocket.
+        parent: A instance of fileSocket.recvSocket which owns this thread.
+        recv_dict: A instance of fileState.stateTable of the received files of the parent.
+        share_folder: A string of the relative path of the shared folder of the parent.
+        sock: None or a socket of the accepted connection.
+        peer_ip: None or a string of the ip of the accepted connection.
+        guide_buffer: A memoryview of the reusable buffer for guide packages.
+        buffer: A memoryview of the reusable buffer for messages, which grows for larger messages.
+        is_link: A bool of whether the connection is a persistent link with framed streams.
+        streams: A dictionary of stream ids (keys) and fileSocket._recvStream (values).
+        stream: A instance of fileSocket._recvStream of the current message.
+    """
+    buffer_size = 256 * 1024
+
+    def __init__(self, recv_sock, main_queue, parent):
+        threading.Thread.__init__(self)
+        self.recv_sock = recv_sock
+        self.main_queue = main_queue
+        self.parent = parent
+        self.recv_dict = parent.recv_dict
+        self.share_folder = parent.share_folder
+        self.sock = None
+        self.peer_ip = None
+        self.is_link = False
+        self.streams = dict()
+        self.guide_buffer = memoryview(bytearray(struct.calcsize(_protocol.mux_guide_format)))
+        self.buffer = memoryview(bytearray(self.buffer_size))
+        self.daemon = True
+
+    def run(self):
+        """Start function for multithreading. Keep listening if connection is established. The
+        thread is ended if the pool is shrunk.
+        """
+        while self.parent.keep_thread(self):
+            self.accept()
+            try:
+                while self.sock is not None:
+                    package = self._recv_package()
+                    # Accept a new connection if the connection is closed by another socket.
+                    if package is None:
+                        break
+                    self.recv_package(package)
+            except socket.error:
+                pass
+            self.close()
+            # The thread of a persistent link is ended with the link.
+            if self.is_link:
+                return
+
+    def accept(self):
+        """Accept a new connection.
+        """
+        self.sock, addr = self.recv_sock.accept()
+        self.peer_ip = addr[0]
+        self.is_link = False
+
+    def close(self):
+        """Close the connection. The unfinished streams will be sent again.
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.close_streams()
+
+    def pause(self):
+        """Pause the socket by closing connection. A persistent link is kept, and only the
+        stream of the current message is closed, as every message is sent in a new stream.
+        """
+        if not self.is_link:
+            self.close()
+            return
+        stream = self.streams.pop(self.stream.stream_id, None)
+        if stream is not None:
+            stream.close()
+
+    def reply(self, code, *args):
+        """Reply a message on the connection in the basic framing.
+
+        Args:
+            code: A _protocol.code of the message.
+            *args: The arguments of the message.
+        """
+        package = _protocol.pack(code, *args)
+        self.sock.sendall(_protocol.guide_struct.pack(len(package)) + package)
+
+    def _recv_package(self):
+        """Receive a message by a guide package.
+
+        Returns:
+            None or A memoryview of raw message, which is valid until the next receiving.
+        """
+        # Receive the fixed-length guide package to decide the buffer size for message.
+        guide_format = _protocol.mux_guide_format if self.is_link else _protocol.guide_format
+        msg = self._recv_into(self.guide_buffer, struct.calcsize(guide_format))
+        # Discard empty package in some conditions.
+        if msg is None:
+            return None
+        buffer_size, *stream_id = struct.unpack_from(guide_format, msg)
+        self.select_stream(stream_id[0] if stream_id else 0)
+        if buffer_size > len(self.buffer):
+            self.buffer = memoryview(bytearray(buffer_size))
+        return self._recv_into(self.buffer, buffer_size)
+
+    def _recv_into(self, buffer, size):
+        """Receive data of a given size into a reusable buffer.
 
         Args:
-            filename: A string of the relative path of the file.
-            block_num: A integer of the number of split blocks.
-            file_size: A integer of the size of the file.
+            buffer: A memoryview of the buffer to receive data into.
+            size: A integer of the size of data.
+
+        Returns:
+            None or A memoryview of the received data in the buffer.
         """
-        # Receive a SEND command as the start mark of a block.
-        command.put(fileSocket.recv_send, self.main_queue, filename, block_num)
-        self.filename = filename
-        self.fw = fileLoader.fileWriter(filename, file_size)
+        view = buffer[:size]
+        received = 0
+        while received < size:
+            # Apply socket.MSG_WAITALL to avoid receiving only half package.
+            length = self.sock.recv_into(view[received:], size - received, socket.MSG_WAITALL)
+            if length == 0:
+                return None
+            received += length
+        return view
+
+    def recv_link(self):
+        """Receive LINK command from another socket. The connection is kept as a persistent link
+        and the following messages are framed with stream ids.
+        """
+        self.is_link = True
+        # The stream of the LINK command in the basic framing is not used by the link.
+        self.pause()
+        # This thread is kept for the link, so another thread is started to accept connections.
+        self.parent.release_thread(self)
 
-    def recv_pakg(self, position, data):
-        """Receive PAKG command from another socket.
+    def recv_blck(self, position, size):
+        """Receive BLCK command from another socket and the following raw block data.
 
         Args:
             position: A integer of the written position in the file.
-            data: A bytes of the file data.
-        """
-        # If the _protocol is in base64 style, the following code is needed to decode the string of
-        # file data into bytes.
-        # data = base64.b64decode(data)
-        self.fw.write(position, data)
-
-    def recv_vrfy(self):
-        """Receive VRFY command from another socket.
+            size: A integer of the size of the raw block data.
         """
-        # Receive a VERY command as the end mark of a block.
-        self.fw.close()
-        command.put(fileSocket.recv_vrfy, self.main_queue, self.filename)
-        self.pause()
+        end = position + size
+        while position < end:
+            data = self._recv_into(self.buffer, min(end - position, len(self.buffer)))
+            if data is None:
+                raise socket.error("Connection closed in BLCK")
+            self.stream.fw.write(position, data)
+            position += len(data)
+        fileMetrics.inc('recv_bytes', size)
 
 
-class recvSocket(object):
+class recvSocket(_threadPool):
     """A subprocess-based class to send messages.
 
     Attributes:
@@ -299,22 +2187,33 @@ class recvSocket(object):
         recv_addr: A address-like set of the local ip and port.
         main_queue: A queue to transmit message from fileSocket.recvSocket to fileSocket.fileSocket.
         recv_queue: A queue to transmit message to fileSocket.recvSocket.
+        recv_dict: A instance of fileState.stateTable of the received files shared with
+        fileSocket.fileSocket and fileScanner.fileScanner.
+        share_folder: A string of the relative path of the shared folder, out of which the
+        received files are rejected.
         recv_sock: A socket to bind the local address and listen connections.
     """
     thread_list = list()
+    pool_lock = threading.Lock()
 
-    def __init__(self, recv_addr, main_queue, recv_queue):
+    def __init__(self, recv_addr, main_queue, recv_queue, recv_dict, share_folder='./share'):
         self.recv_addr = recv_addr
         self.main_queue = main_queue
         self.recv_queue = recv_queue
+        self.recv_dict = recv_dict
+        self.share_folder = share_folder
 
         self.recv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allow rebinding the port when a restarted process left connections in TIME_WAIT.
+        self.recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.recv_sock.bind(self.recv_addr)
         self.recv_sock.listen()
 
     def start(self):
         """Start function for multiprocess.
         """
+        fileMetrics.set_gauge_function('recv_threads', lambda: self.thread_num)
+        fileSocket.report_metrics(self.main_queue, 'recv')
         while True:
             self.get_command()
 
@@ -323,15 +2222,22 @@ class recvSocket(object):
         """
         command.get(self, self.recv_queue)
 
-    def init_thread(self, num):
-        """Initiate the socket threads for receiving message.
+    def new_thread(self):
+        return _recvThread(self.recv_sock, self.main_queue, self)
+
+    @staticmethod
+    def mark_files(recv_dict, filenames):
+        """Mark the files into a transmission status before they are created. Otherwise a
+        scanning of a new directory may find the files before fileSocket.fileSocket counts their
+        blocks, and send them back as local files.
 
         Args:
-            num: A integer of the number of initiated threads.
+            recv_dict: A instance of fileState.stateTable of the received files.
+            filenames: A list of strings of the relative paths of the files.
         """
-        for i in range(num):
-            self.thread_list.append(_recvThread(self.recv_sock, self.main_queue))
-            self.thread_list[-1].start()
+        for filename in filenames:
+            # The block number 0 is replaced by fileSocket.fileSocket.recv_send().
+            recv_dict.setdefault(filename, 0)
 
 
 class fileSocket(object):
@@ -344,16 +2250,57 @@ class fileSocket(object):
         recv_queue: A queue to transmit message to fileSocket.recvSocket.
         ip: A string of the IPv4 host of the target socket.
         port: A integer of the port shared by local and other socket.
+        peer_port: None or a integer of the port of other socket if it is different from port,
+        e.g. for two sockets on one host.
+        sock_num: A integer of the initial number of sending threads after connection.
+        min_sock_num: A integer of the minimum number of sending threads.
+        max_sock_num: A integer of the maximum number of sending threads, which are adapted to
+        the measured goodput if it is larger than min_sock_num.
+        bundle_threshold: A integer of the maximum size of the files sent in bundles.
+        features: A set of strings of the enabled _protocol.features.
+        peer_features: A set of strings of the _protocol.features negotiated with another socket.
+        deferred_files: None or a set of the lists of the added and updated files scanned before
+        the features are negotiated, which are sent after the first CONT command of another
+        socket, so that they are sent in bundles, by their delta and journaled if supported.
         recv_addr: A address-like set of the local ip and port.
         send_addr: A address-like set of the other ip and port.
-        recv_dict: A inter-process dictionary of relative filepath (keys) and file_info (values) to
-        determine whether the files are from other devices.
+        engine: A string of the engine to send and receive messages, which is 'thread' for the
+        sendSocket and recvSocket processes or 'async' for fileAsync.asyncEngine.
+        recv_dict: A instance of fileState.stateTable of relative filepath (keys) and the remaining
+        block number or file_info (values) in shared memory to determine whether the files are
+        from other devices.
+        journal: A instance of fileLoader.transferJournal of the files in transmission.
         my_send_socket: A instance of fileSocket.sendSocket.
         my_recv_socket: A instance of fileSocket.recvSocket.
+        my_engine: A instance of fileAsync.asyncEngine instead of my_send_socket and
+        my_recv_socket with the asyncio engine.
         my_file_scanner: A instance of fileScanner.fileScanner.
         send_subproc: A process of my_send_socket.
         recv_subproc: A process of my_recv_socket.
-        scan_subproc: A process of my_file_scanner.
+        scan_subproc: A process of my_file_scanner, or a thread with the asyncio engine.
+        metrics_port: None or a integer of the local port of the HTTP stats endpoint.
+        metrics_interval: None or a integer of the interval time (second) between the logged
+        lines of the metrics.
+        policy: A string of the policy in fileScheduler.POLICIES to schedule the sent blocks.
+        rules: None or a list of sets of the fnmatch pattern of the relative path and the
+        priority of the files, where the files with a higher priority are sent first.
+        profile: A bool of whether the commands are profiled by command.enable_profile().
+        profile_stacks: A bool of whether the stacks of the threads are sampled when profiled.
+        share_folder: A string of the relative path of the shared folder.
+        peer_sock_num: None or a integer of the number of sending threads of another socket.
+        swarm_peers: A list of the addresses of the swarm peers to pull the missing files from.
+        swarm: None or a instance of fileSwarm.swarmTable if the swarm peers are given. Only the
+        given swarm peers are announced the files and served the blocks.
+        relay_peers: A list of the addresses of the peers to which the received blocks are
+        forwarded, so that the receivers form a chain or tree and the source sends a file once.
+        merkle: A instance of fileMerkle.merkleTree of the shared folder refreshed before every
+        CONT command, which is compared with the tree of another socket.
+        reconciled: None or a set of the local and another root hashes of the last comparison,
+        so that the trees are compared once if both sockets send CONT command at startup.
+        merkle_prefixes: A dictionary of the prefixes of the nodes requested by MRKQ command
+        which are not replied yet (keys) and the time when the comparison is started (values).
+        restored_files: A set of relative filepath of the unfinished files in the journal at
+        startup, which are requested once another socket is connected.
     """
     init_sock_num = 1
 
@@ -361,17 +2308,74 @@ class fileSocket(object):
     send_queue = multiprocessing.Queue()
     recv_queue = multiprocessing.Queue()
 
-    def __init__(self, ip, port, sock_num=1, share_folder='./share'):
+    def __init__(self, ip, port, sock_num=1, share_folder='./share', features=None,
+                 min_sock_num=None, max_sock_num=None,
+                 bundle_threshold=fileLoader.BUNDLE_THRESHOLD, engine='thread', peer_port=None,
+                 metrics_port=None, metrics_interval=fileMetrics.LOG_INTERVAL,
+                 policy=fileScheduler.DEFAULT_POLICY, rules=None, profile=False,
+                 profile_stacks=False, swarm_peers=None, relay_peers=None):
         self.port = port
+        self.peer_port = peer_port
         self.sock_num = sock_num
+        self.min_sock_num = sock_num if min_sock_num is None else min_sock_num
+        self.max_sock_num = sock_num if max_sock_num is None else max_sock_num
+        self.bundle_threshold = bundle_threshold
+        self.features = set(_protocol.features if features is None else features)
+        self.peer_features = set()
+        self.deferred_files = (list(), list())
         self.recv_addr = ('', port)
-        self.send_addr = (ip, port)
-        self.recv_dict = multiprocessing.Manager().dict()
+        self.send_addr = (ip, port if peer_port is None else peer_port)
+        self.engine = engine
+        self.metrics_port = metrics_port
+        self.metrics_interval = metrics_interval
+        self.policy = policy
+        self.rules = rules
+        self.profile = profile
+        self.profile_stacks = profile_stacks
+        self.share_folder = share_folder
+        self.peer_sock_num = None
+        self.swarm_peers = list(swarm_peers or ())
+        self.swarm = fileSwarm.swarmTable() if self.swarm_peers else None
+        self.relay_peers = list(relay_peers or ())
+        self.merkle = fileMerkle.merkleTree()
+        self.reconciled = None
+        self.merkle_prefixes = dict()
+
+        if self.engine == 'async':
+            # The asyncio engine is imported on demand, as it is built on the classes here.
+            import fileAsync
+            # Only the features implemented by the engine are negotiated.
+            self.features &= set(fileAsync.asyncEngine.features)
+            # All the parts run in this process, so the messages are not pickled.
+            self.main_queue = queue.Queue()
+            self.send_queue = queue.Queue()
+        self.recv_dict = fileState.stateTable()
+
+        # The unfinished files in the journal are kept in transmission status, so that they are
+        # not sent as new files after a restart.
+        self.journal = fileLoader.transferJournal()
+        for filename in self.journal.entries:
+            self.recv_dict[filename] = self.journal.remaining(filename)
+        self.restored_files = set(self.journal.entries)
 
-        self.my_send_socket = sendSocket(self.send_addr, self.send_queue)
-        self.my_recv_socket = recvSocket(self.recv_addr, self.main_queue, self.recv_queue)
         self.my_file_scanner = fileScanner.fileScanner(share_folder, self.main_queue, self.recv_dict)
 
+        if self.engine == 'async':
+            self.my_engine = fileAsync.asyncEngine(self.send_addr, self.recv_addr, self.main_queue,
+                                                   self.send_queue, self.recv_dict,
+                                                   self.policy, self.rules, self.share_folder)
+            self.recv_queue = self.my_engine.recv_queue
+            # The scanner thread feeds the metrics of this process without reporting.
+            self.scan_subproc = threading.Thread(target=self.my_file_scanner.main_loop)
+            self.scan_subproc.daemon = True
+            return
+
+        self.my_send_socket = sendSocket(self.send_addr, self.main_queue, self.send_queue,
+                                         self.min_sock_num, self.max_sock_num, self.policy,
+                                         self.rules)
+        self.my_recv_socket = recvSocket(self.recv_addr, self.main_queue, self.recv_queue,
+                                         self.recv_dict, self.share_folder)
+
         self.send_subproc = multiprocessing.Process(target=self.my_send_socket.start)
         self.recv_subproc = multiprocessing.Process(target=self.my_recv_socket.start)
         self.scan_subproc = multiprocessing.Process(target=self.my_file_scanner.start)
@@ -384,10 +2388,18 @@ class fileSocket(object):
     def start(self):
         """Start function for file sharing.
         """
+        if self.profile:
+            command.enable_profile(self.profile_stacks)
+        self.start_metrics()
         self.scan_subproc.start()
-        self.recv_subproc.start()
-        self.send_subproc.start()
+        if self.engine == 'async':
+            self.my_engine.start()
+        else:
+            self.recv_subproc.start()
+            self.send_subproc.start()
         self.connect()
+        if self.swarm is not None:
+            self.start_swarm()
         while True:
             self.get_command()
 
@@ -396,28 +2408,114 @@ class fileSocket(object):
         """
         command.get(self, self.main_queue)
 
+    def start_metrics(self):
+        """Start the stats endpoint and the logged lines of the metrics, which are merged from
+        the metrics of all the processes.
+        """
+        fileMetrics.set_gauge_function('queue_depth', self.main_queue.qsize, queue='main')
+        fileMetrics.set_gauge_function('queue_depth', self.send_queue.qsize, queue='send')
+        if self.metrics_port is not None:
+            fileMetrics.serve(self.metrics_port)
+            logger.info("Metrics are served at http://127.0.0.1:%d/metrics", self.metrics_port)
+        if self.metrics_interval:
+            fileMetrics.start_logger(self.metrics_interval)
+
+    @staticmethod
+    def report_metrics(main_queue, source):
+        """Report the metrics of a subprocess to fileSocket.fileSocket periodically.
+
+        Args:
+            main_queue: A queue to transmit message to fileSocket.fileSocket.
+            source: A string of the name of the subprocess.
+        """
+        fileMetrics.start_reporter(functools.partial(command.put, fileSocket.recv_metrics,
+                                                     main_queue, source))
+
+    def recv_metrics(self, source, snapshot):
+        """Receive the metrics reported by a subprocess.
+
+        Args:
+            source: A string of the name of the subprocess.
+            snapshot: A dictionary returned by fileMetrics.metricsRegistry.snapshot().
+        """
+        fileMetrics.get_registry().update(source, snapshot)
+
     def connect(self):
         """Initiate the connection with other sockets.
         """
         self.init_thread(self.init_sock_num)
         self.send_cont(is_echo=False)
 
-    def init_thread(self, sock_num):
-        """Initiate the socket threads for sending and receiving message.
+    def init_thread(self, sock_num, peer_sock_num=None):
+        """Resize the socket threads for sending and receiving message.
 
         Args:
-            sock_num: A integer of the number of initiated threads.
+            sock_num: A integer of the number of sending threads.
+            peer_sock_num: None or a integer of the number of sending threads of another socket,
+            which is served by the receiving threads besides the initial ones.
         """
-        command.put(recvSocket.init_thread, self.recv_queue, sock_num)
+        if peer_sock_num is not None:
+            self.peer_sock_num = peer_sock_num
+        command.put(recvSocket.init_thread, self.recv_queue, self.get_recv_num())
         command.put(sendSocket.init_thread, self.send_queue, sock_num)
 
-    def send_cont(self, is_echo):
-        """Give command to sendSocket to send CONT command.
+    def get_recv_num(self):
+        """Get the number of receiving threads.
+
+        Returns:
+            A integer of the initial threads, the threads for the sending threads of another
+            socket and fileSwarm.SWARM_RECV_NUM threads for each swarm peer.
+        """
+        recv_num = self.init_sock_num
+        if self.peer_sock_num is not None:
+            recv_num += self.peer_sock_num
+        if self.swarm is not None:
+            recv_num += len(self.swarm.peers) * fileSwarm.SWARM_RECV_NUM
+        return recv_num
+
+    def send_cont(self, is_echo, peer_root=None):
+        """Give command to sendSocket to send CONT command with the root hash of the shared
+        folder. The Merkle tree is refreshed first by a thread, as the files may be changed while
+        another socket is down, so that the walking of a large shared folder does not block the
+        main queue.
 
         Args:
             is_echo: A bool of whether this command is an echo (send after receiving CONT).
+            peer_root: None or a string of the root hash of another socket, which is compared
+            with the refreshed tree.
+        """
+        if 'merkle' not in self.features:
+            command.put(sendSocket.send_cont, self.send_queue, self.sock_num, is_echo,
+                        self.features, '')
+            return
+
+        def run():
+            with fileMetrics.timer('merkle_build_seconds'):
+                root = self.merkle.refresh(self.share_folder, self.recv_dict, self.journal)
+            command.put(sendSocket.send_cont, self.send_queue, self.sock_num, is_echo,
+                        self.features, root)
+            if peer_root is not None:
+                command.put(fileSocket.reconcile, self.main_queue, peer_root)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def reconcile(self, peer_root):
+        """Compare the Merkle trees of the shared folders if the root hashes are different. Both
+        sockets descend into the differing nodes and send the files missing or older in another
+        socket, so the files changed while either socket is down are sent.
+
+        Args:
+            peer_root: A string of the root hash of another socket.
         """
-        command.put(sendSocket.send_cont, self.send_queue, self.sock_num, is_echo)
+        if 'merkle' not in self.peer_features:
+            return
+        with self.merkle.lock:
+            root = self.merkle.root
+        if root != peer_root and (root, peer_root) != self.reconciled:
+            self.reconciled = (root, peer_root)
+            self.send_mrkq([''], time.time())
 
     def send_file(self, filename):
         """Give command to sendSocket to send a file.
@@ -427,43 +2525,705 @@ class fileSocket(object):
         """
         command.put(sendSocket.send_file, self.send_queue, filename)
 
-    def recv_cont(self, sock_num, is_echo):
-        """Receive CONT command from another socket. Initiate threads and echo CONT command if
-        the received CONT is not echo.
+    def send_files(self, added, updated, is_deferred=False):
+        """Give command to sendSocket to send the added and updated files of a scanning. The
+        small files are sent in bundles if supported, which saves the overhead of each file.
+
+        Args:
+            added: A list of strings of the relative paths of the added files.
+            updated: A list of strings of the relative paths of the updated files.
+            is_deferred: A bool of whether the files are deferred until the features are
+            negotiated, which are announced already.
+        """
+        # The swarm peers pull the files, except the target which is sent the files.
+        if not is_deferred:
+            self.announce(added + updated, exclude=self.send_addr)
+        if self.deferred_files is not None:
+            self.deferred_files[0].extend(added)
+            self.deferred_files[1].extend(updated)
+            return
+
+        if 'bundle' in self.peer_features:
+            small = set()
+            for filename in added + updated:
+                try:
+                    if os.path.getsize(filename) <= self.bundle_threshold:
+                        small.add(filename)
+                except OSError:
+                    # The file is removed meanwhile.
+                    continue
+            for filenames in fileLoader.split_bundles(sorted(small)):
+                command.put(sendSocket.send_bundle, self.send_queue, filenames)
+            added = [filename for filename in added if filename not in small]
+            updated = [filename for filename in updated if filename not in small]
+
+        for filename in added:
+            self.send_file(filename)
+        for filename in updated:
+            self.send_update(filename)
+
+    def start_swarm(self):
+        """Announce all the held files to the swarm peers, which send back their files, and
+        check the lost requests periodically.
+        """
+        for addr in self.swarm_peers:
+            self.swarm.add_peer(addr)
+        command.put(recvSocket.init_thread, self.recv_queue, self.get_recv_num())
+        filenames = fileSwarm.list_files(self.share_folder)
+        for addr in self.swarm_peers:
+            self.send_have(addr, filenames, is_echo=False)
+
+        def run():
+            while True:
+                time.sleep(fileSwarm.SWARM_CHECK_INTERVAL)
+                command.put(fileSocket.check_swarm, self.main_queue)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def send_have(self, addr, filenames, is_echo=True, is_update=False):
+        """Give command to sendSocket to announce files to a swarm peer.
+
+        Args:
+            addr: A address-like set of the ip and port of the swarm peer.
+            filenames: A list of strings of the relative paths of the files.
+            is_echo: A bool of whether this command is an echo (send after receiving HAVE).
+            is_update: A bool of whether the files are finished or changed just now.
+        """
+        manifest = fileSwarm.get_manifest(filenames, self.recv_dict, self.share_folder)
+        command.put(sendSocket.send_have, self.send_queue, addr, json.dumps(manifest), self.port,
+                    is_echo, is_update)
+
+    def announce(self, filenames, exclude=None):
+        """Announce the finished or changed files to the swarm peers, which pull the missing
+        ones and replace their received copies.
+
+        Args:
+            filenames: A list of strings of the relative paths of the files.
+            exclude: None or a address-like set of the peer not to announce to.
+        """
+        if self.swarm is None or not filenames:
+            return
+        for addr in self.swarm.peers:
+            if addr != exclude:
+                self.send_have(addr, filenames, is_update=True)
+
+    def pull_file(self, filename, file_size, file_hash, is_update=False):
+        """Start to pull a file from the swarm peers if it is missing locally or its pulling is
+        interrupted. A new version announced by a peer replaces the one being pulled and the
+        received copy which is not changed locally, while the local files are never replaced, so
+        that the versions do not bounce between the peers.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the size of the file.
+            file_hash: A string of the md5 of the file.
+            is_update: A bool of whether the version is finished or changed just now.
+        """
+        if not fileLoader.is_shared(filename, self.share_folder):
+            return
+        download = self.swarm.downloads.get(filename)
+        status = self.recv_dict.get(filename)
+        if download is not None:
+            if download.file_hash == file_hash or not is_update:
+                return
+            self.swarm.finish(filename)
+        elif filename in self.journal:
+            # Only the same version is resumed.
+            if self.journal.entries[filename][1] != file_hash:
+                return
+        elif isinstance(status, int):
+            return
+        elif os.path.exists(filename):
+            if not is_update or status is None or status == file_hash or \
+                    fileLoader.get_file_info(filename) != status:
+                return
+        self.start_pull(filename, file_size, file_hash)
+
+    def start_pull(self, filename, file_size, file_hash, attempt=0):
+        """Pull a version of a file from the swarm peers.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the size of the file.
+            file_hash: A string of the md5 of the file.
+            attempt: A integer of the number of previous pulls of the version.
+        """
+        block_num = math.ceil(file_size / fileLoader.TEMP_FILE_SIZE)
+        if block_num == 0:
+            self.recv_dict[filename] = file_hash
+            fileLoader.fileWriter(filename, 0).close()
+            return
+        # The file is journaled, so that the blocks from different peers are counted once.
+        self.journal.start(filename, file_size, file_hash, block_num)
+        self.recv_dict[filename] = self.journal.remaining(filename)
+        bitmap = int.from_bytes(self.journal.bitmap(filename), 'little')
+        self.swarm.start(filename, file_size, file_hash,
+                         [i for i in range(block_num) if not bitmap >> i & 1], attempt)
+
+    def request_blocks(self):
+        """Give command to sendSocket to request the blocks scheduled by the swarm table.
+        """
+        for addr, filename, file_hash, block_index in self.swarm.schedule(time.time()):
+            command.put(sendSocket.send_getb, self.send_queue, addr, filename, file_hash,
+                        block_index, self.port)
+
+    def recv_have(self, addr, manifest, is_echo, is_update=False):
+        """Receive HAVE command from a swarm peer. Send back the held files if the received
+        HAVE is not echo, and pull the missing files. The HAVE commands from other hosts are
+        ignored, so that the files are announced to the given swarm peers only.
+
+        Args:
+            addr: A address-like set of the ip and port of the peer.
+            manifest: A list of [filename, size, md5] of the files held by the peer.
+            is_echo: A bool of whether this command is an echo (send after receiving HAVE).
+            is_update: A bool of whether the files are finished or changed just now.
+        """
+        if not self.is_swarm_peer(addr):
+            return
+        if not is_echo:
+            self.send_have(addr, fileSwarm.list_files(self.share_folder))
+        if self.swarm.add_peer(addr):
+            command.put(recvSocket.init_thread, self.recv_queue, self.get_recv_num())
+        for filename, file_size, file_hash in manifest:
+            self.swarm.add_source(addr, filename, file_hash)
+            if file_hash is not None:
+                self.pull_file(filename, file_size, file_hash, is_update)
+        self.request_blocks()
+
+    def recv_getb(self, addr, filename, file_hash, block_index):
+        """Receive GETB command from a swarm peer. Send the block if the version of the file is
+        held, or announce the held version otherwise. The GETB commands from other hosts are
+        ignored.
+
+        Args:
+            addr: A address-like set of the ip and port of the peer.
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the requested version of the file.
+            block_index: A integer of the index of the block.
+        """
+        if not self.is_swarm_peer(addr):
+            return
+        if not isinstance(self.recv_dict.get(filename), int) and \
+                fileLoader.is_shared(filename, self.share_folder) and os.path.isfile(filename) and \
+                fileLoader.get_file_info(filename) == file_hash:
+            command.put(sendSocket.send_part, self.send_queue, addr, filename, block_index,
+                        file_hash)
+        else:
+            self.send_have(addr, [filename])
+
+    def is_swarm_peer(self, addr):
+        """Decide whether a host is a given swarm peer.
+
+        Args:
+            addr: A address-like set of the ip and port of the host.
+
+        Returns:
+            A bool of whether the host is a given swarm peer.
+        """
+        if self.swarm is None or addr not in self.swarm_peers:
+            logger.warning("Ignore the swarm command from %s:%d, which is not a swarm peer", *addr)
+            return False
+        return True
+
+    def drop_peer(self, addr):
+        """Remove a unreachable swarm peer, whose blocks are requested from other peers.
+
+        Args:
+            addr: A address-like set of the ip and port of the peer.
+        """
+        if self.swarm is None or addr not in self.swarm.peers:
+            return
+        logger.info("Swarm peer %s:%d is unreachable", *addr)
+        self.swarm.drop_peer(addr)
+        command.put(recvSocket.init_thread, self.recv_queue, self.get_recv_num())
+        self.request_blocks()
+
+    def check_swarm(self):
+        """Request the blocks again whose requests are lost in the timeout, and announce the
+        files again to the given swarm peers which are unreachable before.
+        """
+        self.swarm.expire(time.time())
+        self.request_blocks()
+        lost = [addr for addr in self.swarm_peers if addr not in self.swarm.peers]
+        if lost:
+            filenames = fileSwarm.list_files(self.share_folder)
+            for addr in lost:
+                self.send_have(addr, filenames, is_echo=False)
+
+    def send_update(self, filename):
+        """Give command to sendSocket to send an updated file by its delta if supported.
+
+        Args:
+            filename: A string of the relative path of the file.
+        """
+        try:
+            file_size = os.path.getsize(filename)
+        except OSError:
+            # The file is removed meanwhile.
+            return
+        if 'delta' in self.peer_features and file_size >= fileLoader.DELTA_MIN_SIZE:
+            command.put(sendSocket.send_sigr, self.send_queue, filename)
+        else:
+            self.send_file(filename)
+
+    def recv_cont(self, sock_num, is_echo, features='', root=''):
+        """Receive CONT command from another socket. Initiate threads, negotiate the features and
+        echo CONT command if the received CONT is not echo. Compare the Merkle trees of the
+        shared folders if the root hashes are different.
 
         Args:
             sock_num: A integer of requested number of sockets.
             is_echo: A bool of whether this command is an echo (send after receiving CONT).
+            features: A string of comma-separated _protocol.features supported by another socket,
+            which is empty for the baseline sockets without FEAT command.
+            root: A string of the root hash of the Merkle tree of another socket.
         """
-        # TODO(Zirui): The reconnection will cause duplicate initiation of socket threads.
-        self.init_thread(sock_num)
+        # The threads are resized, so that a reconnection does not initiate duplicate threads.
+        self.init_thread(self.sock_num, sock_num)
+        # Only the features supported by both sides are used, so that the sockets without
+        # optional features keep working.
+        self.peer_features = self.features & set(filter(None, features.split(',')))
+        command.put(sendSocket.set_features, self.send_queue, self.peer_features)
+        # The files scanned before are sent by the negotiated features, before the comparison
+        # of the trees, so that sendSocket does not send them again by it.
+        if self.deferred_files is not None:
+            added, updated = self.deferred_files
+            self.deferred_files = None
+            added = list(dict.fromkeys(added))
+            updated = [filename for filename in dict.fromkeys(updated) if filename not in added]
+            self.send_files(added, updated, is_deferred=True)
+        # The tree is compared after it is refreshed for the echo, or it is refreshed just
+        # before the CONT command echoed by another socket.
         if not is_echo:
-            self.send_cont(is_echo=True)
+            self.send_cont(is_echo=True, peer_root=root)
+        else:
+            self.reconcile(root)
+
+        # Request the unfinished blocks in the journal after a restart of either socket. Another
+        # socket is restarted if its CONT is not echo, while only the files journaled before
+        # this socket is started are requested by the echo, as the files journaled since then
+        # are requested by their OFFR command or still being sent.
+        if 'resume' in self.peer_features:
+            filenames = self.journal.entries if not is_echo else \
+                [filename for filename in self.restored_files if filename in self.journal]
+            for filename in list(filenames):
+                file_size, file_hash, _, _ = self.journal.entries[filename]
+                command.put(sendSocket.send_rsum, self.send_queue, filename, file_size, file_hash,
+                            self.journal.bitmap(filename))
+            self.restored_files = set()
+
+    def recv_bndl(self, manifest):
+        """Receive BNDL command from another socket. Mark the files into a transmission status.
+
+        Args:
+            manifest: A list of [filename, size, md5] of the files in the bundle, where md5 is
+            None if the files are not journaled.
+        """
+        # Mark all the files at once before they are created by the receiving thread, so that
+        # they are not regarded as local files by the scanner.
+        self.recv_dict.update({filename: 1 for filename, _, _ in manifest})
+        for filename, file_size, file_hash in manifest:
+            self.recv_send(filename, 1, file_size, file_hash)
+
+    def recv_bndl_vrfy(self, manifest):
+        """Receive VRFY command of a bundle from another socket. Finish all the files in the
+        bundle.
+
+        Args:
+            manifest: A list of [filename, size, md5] of the files in the bundle.
+        """
+        finished = [filename for filename, file_size, file_hash in manifest
+                    if self.verify(filename, None if file_hash is None else 0)]
+        self.announce(finished)
 
-    def recv_send(self, filename, block_num):
+    def recv_pool(self, sock_num):
+        """Receive POOL command from another socket. Resize the receiving threads.
+
+        Args:
+            sock_num: A integer of the number of sending threads of another socket.
+        """
+        self.peer_sock_num = sock_num
+        command.put(recvSocket.init_thread, self.recv_queue, self.get_recv_num())
+
+    def recv_send(self, filename, block_num, file_size, file_hash=None):
         """Receive SEND command from another socket. Mark the file into a transmission status.
 
         Args:
             filename: A string of the relative path of the file.
             block_num: A integer of the number of split blocks.
+            file_size: A integer of the size of the file.
+            file_hash: None or a string of the md5 of the file to journal the blocks.
         """
-        if filename not in self.recv_dict.keys():
+        # A finished version is not journaled again if it is received again, e.g. from another
+        # relay peer in a tree.
+        if file_hash is not None and self.recv_dict.get(filename) == file_hash:
+            return
+        if self.swarm is not None:
+            # A block of a finished or replaced pull may arrive late.
+            if self.swarm.is_replaced(filename, file_hash):
+                return
+            # Another version pushed by another socket replaces the pulled one.
+            self.swarm.cancel(filename, file_hash)
+        if file_hash is not None:
+            self.journal.start(filename, file_size, file_hash, block_num)
+            self.recv_dict[filename] = self.journal.remaining(filename)
+            # The file is added to the tree by its expected size and md5 as it is refreshed, so
+            # that another socket does not send it again by the comparison meanwhile.
+            entry = [file_size, file_hash, None, None]
+            with self.merkle.lock:
+                if self.merkle.files.get(filename) != entry:
+                    self.merkle.update({filename: entry})
+            return
+
+        self.journal.finish(filename)
+        # A finished file (with md5) is received again if it is updated by another socket, and a
+        # file marked by recvSocket.mark_files() is not counted yet.
+        status = self.recv_dict.get(filename)
+        if not isinstance(status, int) or status == 0:
             self.recv_dict[filename] = block_num
 
-    def recv_vrfy(self, filename):
+    def recv_vrfy(self, filename, block_index=None, file_hash=None):
         """Receive VRFY command from another socket. Update the received block number.
 
         Args:
             filename: A string of the relative path of the file.
+            block_index: None or a integer of the index of the journaled block.
+            file_hash: None or a string of the md5 of the journaled block.
+        """
+        if self.verify(filename, block_index, file_hash):
+            self.announce([filename])
+
+    def verify(self, filename, block_index=None, file_hash=None):
+        """Count a received block and finish the file after all the blocks are received.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_index: None or a integer of the index of the journaled block.
+            file_hash: None or a string of the md5 of the journaled block.
+
+        Returns:
+            A bool of whether the file is finished.
+        """
+        is_journaled = block_index is not None and filename in self.journal
+        if is_journaled:
+            # A block of another version is not counted, e.g. it is sent before the file is
+            # changed.
+            _, journal_hash, block_num, _ = self.journal.entries[filename]
+            if file_hash is not None and journal_hash != file_hash:
+                return False
+            # A block is counted only once even if it is sent again after a restart, and it is
+            # forwarded once it is verified, while the other blocks are still received.
+            if self.journal.complete(filename, block_index):
+                self.relay(filename, journal_hash, block_num, [block_index])
+            remaining = self.journal.remaining(filename)
+            self.recv_dict[filename] = remaining
+            if self.swarm is not None:
+                self.swarm.complete(filename, block_index)
+        else:
+            remaining = self.recv_dict.complete(filename)
+            # A block is sent again after the file is finished.
+            if remaining is None:
+                return False
+
+        if remaining != 0:
+            if self.swarm is not None:
+                self.request_blocks()
+            return False
+        # The md5 of the whole file closes the transmission, as a block may be corrupted with the
+        # same CRC32. A pulled file is checked by finish_pull().
+        file_info = fileLoader.get_file_info(filename)
+        if is_journaled and file_info != journal_hash and \
+                (self.swarm is None or filename not in self.swarm.downloads):
+            self.retry_file(filename, file_info)
+            return False
+        self.journal.finish(filename)
+        self.journal.receive(filename, file_info)
+        self.recv_dict[filename] = file_info
+        fileLoader.get_hash_cache().flush()
+        # The tree is added the received file at once, as it may be replied to another socket
+        # before it is refreshed again, where the file would be missing and sent back.
+        stat = os.stat(filename)
+        with self.merkle.lock:
+            self.merkle.update({filename: [stat.st_size, file_info, file_info, stat.st_mtime_ns]})
+        if not is_journaled:
+            # A file without journal (e.g. a delta) is forwarded after it is finished.
+            block_num = max(math.ceil(os.path.getsize(filename) / fileLoader.TEMP_FILE_SIZE), 1)
+            self.relay(filename, self.recv_dict[filename], block_num, range(block_num))
+        if self.swarm is not None:
+            self.finish_pull(filename)
+        return True
+
+    def retry_blocks(self, blocks):
+        """Request the corrupt blocks again, whose CRC32 is different from that of the sent
+        ones. The blocks of the pulled files are requested from the swarm peers again.
+
+        Args:
+            blocks: A list of [filename, block_index, md5] of the blocks, where md5 is None if the
+            file is not journaled.
+        """
+        for filename, block_index, file_hash in blocks:
+            fileMetrics.inc('corrupt_blocks')
+            # The block of a finished or replaced version is not needed.
+            entry = self.journal.entries.get(filename)
+            if not isinstance(self.recv_dict.get(filename), int) or file_hash is not None and \
+                    (entry is None or entry[1] != file_hash):
+                continue
+            logger.warning("Block %d of %s is corrupt and requested again", block_index, filename)
+            if self.swarm is not None and self.swarm.retry(filename, file_hash, block_index):
+                continue
+            command.put(sendSocket.send_rtry, self.send_queue, filename, block_index, file_hash)
+        if self.swarm is not None:
+            self.request_blocks()
+
+    def retry_file(self, filename, file_info):
+        """Request the whole file again if its md5 is different from the expected one after all
+        the blocks are verified.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_info: A string of the md5 of the received file.
+        """
+        file_size, file_hash, block_num, _ = self.journal.entries[filename]
+        fileMetrics.inc('corrupt_files')
+        logger.warning("Received %s is corrupt: md5 %s instead of %s", filename, file_info,
+                       file_hash)
+        self.journal.finish(filename)
+        self.journal.start(filename, file_size, file_hash, block_num)
+        self.recv_dict[filename] = self.journal.remaining(filename)
+        command.put(sendSocket.send_rsum, self.send_queue, filename, file_size, file_hash,
+                    self.journal.bitmap(filename))
+
+    def relay(self, filename, file_hash, block_num, block_indexes):
+        """Give command to sendSocket to forward the received blocks to the relay peers.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the file.
+            block_num: A integer of the number of split blocks.
+            block_indexes: A iterable of the indexes of the blocks.
+        """
+        if self.relay_peers:
+            command.put(sendSocket.send_relay, self.send_queue, self.relay_peers, filename,
+                        file_hash, block_num, list(block_indexes))
+
+    def finish_pull(self, filename):
+        """Log the peers of a pulled file after it is finished.
+
+        Args:
+            filename: A string of the relative path of the file.
+        """
+        download = self.swarm.finish(filename)
+        if download is None:
+            return
+        if self.recv_dict[filename] != download.file_hash:
+            logger.warning("Pulled %s is changed meanwhile: md5 %s instead of %s", filename,
+                           self.recv_dict[filename], download.file_hash)
+            # The blocks of another version may be written over it, so it is pulled again.
+            if download.attempt < fileSwarm.SWARM_RETRY_NUM:
+                self.start_pull(filename, download.file_size, download.file_hash,
+                                download.attempt + 1)
+                self.request_blocks()
+                return
+        logger.info("Pulled %s from %d swarm peers: %s", filename, len(download.served),
+                    ', '.join('{}:{} {} blocks'.format(*addr, num)
+                              for addr, num in download.served.most_common()))
+        self.request_blocks()
+
+    def recv_offr(self, filename, file_size, file_hash, block_hashes):
+        """Receive OFFR command from another socket. Copy the blocks held by local files and
+        request the other blocks, so that the same content in other paths or renamed files are
+        not sent again.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the size of the file.
+            file_hash: A string of the md5 of the file.
+            block_hashes: A bytes of the concatenated sha1 of the blocks.
+        """
+        block_num = len(block_hashes) // fileLoader.BLOCK_HASH_SIZE
+        self.recv_send(filename, block_num, file_size, file_hash)
+        for block_index in fileLoader.copy_blocks(filename, file_size, block_hashes):
+            self.recv_vrfy(filename, block_index)
+
+        if filename in self.journal:
+            command.put(sendSocket.send_rsum, self.send_queue, filename, file_size, file_hash,
+                        self.journal.bitmap(filename))
+
+    def recv_rsum(self, filename, file_size, file_hash, bitmap):
+        """Receive RSUM command from another socket. Send the blocks which are not verified if
+        the file is not changed, or the whole file otherwise.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the expected size of the file.
+            file_hash: A string of the expected md5 of the file.
+            bitmap: A bytes of the bitmap of the verified blocks.
+        """
+        # The receiver drops the unfinished file, as it is not sent anymore.
+        if not os.path.isfile(filename):
+            command.put(sendSocket.send_gone, self.send_queue, filename, file_hash)
+            return
+        if os.path.getsize(filename) == file_size and \
+                fileLoader.get_file_info(filename) == file_hash:
+            command.put(sendSocket.send_file, self.send_queue, filename, bitmap)
+        else:
+            command.put(sendSocket.send_file, self.send_queue, filename)
+
+    def recv_gone(self, filename, file_hash):
+        """Receive GONE command from another socket. Drop the unfinished file requested by RSUM
+        command, so that it is neither kept in the journal nor ignored by the scanner for good.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the file requested by RSUM command.
+        """
+        entry = self.journal.entries.get(filename)
+        # Another version of the file may be received meanwhile.
+        if entry is None or entry[1] != file_hash:
+            return
+        # A file pulled from the swarm peers is still held by them.
+        if self.swarm is not None and filename in self.swarm.downloads:
+            return
+        logger.warning("Drop unfinished %s, which is not held by the sender anymore", filename)
+        self.journal.finish(filename)
+        self.recv_dict.pop(filename)
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def recv_rtry(self, filename, block_index, file_hash=None):
+        """Receive RTRY command from another socket. Send the corrupt block again if the file is
+        not changed. A changed file is sent again after the next scanning anyway.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_index: A integer of the index of the block.
+            file_hash: None or a string of the md5 of the journaled file.
+        """
+        if isinstance(self.recv_dict.get(filename), int) or not os.path.isfile(filename):
+            return
+        if file_hash is None or fileLoader.get_file_info(filename) == file_hash:
+            command.put(sendSocket.send_block, self.send_queue, filename, block_index, file_hash)
+
+    def recv_sigr(self, filename):
+        """Receive SIGR command from another socket. Send back the block signatures of the file.
+
+        Args:
+            filename: A string of the relative path of the file.
+        """
+        command.put(sendSocket.send_sigs, self.send_queue, filename)
+
+    def recv_sigs(self, filename, block_size, signatures):
+        """Receive SIGS command from another socket. Send the delta of the file.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_size: A integer of the block size of the signatures.
+            signatures: A bytes of the block signatures.
+        """
+        command.put(sendSocket.send_delta, self.send_queue, filename, block_size, signatures)
+
+    def is_received(self, filename):
+        """Decide whether a file is being received, whose tree node is outdated.
+
+        Args:
+            filename: A string of the relative path of the file.
+
+        Returns:
+            A bool of whether the file is journaled or in transmission.
+        """
+        return filename in self.journal or isinstance(self.recv_dict.get(filename), int)
+
+    def send_mrkq(self, prefixes, start_time):
+        """Give command to sendSocket to request the nodes of the Merkle tree of another socket.
+
+        Args:
+            prefixes: A list of the prefixes of the nodes.
+            start_time: A float of the time when the comparison is started.
+        """
+        fileMetrics.inc('merkle_nodes', len(prefixes), kind='requested')
+        self.merkle_prefixes.update(dict.fromkeys(prefixes, start_time))
+        command.put(sendSocket.send_mrkq, self.send_queue, json.dumps(prefixes))
+
+    def recv_mrkq(self, prefixes):
+        """Receive MRKQ command from another socket. Reply the requested nodes of the local
+        Merkle tree.
+
+        Args:
+            prefixes: A list of the prefixes of the nodes.
+        """
+        with self.merkle.lock:
+            nodes = [self.merkle.get_node(prefix) for prefix in prefixes]
+        command.put(sendSocket.send_mrkr, self.send_queue, json.dumps(nodes))
+
+    def recv_mrkr(self, nodes):
+        """Receive MRKR command from another socket. Descend into the differing children of the
+        nodes, and send the local files which are missing in another socket or newer than its
+        ones.
+
+        Args:
+            nodes: A list of [prefix, children, files] of the nodes of another socket.
         """
-        self.recv_dict[filename] -= 1
-        if self.recv_dict[filename] == 0:
-            self.recv_dict[filename] = fileLoader.get_file_info(filename)
+        # A late reply to the requests before a restart of either socket is dropped, as it
+        # is compared with a tree changed meanwhile.
+        nodes = [node for node in nodes if node[0] in self.merkle_prefixes]
+        if not nodes:
+            return
+        start_time = min(self.merkle_prefixes.pop(node[0]) for node in nodes)
+        prefixes = list()
+        added = list()
+        updated = list()
+        with self.merkle.lock:
+            for prefix, children, files in nodes:
+                result = self.merkle.compare(prefix, children, files)
+                prefixes.extend(result[0])
+                added.extend(result[1])
+                updated.extend(result[2])
+        if prefixes:
+            self.send_mrkq(prefixes, start_time)
+        # The tree of either socket may be refreshed before the files queued by the scanner are
+        # sent, so the files in transmission are not sent, and sendSocket drops the files which
+        # are queued or sent since the comparison is started.
+        added = [filename for filename in added if not self.is_received(filename)]
+        updated = [filename for filename in updated if not self.is_received(filename)]
+        if added or updated:
+            command.put(sendSocket.send_missing, self.send_queue, sorted(added), sorted(updated),
+                        start_time)
+
+
+class _timedCommand(tuple):
+    """A message of command which carries the time when it is put, in the profiling mode.
+
+    Attributes:
+        put_time: A float of time.monotonic() when the message is put, which is comparable
+        between the processes.
+    """
 
 
 class command(object):
     """A static class to put and get command from a queue.
+
+    Attributes:
+        profile: A bool of whether the time waited in the queue and the running time of the
+        commands are recorded by the function names into the command_wait_seconds and
+        command_run_seconds histograms of fileMetrics.
     """
+    profile = False
+
+    @classmethod
+    def enable_profile(cls, with_stacks=False):
+        """Enable the profiling mode of all the processes, which should be called before the
+        subprocesses are started. The profile is dumped on SIGUSR1 by fileProfiler.dump().
+
+        Args:
+            with_stacks: A bool of whether the stacks of the threads are sampled.
+        """
+        cls.profile = True
+        fileProfiler.enable(with_stacks)
+
     @classmethod
     def get(cls, self, queue, retry=None):
         """Get message from a given queue.
@@ -480,10 +3240,12 @@ class command(object):
             try:
                 cls.run(self, cmd)
             except retry as e:
+                fileMetrics.inc('command_retries', command=cmd[0].__name__)
+                logger.debug("Retry %s after %r", cmd[0].__name__, e)
                 queue.put(cmd)
 
-    @staticmethod
-    def put(func, queue, *args):
+    @classmethod
+    def put(cls, func, queue, *args):
         """Put Message into a given queue.
 
         Args:
@@ -491,17 +3253,43 @@ class command(object):
             queue: A queue to put message into.
             *args: Arguments for the given function.
         """
-        queue.put((func, *args), block=True)
+        if not cls.profile:
+            queue.put((func, *args), block=True)
+            return
+        fileProfiler.start_threads()
+        cmd = _timedCommand((func, *args))
+        cmd.put_time = time.monotonic()
+        queue.put(cmd, block=True)
 
-    @staticmethod
-    def run(self, cmd):
+    @classmethod
+    def run(cls, self, cmd):
         """Run the function in the message.
 
         Args:
             self: A instance of the class which the function is from.
             cmd: A set of values in the message.
         """
-        cmd[0](self, *cmd[1:])
+        if not cls.profile:
+            cls.call(self, cmd)
+            return
+        fileProfiler.start_threads()
+        name = cmd[0].__qualname__
+        start_time = time.monotonic()
+        if isinstance(cmd, _timedCommand):
+            fileMetrics.observe('command_wait_seconds', start_time - cmd.put_time, command=name)
+        try:
+            cls.call(self, cmd)
+        finally:
+            fileMetrics.observe('command_run_seconds', time.monotonic() - start_time,
+                                command=name)
+
+    @staticmethod
+    def call(self, cmd):
+        # The send commands of fileSocket._sendHandler return generators of actions, which are
+        # run by the engine.
+        result = cmd[0](self, *cmd[1:])
+        if inspect.isgenerator(result):
+            self.transmit(result)
 
 
 class _protocol(object):
@@ -510,18 +3298,52 @@ class _protocol(object):
 
     Attributes:
         code: A enum-like class of defined code types.
+        features: A tuple of strings of the optional features negotiated by CONT and FEAT
+        commands.
         max_param: The Maximum of the given arguments.
         order_mark: A string of indicator for byte order, size and alignment of the packed data
         byte_mark: A string of a placeholder for bytes in format part.
         string_mark: A string of a placeholder for string in format part.
         code_format: A string of the struct format for code.
         guide_format: A string of the struct format for guide package.
+        mux_guide_format: A string of the struct format for guide package with stream id in a
+        persistent link.
+        guide_struct: A precompiled struct.Struct of guide_format.
+        mux_guide_struct: A precompiled struct.Struct of mux_guide_format.
+        version: A integer of the version of the framing by pack_v2(), which is the first byte of
+        its packages and never the first byte of a v1 package (an ASCII code).
+        prefix_format: A string of the struct format for the version, code and the number of
+        arguments of a v2 package.
+        _structs: A protected dictionary of (version, type marks of the arguments) (keys) and the
+        precompiled struct.Struct (values) of the v1 formats and the v2 headers.
     """
     class code:
         CONT = 'CONT'
+        FEAT = 'FEAT'
         SEND = 'SEND'
+        BNDL = 'BNDL'
         PAKG = 'PAKG'
+        ZPKG = 'ZPKG'
         VRFY = 'VRFY'
+        BLCK = 'BLCK'
+        SIGR = 'SIGR'
+        SIGS = 'SIGS'
+        DLTA = 'DLTA'
+        COPY = 'COPY'
+        RSUM = 'RSUM'
+        GONE = 'GONE'
+        OFFR = 'OFFR'
+        LINK = 'LINK'
+        POOL = 'POOL'
+        HAVE = 'HAVE'
+        GETB = 'GETB'
+        MRKQ = 'MRKQ'
+        MRKR = 'MRKR'
+        RTRY = 'RTRY'
+        HOLE = 'HOLE'
+
+    features = ('bundle', 'bz2', 'crc', 'dedup', 'delta', 'lzma', 'merkle', 'mux', 'pool',
+                'resume', 'sendfile', 'sparse', 'v2', 'zlib')
 
     max_param = 8
     order_mark = '!'    # For network (= big-endian).
@@ -529,6 +3351,30 @@ class _protocol(object):
     string_mark = '$'
     code_format = order_mark + '4s'
     guide_format = order_mark + 'I'
+    mux_guide_format = order_mark + 'II'
+    guide_struct = struct.Struct(guide_format)
+    mux_guide_struct = struct.Struct(mux_guide_format)
+
+    version = 2
+    prefix_format = order_mark + 'B4sB'
+    _structs = dict()
+
+    @classmethod
+    def pack_buffers(cls, code, *args, version=1):
+        """Pack the given code and arguments into buffers by a version of the framing.
+
+        Args:
+            code: A _protocol.code of the package code.
+            *args: The arguments of the package.
+            version: A integer of the version of the framing, which is negotiated by the 'v2'
+            feature.
+
+        Returns:
+            A list of bytes-like objects of the package.
+        """
+        if version < cls.version:
+            return [cls.pack(code, *args)]
+        return cls.pack_v2(code, *args)
 
     @classmethod
     def pack(cls, code, *args):
@@ -549,26 +3395,29 @@ class _protocol(object):
         str_package = bytes()
         s_format = str()
 
-        # Pack the values by their types and the format is recorded.
+        # Pack the values by their types and the format is recorded. The bool is checked before
+        # the int as it is a subclass of int.
         for i in args:
-            if isinstance(i, int):
-                s_format += 'I'
-                num_package += struct.pack(cls.order_mark + 'I', i)
+            if isinstance(i, bool):
+                s_format += '?'
+                num_package += struct.pack(cls.order_mark + '?', i)
+            elif isinstance(i, int):
+                # The integers beyond 4 GiB (e.g. positions of large files) need 64 bits.
+                int_format = 'I' if i < 1 << 32 else 'Q'
+                s_format += int_format
+                num_package += struct.pack(cls.order_mark + int_format, i)
             elif isinstance(i, float):
                 s_format += 'd'
                 num_package += struct.pack(cls.order_mark + 'd', i)
-            elif isinstance(i, bool):
-                s_format += '?'
-                num_package += struct.pack(cls.order_mark + '?', i)
             # The length of string and bytes is recorded in the format.
             elif isinstance(i, str):
                 s_format += cls.string_mark
                 num_package += struct.pack(cls.order_mark + 'I', len(i))
                 str_package += struct.pack(cls.order_mark + str(len(i)) + 's', i.encode())
-            elif isinstance(i, bytes):
+            elif isinstance(i, (bytes, bytearray, memoryview)):
                 s_format += cls.byte_mark
                 num_package += struct.pack(cls.order_mark + 'I', len(i))
-                str_package += struct.pack(cls.order_mark + str(len(i)) + 's', i)
+                str_package += i
             else:
                 raise Exception("Pack Unknown Type: {} ({})".format(i, type(i)))
 
@@ -585,39 +3434,132 @@ class _protocol(object):
     def unpack(cls, package):
         """Unpack the given package bytes into code and arguments.
 
+        The bytes arguments are sliced from the package without copying, so they are memoryview
+        if the package is a memoryview.
+
         Args:
-            package: A bytes of formatted package.
+            package: A bytes-like object of formatted package.
 
         Returns:
             A set of unpacked code and arguments.
         """
+        # The package of the v2 framing is marked by its first byte.
+        if package[0] == cls.version:
+            return cls.unpack_v2(package)
+
         p_loader = cls._packageLoader(package)
         code = p_loader.unpack(cls.code_format)[0].decode()
         s_format = p_loader.unpack(cls.order_mark + str(cls.max_param) + 's')[0].decode()
 
-        # Transfer the custom format into a struct-recognized format and unpack the package by
-        # the transferred format.
-        temp_format = s_format.strip()
-        temp_format = temp_format.replace(cls.byte_mark, 'I')
-        temp_format = temp_format.replace(cls.string_mark, 'I')
-        args = list(p_loader.unpack(cls.order_mark + temp_format))
+        # Transfer the custom format into a struct-recognized format, which is compiled once,
+        # and unpack the package by the transferred format.
+        v1_struct = cls._structs.get((1, s_format))
+        if v1_struct is None:
+            temp_format = s_format.strip()
+            temp_format = temp_format.replace(cls.byte_mark, 'I')
+            temp_format = temp_format.replace(cls.string_mark, 'I')
+            v1_struct = struct.Struct(cls.order_mark + temp_format)
+            cls._structs[(1, s_format)] = v1_struct
+        args = list(p_loader.unpack(v1_struct))
 
         # Unpack string and bytes by placing the byte_mark and string_mark in the custom format.
         # The integer provides the length of string or bytes for unpacking.
         for index, item in enumerate(s_format):
             if item == cls.byte_mark:
-                args[index] = p_loader.unpack(cls.order_mark + str(args[index]) + 's')[0]
+                args[index] = p_loader.slice(args[index])
             if item == cls.string_mark:
-                args[index] = p_loader.unpack(cls.order_mark + str(args[index]) + 's')[0].decode()
+                args[index] = bytes(p_loader.slice(args[index])).decode()
 
         # The code without brackets can run in Pycharm (Python 3.8), but not in virtual environment.
         return (code, *args)
 
+    @classmethod
+    def pack_v2(cls, code, *args):
+        """Pack the given code and arguments by the v2 framing.
+
+        The header of the version, code, type marks, numbers and lengths of string and bytes is
+        packed by one precompiled struct.Struct of the type marks, which are the same for the
+        messages of a type. The string and bytes follow the header as separate buffers without
+        copying, so that they are sent together by one sendmsg. The integers are 64-bit.
+
+        Args:
+            code: A _protocol.code of the package code.
+            *args: The arguments of the package.
+
+        Returns:
+            A list of bytes-like objects of the header and the string and bytes arguments.
+
+        Raises:
+            Exception: A custom exception to pack incompatible values.
+        """
+        marks = str()
+        values = list()
+        buffers = [None]
+        for i in args:
+            if isinstance(i, bool):
+                marks += '?'
+                values.append(i)
+            elif isinstance(i, int):
+                marks += 'Q'
+                values.append(i)
+            elif isinstance(i, float):
+                marks += 'd'
+                values.append(i)
+            elif isinstance(i, str):
+                marks += cls.string_mark
+                buffers.append(i.encode())
+                values.append(len(buffers[-1]))
+            elif isinstance(i, (bytes, bytearray, memoryview)):
+                marks += cls.byte_mark
+                buffers.append(i)
+                values.append(len(i))
+            else:
+                raise Exception("Pack Unknown Type: {} ({})".format(i, type(i)))
+
+        buffers[0] = cls._get_struct(marks).pack(cls.version, code.encode(), len(marks),
+                                                 marks.encode(), *values)
+        return buffers
+
+    @classmethod
+    def unpack_v2(cls, package):
+        """Unpack the given package bytes of the v2 framing into code and arguments. The bytes
+        arguments are sliced from the package without copying.
+
+        Args:
+            package: A bytes-like object of formatted package.
+
+        Returns:
+            A set of unpacked code and arguments.
+        """
+        # The number of arguments is the last byte of the prefix, followed by the type marks.
+        start = struct.calcsize(cls.prefix_format)
+        marks = bytes(package[start: start + package[start - 1]]).decode()
+        header = cls._get_struct(marks)
+        _, code, _, _, *args = header.unpack_from(package)
+
+        pt = header.size
+        for index, item in enumerate(marks):
+            if item == cls.byte_mark:
+                args[index], pt = package[pt: pt + args[index]], pt + args[index]
+            elif item == cls.string_mark:
+                args[index], pt = bytes(package[pt: pt + args[index]]).decode(), pt + args[index]
+        return (code.decode(), *args)
+
+    @classmethod
+    def _get_struct(cls, marks):
+        # Compile the header of the type marks at the first use.
+        header = cls._structs.get((cls.version, marks))
+        if header is None:
+            temp_format = marks.replace(cls.byte_mark, 'I').replace(cls.string_mark, 'I')
+            header = struct.Struct(cls.prefix_format + str(len(marks)) + 's' + temp_format)
+            cls._structs[(cls.version, marks)] = header
+        return header
+
     class _packageLoader(object):
         """A protected auxiliary class to unpack package.
 
         Attributes:
-            package: A bytes of formatted package.
+            package: A bytes-like object of formatted package.
             pt: A integer of pointer of unpack position.
         """
         package = bytes()
@@ -630,16 +3572,32 @@ class _protocol(object):
             """Unpack the package by the given format from the position of pt.
 
             Args:
-                fmt: A string of struct format to unpack.
+                fmt: A string of struct format or a precompiled struct.Struct to unpack.
 
             Returns:
                 A set of unpacked values.
             """
-            fmt_len = struct.calcsize(fmt)
-            args = struct.unpack(fmt, self.package[self.pt: self.pt + fmt_len])
-            self.pt += fmt_len
+            if isinstance(fmt, str):
+                args = struct.unpack_from(fmt, self.package, self.pt)
+                self.pt += struct.calcsize(fmt)
+                return args
+            args = fmt.unpack_from(self.package, self.pt)
+            self.pt += fmt.size
             return args
 
+        def slice(self, size):
+            """Slice the package by the given size from the position of pt without copying.
+
+            Args:
+                size: A integer of the size to slice.
+
+            Returns:
+                A bytes-like object of the same type as the package.
+            """
+            data = self.package[self.pt: self.pt + size]
+            self.pt += size
+            return data
+
 
 # Another implementation for packing code and arguments into a transferable binary.
 
@@ -0,0 +1,226 @@
+# -*- coding: UTF-8 -*-
+"""
+The shared-memory table of the file states shared by the processes.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import struct
+from multiprocessing import shared_memory
+
+STATE_SLOT_NUM = 256 * 1024
+STATE_PROBE_NUM = 64
+
+
+class stateTable(object):
+    """A table of the transmission status of the received files in shared memory, which the
+    scanner and socket processes read and write directly instead of a dictionary served by a
+    manager process.
+
+    A file is kept in a fixed-size slot found by the hash of its relative path with linear
+    probing. A slot holds the 16-byte blake2b of the path, the status, and the remaining block
+    number of a file in transmission or the md5 of a finished file. If all the probed slots are
+    taken, a finished file is evicted, which is only sent back once as a local file.
+
+    The table is created by the main process and inherited by the forked processes. The name of
+    the shared memory is unlinked at once, so that the memory is released with the processes
+    even if they are killed.
+
+    Attributes:
+        slot_num: A integer of the number of slots.
+        shm: A instance of multiprocessing.shared_memory.SharedMemory of the slots.
+        lock: A lock of multiprocessing to access the slots exclusively.
+    """
+    slot_struct = struct.Struct('=16sB7xq16s')
+    EMPTY, COUNTING, FINISHED, DELETED = range(4)
+
+    def __init__(self, slot_num=STATE_SLOT_NUM):
+        self.slot_num = slot_num
+        self.shm = shared_memory.SharedMemory(create=True, size=slot_num * self.slot_struct.size)
+        self.shm.unlink()
+        self.lock = multiprocessing.Lock()
+
+    def close(self):
+        """Release the shared memory of this process.
+        """
+        self.shm.close()
+
+    @staticmethod
+    def _get_key(filename):
+        return hashlib.blake2b(os.fsencode(filename), digest_size=16).digest()
+
+    def _read(self, index):
+        return self.slot_struct.unpack_from(self.shm.buf, index * self.slot_struct.size)
+
+    def _write(self, index, key, value):
+        if isinstance(value, int):
+            slot = (key, self.COUNTING, value, bytes(16))
+        else:
+            slot = (key, self.FINISHED, 0, bytes.fromhex(value))
+        self.slot_struct.pack_into(self.shm.buf, index * self.slot_struct.size, *slot)
+
+    def _delete(self, index):
+        # The slot is kept as a tombstone to continue the probing of other keys.
+        self.slot_struct.pack_into(self.shm.buf, index * self.slot_struct.size, bytes(16),
+                                   self.DELETED, 0, bytes(16))
+
+    def _get_value(self, slot):
+        if slot[1] == self.COUNTING:
+            return slot[2]
+        return slot[3].hex()
+
+    def _find(self, key):
+        """Find the slot of a key by linear probing. The lock should be held.
+
+        Args:
+            key: A bytes of the hash of the relative path of the file.
+
+        Returns:
+            None or a integer of the index of the slot of the key.
+            None or a integer of the index of the slot to insert the key.
+        """
+        free = None
+        evicted = None
+        start = int.from_bytes(key[:8], 'little') % self.slot_num
+        for i in range(min(STATE_PROBE_NUM, self.slot_num)):
+            index = (start + i) % self.slot_num
+            slot_key, status, _, _ = self._read(index)
+            if status == self.EMPTY:
+                return None, index if free is None else free
+            if status == self.DELETED:
+                free = index if free is None else free
+            elif slot_key == key:
+                return index, index
+            elif status == self.FINISHED and evicted is None:
+                evicted = index
+        return None, evicted if free is None else free
+
+    def get(self, filename, default=None):
+        """Get the status of a file.
+
+        Args:
+            filename: A string of the relative path of the file.
+            default: The value returned if the file is not in the table.
+
+        Returns:
+            A integer of the remaining block number of a file in transmission, a string of the
+            md5 of a finished file, or default.
+        """
+        with self.lock:
+            index, _ = self._find(self._get_key(filename))
+            if index is None:
+                return default
+            return self._get_value(self._read(index))
+
+    def __getitem__(self, filename):
+        value = self.get(filename)
+        if value is None:
+            raise KeyError(filename)
+        return value
+
+    def __contains__(self, filename):
+        return self.get(filename) is not None
+
+    def __setitem__(self, filename, value):
+        """Set the status of a file.
+
+        Args:
+            filename: A string of the relative path of the file.
+            value: A integer of the remaining block number, or a string of the md5.
+        """
+        key = self._get_key(filename)
+        with self.lock:
+            index, free = self._find(key)
+            if free is None:
+                raise MemoryError("The state table is full of files in transmission")
+            self._write(free, key, value)
+
+    def update(self, items):
+        """Set the status of files.
+
+        Args:
+            items: A dictionary of relative filepath (keys) and status (values).
+        """
+        for filename, value in items.items():
+            self[filename] = value
+
+    def setdefault(self, filename, value):
+        """Set the status of a file if it is not in the table.
+
+        Args:
+            filename: A string of the relative path of the file.
+            value: A integer of the remaining block number, or a string of the md5.
+
+        Returns:
+            The status of the file.
+        """
+        key = self._get_key(filename)
+        with self.lock:
+            index, free = self._find(key)
+            if index is not None:
+                return self._get_value(self._read(index))
+            if free is None:
+                raise MemoryError("The state table is full of files in transmission")
+            self._write(free, key, value)
+            return value
+
+    def pop(self, filename, default=None):
+        """Remove a file from the table.
+
+        Args:
+            filename: A string of the relative path of the file.
+            default: The value returned if the file is not in the table.
+
+        Returns:
+            The status of the removed file, or default.
+        """
+        with self.lock:
+            index, _ = self._find(self._get_key(filename))
+            if index is None:
+                return default
+            slot = self._read(index)
+            self._delete(index)
+            return self._get_value(slot)
+
+    def complete(self, filename):
+        """Count a received block of a file in transmission atomically.
+
+        Args:
+            filename: A string of the relative path of the file.
+
+        Returns:
+            None if the file is not in transmission (e.g. a block is sent again after the file is
+            finished), or a integer of the remaining block number.
+        """
+        with self.lock:
+            index, _ = self._find(self._get_key(filename))
+            if index is None:
+                return None
+            key, status, count, _ = self._read(index)
+            if status != self.COUNTING or count <= 0:
+                return None
+            self._write(index, key, count - 1)
+            return count - 1
+
+    def protect(self, filename, file_info):
+        """Decide whether a scanned file is from another device atomically. The file is
+        protected if it is in transmission or its file_info is not changed after it is finished.
+        Otherwise, the changed file is removed from the table.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_info: A string of specific file identification mark (e.g. md5).
+
+        Returns:
+            A bool of whether the file should be neglected by the scanner.
+        """
+        with self.lock:
+            index, _ = self._find(self._get_key(filename))
+            if index is None:
+                return False
+            slot = self._read(index)
+            if slot[1] == self.COUNTING or self._get_value(slot) == file_info:
+                return True
+            self._delete(index)
+            return False
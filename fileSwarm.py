@@ -0,0 +1,354 @@
+# -*- coding: UTF-8 -*-
+"""
+Pulling of the files from several swarm peers in parallel.
+"""
+
+import collections
+import os
+
+import fileLoader
+import fileMetrics
+
+SWARM_WINDOW_SIZE = 2 * fileLoader.TEMP_FILE_SIZE
+SWARM_ENDGAME_NUM = 2
+SWARM_TIMEOUT = 60
+SWARM_CHECK_INTERVAL = 5
+SWARM_RECV_NUM = 4
+SWARM_SEND_NUM = 4
+SWARM_RETRY_NUM = 2
+SWARM_REPLACED_NUM = 1024
+CONNECT_RETRIES = 3
+
+
+def parse_addr(text):
+    """Parse a address of a peer of the command line, e.g. a swarm or relay peer.
+
+    Args:
+        text: A string of 'ip:port'.
+
+    Returns:
+        A address-like set of the ip and port.
+    """
+    ip, sep, port = text.rpartition(':')
+    if not sep or not ip:
+        raise ValueError("The peer should be ip:port: {}".format(text))
+    return ip, int(port)
+
+
+def get_manifest(filenames, recv_dict, root):
+    """Get the entries of the files to announce by HAVE command.
+
+    Args:
+        filenames: A iterable of strings of the relative paths of the files.
+        recv_dict: A instance of fileState.stateTable, where the files in transmission are not
+        announced.
+        root: A string of the relative path of the shared folder, out of which the files are not
+        announced.
+
+    Returns:
+        A list of [filename, size, md5] of the files, where md5 is None if the file is not held.
+    """
+    # Merge the local files hashed by the scanner.
+    fileLoader.get_hash_cache().load()
+    manifest = list()
+    for filename in filenames:
+        if isinstance(recv_dict.get(filename), int) or not fileLoader.is_shared(filename, root):
+            continue
+        try:
+            manifest.append([filename, os.path.getsize(filename),
+                             fileLoader.get_file_info(filename)])
+        except OSError:
+            manifest.append([filename, 0, None])
+    return manifest
+
+
+def list_files(root):
+    """List the files in a root path to announce.
+
+    Args:
+        root: A string of the root path.
+
+    Returns:
+        A list of strings of the relative paths of the files.
+    """
+    filenames = list()
+    for path, dirs, files in os.walk(root):
+        filenames.extend(os.path.join(path, name) for name in files
+                         if not name.endswith(fileLoader.PART_SUFFIX))
+    return filenames
+
+
+class _download(object):
+    """A auxiliary class of the status of a file pulled from the swarm peers.
+
+    Attributes:
+        filename: A string of the relative path of the file.
+        file_size: A integer of the size of the file.
+        file_hash: A string of the md5 of the file.
+        missing: A set of the indexes of the blocks which are not verified.
+        pending: A deque of the indexes of the blocks which are not requested.
+        requested: A dictionary of the indexes of the requested blocks (keys) and dictionaries of
+        the addresses of the peers (keys) and the time of the requests (values).
+        served: A collections.Counter of the addresses of the peers (keys) and the numbers of
+        verified blocks requested from them first.
+        attempt: A integer of the number of previous pulls of the version, which are finished
+        with a wrong md5.
+    """
+    def __init__(self, filename, file_size, file_hash, missing, attempt=0):
+        self.filename = filename
+        self.file_size = file_size
+        self.file_hash = file_hash
+        self.attempt = attempt
+        self.missing = set(missing)
+        self.pending = collections.deque(sorted(missing))
+        self.requested = dict()
+        self.served = collections.Counter()
+
+    def get_block_size(self, block_index):
+        return min(fileLoader.TEMP_FILE_SIZE,
+                   self.file_size - block_index * fileLoader.TEMP_FILE_SIZE)
+
+    def next_block(self, addr):
+        """Choose the next block to request from a peer. When all the blocks are requested, a
+        block in transmission from other peers is requested again, so that a slow or lost peer
+        does not hold back the end of the file.
+
+        Args:
+            addr: A address-like set of the ip and port of the peer.
+
+        Returns:
+            None or a integer of the index of the block.
+        """
+        while self.pending:
+            block_index = self.pending.popleft()
+            if block_index in self.missing:
+                return block_index
+        candidates = [(len(peers), min(peers.values()), block_index)
+                      for block_index, peers in self.requested.items()
+                      if addr not in peers and len(peers) < SWARM_ENDGAME_NUM]
+        if not candidates:
+            return None
+        return min(candidates)[2]
+
+
+class swarmTable(object):
+    """A table of the swarm peers, the versions of the files they hold and the files pulled
+    from them in the main process.
+
+    The blocks of a file are requested from all the peers holding its version. The size of the
+    blocks in transmission from each peer is limited by window_size, and a peer is requested
+    again only after a block is verified, so that a faster peer serves more blocks.
+
+    Attributes:
+        window_size: A integer of the maximum size of the blocks in transmission from a peer.
+        timeout: A integer of the time (second) after which a request is regarded as lost.
+        peers: A set of the addresses of the swarm peers.
+        sources: A dictionary of relative filepath (keys) and dictionaries of md5 (keys) and sets
+        of the addresses of the peers holding the version (values).
+        downloads: A dictionary of relative filepath (keys) and _download (values) of the files
+        being pulled.
+        loads: A collections.Counter of the addresses of the peers (keys) and the size of the
+        blocks in transmission from them (values).
+        replaced: A ordered dictionary of the recent sets of the relative filepath and the md5 of
+        the finished or replaced pulls, whose blocks still in transmission are not counted.
+    """
+    def __init__(self, window_size=SWARM_WINDOW_SIZE, timeout=SWARM_TIMEOUT):
+        self.window_size = window_size
+        self.timeout = timeout
+        self.peers = set()
+        self.sources = dict()
+        self.downloads = dict()
+        self.loads = collections.Counter()
+        self.replaced = collections.OrderedDict()
+
+    def add_peer(self, addr):
+        """Add a swarm peer.
+
+        Args:
+            addr: A address-like set of the ip and port of the peer.
+
+        Returns:
+            A bool of whether the peer is new.
+        """
+        if addr in self.peers:
+            return False
+        self.peers.add(addr)
+        return True
+
+    def drop_peer(self, addr):
+        """Remove a unreachable peer. Its requested blocks are requested from other peers.
+
+        Args:
+            addr: A address-like set of the ip and port of the peer.
+        """
+        self.peers.discard(addr)
+        for versions in self.sources.values():
+            for peers in versions.values():
+                peers.discard(addr)
+        for download in self.downloads.values():
+            for block_index in list(download.requested):
+                self._release(download, block_index, addr)
+
+    def add_source(self, addr, filename, file_hash):
+        """Record the version of a file held by a peer.
+
+        Args:
+            addr: A address-like set of the ip and port of the peer.
+            filename: A string of the relative path of the file.
+            file_hash: None or a string of the md5 of the file, which is None if the file is not
+            held by the peer.
+        """
+        versions = self.sources.setdefault(filename, dict())
+        for version, peers in versions.items():
+            if version != file_hash:
+                peers.discard(addr)
+        if file_hash is not None:
+            versions.setdefault(file_hash, set()).add(addr)
+
+        # The requests of another version are lost, e.g. the file is changed in the peer.
+        download = self.downloads.get(filename)
+        if download is not None and download.file_hash != file_hash:
+            for block_index in list(download.requested):
+                self._release(download, block_index, addr)
+
+    def start(self, filename, file_size, file_hash, missing, attempt=0):
+        """Start to pull a file.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_size: A integer of the size of the file.
+            file_hash: A string of the md5 of the file.
+            missing: A list of the indexes of the blocks which are not verified.
+            attempt: A integer of the number of previous pulls of the version.
+        """
+        self.replaced.pop((filename, file_hash), None)
+        self.downloads[filename] = _download(filename, file_size, file_hash, missing, attempt)
+
+    def is_replaced(self, filename, file_hash):
+        """Decide whether a received block is of a finished or replaced pull, e.g. a block
+        requested again in the end or a block of the previous version of a changed file.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_hash: A string of the md5 of the block.
+
+        Returns:
+            A bool of whether the block should not be counted.
+        """
+        return (filename, file_hash) in self.replaced
+
+    def cancel(self, filename, file_hash):
+        """Stop pulling a file if another version of it is received, e.g. pushed by the target.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_hash: None or a string of the md5 of the received version.
+        """
+        download = self.downloads.get(filename)
+        if download is not None and download.file_hash != file_hash:
+            self.finish(filename)
+
+    def retry(self, filename, file_hash, block_index):
+        """Request a corrupt block of a pulled file again.
+
+        Args:
+            filename: A string of the relative path of the file.
+            file_hash: None or a string of the md5 of the block.
+            block_index: A integer of the index of the block.
+
+        Returns:
+            A bool of whether the file is pulled, so that the block is requested from the swarm
+            peers again.
+        """
+        download = self.downloads.get(filename)
+        if download is None or download.file_hash != file_hash:
+            return False
+        for addr in list(download.requested.get(block_index, ())):
+            self._release(download, block_index, addr)
+        return True
+
+    def complete(self, filename, block_index):
+        """Mark a block of a pulled file as verified, which frees the window of the peers.
+
+        Args:
+            filename: A string of the relative path of the file.
+            block_index: A integer of the index of the block.
+        """
+        download = self.downloads.get(filename)
+        if download is None:
+            return
+        download.missing.discard(block_index)
+        peers = download.requested.pop(block_index, dict())
+        for addr in peers:
+            self.loads[addr] -= download.get_block_size(block_index)
+        if peers:
+            addr = min(peers, key=peers.get)
+            download.served[addr] += 1
+            fileMetrics.inc('swarm_blocks', peer='{}:{}'.format(*addr))
+
+    def finish(self, filename):
+        """Stop pulling a file.
+
+        Args:
+            filename: A string of the relative path of the file.
+
+        Returns:
+            None or the _download of the file.
+        """
+        download = self.downloads.pop(filename, None)
+        if download is not None:
+            self.replaced[(filename, download.file_hash)] = None
+            if len(self.replaced) > SWARM_REPLACED_NUM:
+                self.replaced.popitem(last=False)
+            for block_index, peers in download.requested.items():
+                for addr in peers:
+                    self.loads[addr] -= download.get_block_size(block_index)
+        return download
+
+    def expire(self, now):
+        """Give up the requests without response in the timeout, whose blocks are requested again.
+
+        Args:
+            now: A float of the current time.
+        """
+        for download in self.downloads.values():
+            for block_index, peers in list(download.requested.items()):
+                for addr, request_time in list(peers.items()):
+                    if now - request_time > self.timeout:
+                        fileMetrics.inc('swarm_timeouts')
+                        self._release(download, block_index, addr)
+
+    def schedule(self, now):
+        """Fill the windows of the peers with the blocks of the pulled files.
+
+        Args:
+            now: A float of the current time.
+
+        Returns:
+            A list of sets of the address of the peer, the relative path, the md5 and the index of
+            the block to request.
+        """
+        requests = list()
+        for download in self.downloads.values():
+            sources = self.sources.get(download.filename, dict()).get(download.file_hash, set())
+            # The least loaded peers are requested first.
+            for addr in sorted(sources & self.peers, key=lambda i: self.loads[i]):
+                while self.loads[addr] < self.window_size:
+                    block_index = download.next_block(addr)
+                    if block_index is None:
+                        break
+                    download.requested.setdefault(block_index, dict())[addr] = now
+                    self.loads[addr] += download.get_block_size(block_index)
+                    requests.append((addr, download.filename, download.file_hash, block_index))
+        return requests
+
+    def _release(self, download, block_index, addr):
+        peers = download.requested.get(block_index)
+        if peers is None or addr not in peers:
+            return
+        del peers[addr]
+        self.loads[addr] -= download.get_block_size(block_index)
+        if not peers:
+            del download.requested[block_index]
+            if block_index in download.missing:
+                download.pending.appendleft(block_index)
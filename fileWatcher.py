@@ -0,0 +1,170 @@
+# -*- coding: UTF-8 -*-
+"""
+Watching of the changed files in the shared folder by the inotify syscalls of Linux.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT_SIZE = 64 * 1024
+
+_event_format = struct.Struct('iIII')
+
+
+class inotifyWatcher(object):
+    """A class to watch the changed files in a directory tree by the inotify syscalls of Linux.
+
+    The files are reported when they are closed after writing or moved in, so that the files in
+    writing are not reported. The files which are moved out or deleted are also reported to
+    be removed. New directories are watched and reported as a whole.
+
+    Attributes:
+        mask: A integer of the watched inotify events.
+        root: A string of the root path to watch.
+        libc: A ctypes library of the C standard library.
+        fd: A integer of the file descriptor of the inotify instance.
+        watches: A dictionary of watch descriptors (keys) and the watched paths (values).
+    """
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.libc.inotify_init1.argtypes = [ctypes.c_int]
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise self._error()
+        self.watches = dict()
+        self.add_tree(self.root)
+
+    def add_watch(self, path):
+        """Watch a directory.
+
+        Args:
+            path: A string of the path of the directory.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            raise self._error(path)
+        self.watches[wd] = path
+
+    def add_tree(self, root):
+        """Watch a directory and all the sub-directories in it.
+
+        Args:
+            root: A string of the path of the root directory.
+        """
+        self.add_watch(root)
+        for path, dirs, files in os.walk(root):
+            for name in dirs:
+                try:
+                    self.add_watch(os.path.join(path, name))
+                except OSError:
+                    # The directory is removed meanwhile.
+                    pass
+
+    def remove_tree(self, root):
+        """Stop watching a directory and all the sub-directories in it.
+
+        Args:
+            root: A string of the path of the root directory.
+        """
+        for wd, path in list(self.watches.items()):
+            if path == root or path.startswith(root + os.sep):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                self.watches.pop(wd)
+
+    def read(self, timeout):
+        """Wait and read the changed paths.
+
+        Args:
+            timeout: A float of the maximum waiting time (second).
+
+        Returns:
+            None if the events are overflowed and a full scanning is needed, or a set of the
+            changed paths which may be files or directories. The set is empty if timeout.
+        """
+        paths = set()
+        readable = select.select([self.fd], [], [], timeout)[0]
+        while readable:
+            try:
+                data = os.read(self.fd, EVENT_SIZE)
+            except BlockingIOError:
+                break
+            for mask, path in self._parse(data):
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self.add_tree(path)
+                    except OSError:
+                        pass
+                elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                    # The watches keep the old paths after moving, so they are watched again
+                    # by the IN_MOVED_TO event if moved inside the root.
+                    self.remove_tree(path)
+                elif mask & IN_CREATE:
+                    # New files are reported when closed after writing.
+                    continue
+                paths.add(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+    def _parse(self, data):
+        """Parse the raw inotify events.
+
+        Args:
+            data: A bytes of the raw inotify_event structures.
+
+        Returns:
+            A list of (mask, path) of events.
+        """
+        events = list()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_format.unpack_from(data, offset)
+            offset += _event_format.size
+            name = data[offset: offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                events.append((mask, None))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or mask & IN_DELETE_SELF:
+                continue
+            path = self.watches[wd]
+            if name:
+                path = os.path.join(path, os.fsdecode(name))
+            events.append((mask, path))
+        return events
+
+    @staticmethod
+    def _error(path=None):
+        code = ctypes.get_errno() or errno.EINVAL
+        return OSError(code, os.strerror(code), path)
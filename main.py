@@ -6,22 +6,65 @@
 """
 
 import argparse
+import logging
 
+import fileScheduler
 import fileSocket
+import fileSwarm
 
 
 def _argparse():
     parser = argparse.ArgumentParser(description="The target ipv4 address.")
     parser.add_argument('--ip', action='store', required=True, dest='ip', help='ip')
+    parser.add_argument('--port', action='store', type=int, default=25795, dest='port',
+                        help='local port')
+    parser.add_argument('--peer-port', action='store', type=int, default=None, dest='peer_port',
+                        help='port of the target if different from the local port')
+    parser.add_argument('--engine', action='store', choices=('thread', 'async'), default='thread',
+                        dest='engine', help='engine to send and receive files')
+    parser.add_argument('--metrics-port', action='store', type=int, default=None,
+                        dest='metrics_port', help='local port of the HTTP stats endpoint')
+    parser.add_argument('--metrics-interval', action='store', type=int, default=60,
+                        dest='metrics_interval',
+                        help='seconds between logged metrics, 0 to disable')
+    parser.add_argument('--schedule', action='store', choices=fileScheduler.POLICIES,
+                        default=fileScheduler.DEFAULT_POLICY, dest='policy',
+                        help='order of the blocks of different files')
+    parser.add_argument('--priority', action='append', type=fileScheduler.parse_rule,
+                        default=[], dest='rules', metavar='PATTERN=PRIORITY',
+                        help='send the matched files first if the priority is higher, '
+                             'e.g. "*.conf=1"')
+    parser.add_argument('--profile', action='store_true', dest='profile',
+                        help='record the time of the commands, dumped by SIGUSR1')
+    parser.add_argument('--profile-stacks', action='store_true', dest='profile_stacks',
+                        help='also sample the stacks of the threads for flame graphs')
+    parser.add_argument('--swarm-peer', action='append', type=fileSwarm.parse_addr, default=[],
+                        dest='swarm_peers', metavar='IP:PORT',
+                        help='swarm peer to pull the missing files from and serve, repeated for more '
+                             'peers')
+    parser.add_argument('--relay', action='append', type=fileSwarm.parse_addr, default=[],
+                        dest='relay_peers', metavar='IP:PORT',
+                        help='peer to forward the received blocks to, which forms a chain or tree')
 
     return parser.parse_args()
 
 
 def main():
     parser = _argparse()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
     # The port should be between 20000 and 30000.
-    new_fileSocket = fileSocket.fileSocket(ip=parser.ip, port=25795, sock_num=4,
-                                           share_folder='./share')
+    # The number of sockets is adapted between the bounds by the measured throughput.
+    new_fileSocket = fileSocket.fileSocket(ip=parser.ip, port=parser.port, sock_num=4,
+                                           share_folder='./share', min_sock_num=1,
+                                           max_sock_num=16, engine=parser.engine,
+                                           peer_port=parser.peer_port,
+                                           metrics_port=parser.metrics_port,
+                                           metrics_interval=parser.metrics_interval,
+                                           policy=parser.policy, rules=parser.rules,
+                                           profile=parser.profile or parser.profile_stacks,
+                                           profile_stacks=parser.profile_stacks,
+                                           swarm_peers=parser.swarm_peers,
+                                           relay_peers=parser.relay_peers)
     new_fileSocket.start()
 
 
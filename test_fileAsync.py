@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+"""
+Tests of the asyncio engine against the basic framing of the thread engine.
+"""
+
+import asyncio
+import queue
+import socket
+import threading
+import unittest
+
+import fileAsync
+import fileScheduler
+import fileSocket
+from fileSocket import _protocol
+from test_fileLoader import folderTest
+from test_fileSocket import recv_message, send_message
+
+
+class loopQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_put_from_thread(self):
+        """The messages put by another thread are got in order in the event loop.
+        """
+        loop_queue = fileAsync._loopQueue(self.loop)
+        thread = threading.Thread(target=lambda: [loop_queue.put(i) for i in range(3)])
+        thread.start()
+        thread.join()
+
+        async def get_all():
+            return [await loop_queue.get() for _ in range(3)]
+
+        self.assertEqual(self.loop.run_until_complete(get_all()), [0, 1, 2])
+
+    def test_renew(self):
+        """The blocks of a file queued before it is sent again are skipped.
+        """
+        loop_queue = fileAsync._loopQueue(self.loop, fileScheduler.sendScheduler('fifo'))
+        send_file = fileSocket._sendThread.send_file
+        loop_queue.put((send_file, None, ('share/a', 0), 2, None))
+        loop_queue.put((send_file, None, ('share/b', 0), 1, None))
+        loop_queue.renew('share/a', 100)
+        loop_queue.put((send_file, None, ('share/a', 1), 2, None))
+
+        async def get_all():
+            return [(await loop_queue.get())[2] for _ in range(2)]
+
+        self.assertEqual(self.loop.run_until_complete(get_all()), [('share/b', 0), ('share/a', 1)])
+
+
+class engineTest(folderTest):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever)
+        self.loop_thread.start()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen()
+        self.listener.settimeout(10)
+
+    def tearDown(self):
+        self.listener.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        super().tearDown()
+
+    def run_coroutine(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(10)
+
+    def test_send_file(self):
+        """A block is sent by a task to a receiver of the basic framing, and the connection is
+        closed after VRFY command.
+        """
+        data = self.random.randbytes(100000)
+        self.write('share/a', data)
+        received = list()
+
+        def baseline_recv():
+            sock, _ = self.listener.accept()
+            sock.settimeout(10)
+            with sock:
+                while True:
+                    message = recv_message(sock)
+                    if message is None:
+                        break
+                    received.append(message)
+
+        receiver = threading.Thread(target=baseline_recv)
+        receiver.start()
+        addr = self.listener.getsockname()
+        send_socket = fileAsync.asyncSendSocket(addr, queue.Queue(), queue.Queue(),
+                                                fileAsync._loopQueue(self.loop),
+                                                fileAsync._loopQueue(self.loop), self.loop)
+        task = send_socket.new_thread()
+        self.run_coroutine(task.transmit(task.send_file(addr, ('share/a', 0), 1)))
+        receiver.join(10)
+
+        self.assertEqual(received[0], (_protocol.code.SEND, 'share/a', 1, len(data)))
+        self.assertEqual(received[-1], (_protocol.code.VRFY,))
+        self.assertEqual(b''.join(bytes(message[2]) for message in received[1:-1]), data)
+
+    def test_recv_file(self):
+        """A block of the basic framing is written by a task, and the main process is told to
+        count it.
+        """
+        data = self.random.randbytes(100000)
+        main_queue = queue.Queue()
+        recv_socket = fileAsync.asyncRecvSocket(('127.0.0.1', 0), main_queue,
+                                                fileAsync._loopQueue(self.loop), dict(), 'share')
+        server = self.run_coroutine(asyncio.start_server(recv_socket.accept,
+                                                         sock=recv_socket.recv_sock))
+        with socket.create_connection(recv_socket.recv_sock.getsockname(), timeout=10) as sock:
+            send_message(sock, _protocol.code.SEND, 'share/b', 1, len(data))
+            send_message(sock, _protocol.code.PAKG, 0, data[:60000])
+            send_message(sock, _protocol.code.PAKG, 60000, data[60000:])
+            send_message(sock, _protocol.code.VRFY)
+            # The connection is paused by the receiver after the block.
+            self.assertEqual(sock.recv(1), b'')
+
+        self.assertEqual(main_queue.get(timeout=10),
+                         (fileSocket.fileSocket.recv_send, 'share/b', 1, len(data), None))
+        self.assertEqual(main_queue.get(timeout=10),
+                         (fileSocket.fileSocket.recv_vrfy, 'share/b', None, None))
+        self.assertEqual(self.read('share/b'), data)
+        server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,284 @@
+# -*- coding: UTF-8 -*-
+"""
+Tests of the loaders, writers and journal of the files in a temporary working directory.
+"""
+
+import hashlib
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import fileLoader
+
+
+class folderTest(unittest.TestCase):
+    """A base class which runs each test in a new temporary working directory, as the files and
+    the hash cache are found by relative paths.
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+        os.makedirs('share')
+        # The hash cache is shared by the process, so each test owns a new cache.
+        fileLoader._hash_cache = None
+        self.random = random.Random(201)
+
+    def tearDown(self):
+        fileLoader._hash_cache = None
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def write(self, filename, data):
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+
+    def read(self, filename):
+        with open(filename, 'rb') as fp:
+            return fp.read()
+
+    def write_sparse(self, filename, ranges, size):
+        """Write the data at the positions of a file with holes between them, or skip the test if
+        the file system does not make holes.
+
+        Args:
+            filename: A string of the relative path of the file.
+            ranges: A list of sets of the position and the data.
+            size: A integer of the size of the file.
+        """
+        with open(filename, 'wb') as fp:
+            for position, data in ranges:
+                fp.seek(position)
+                fp.write(data)
+            fp.truncate(size)
+        loader = fileLoader.blockLoader(filename)
+        is_sparse = loader.is_sparse()
+        loader.close()
+        if not is_sparse:
+            self.skipTest('The file system does not make holes.')
+
+
+class deltaTest(folderTest):
+    block_size = 4096
+
+    def apply(self, filename, basis, delta):
+        """Rebuild a file from its delta against the basis file like the receiver.
+        """
+        writer = fileLoader.fileWriter(filename, delta.file_size, basis=basis)
+        for position, size, offset, data in delta:
+            if data is None:
+                writer.copy(position, offset, size)
+            else:
+                writer.write(position, data)
+        writer.close()
+
+    def test_rebuild(self):
+        """An inserted and an overwritten range are sent as literal data, and the other blocks are
+        copied from the old copy even at the shifted offsets.
+        """
+        old = self.random.randbytes(64 * self.block_size)
+        new = old[:1000] + b'inserted' + old[1000:30000] + bytes(500) + old[30500:]
+        self.write('share/old', old)
+        self.write('share/new', new)
+
+        signatures = fileLoader.get_signatures('share/old', self.block_size)
+        delta = fileLoader.deltaLoader('share/new', signatures, self.block_size)
+        self.assertIsNotNone(delta.instructions)
+        literal = sum(size for _, size, offset in delta.instructions if offset is None)
+        self.assertLess(literal, 4 * self.block_size)
+
+        self.apply('share/old', 'share/old', delta)
+        self.assertEqual(self.read('share/old'), new)
+        self.assertFalse(os.path.exists('share/old' + fileLoader.PART_SUFFIX))
+
+    def test_new_content(self):
+        """A file whose content is mostly new has no delta, so the whole file is sent.
+        """
+        self.write('share/old', self.random.randbytes(64 * self.block_size))
+        self.write('share/new', self.random.randbytes(64 * self.block_size))
+
+        signatures = fileLoader.get_signatures('share/old', self.block_size)
+        delta = fileLoader.deltaLoader('share/new', signatures, self.block_size)
+        self.assertIsNone(delta.instructions)
+        delta.close()
+
+
+class journalTest(folderTest):
+    def test_resume(self):
+        """The verified blocks are kept after a restart, and requested by the bitmap.
+        """
+        journal = fileLoader.transferJournal()
+        journal.start('share/a', 100, 'md5', 10)
+        self.assertTrue(journal.complete('share/a', 0))
+        self.assertTrue(journal.complete('share/a', 9))
+        self.assertFalse(journal.complete('share/a', 9))
+
+        journal = fileLoader.transferJournal()
+        self.assertIn('share/a', journal)
+        self.assertEqual(journal.remaining('share/a'), 8)
+        self.assertEqual(journal.bitmap('share/a'), b'\x01\x02')
+
+        # The same version continues, while a changed version starts again.
+        journal.start('share/a', 100, 'md5', 10)
+        self.assertEqual(journal.remaining('share/a'), 8)
+        journal.start('share/a', 100, 'other', 10)
+        self.assertEqual(journal.remaining('share/a'), 10)
+
+        journal.finish('share/a')
+        self.assertNotIn('share/a', fileLoader.transferJournal())
+
+    def test_broken_file(self):
+        """A journal file cut by a crash is dropped instead of failing the startup.
+        """
+        self.write(fileLoader.JOURNAL_PATH, b'{"share/a": [100, ')
+        self.assertEqual(fileLoader.transferJournal().entries, dict())
+
+
+class bundleTest(folderTest):
+    def test_split(self):
+        """The files are split by the number of files and the size of a bundle in order.
+        """
+        for i, size in enumerate([40, 40, 40, 90, 10, 10]):
+            self.write('share/f%d' % i, bytes(size))
+        filenames = ['share/f%d' % i for i in range(6)]
+
+        with mock.patch.object(fileLoader, 'BUNDLE_SIZE', 100), \
+                mock.patch.object(fileLoader, 'BUNDLE_FILE_NUM', 2):
+            self.assertEqual(fileLoader.split_bundles(filenames),
+                             [filenames[0:2], filenames[2:3], filenames[3:5], filenames[5:6]])
+
+    def test_unpack(self):
+        """The data of a bundle spans the files, which are written back by the manifest.
+        """
+        files = {'share/a': b'', 'share/b': self.random.randbytes(10),
+                 'share/c/d': self.random.randbytes(100), 'share/e': b'e'}
+        os.makedirs('share/c')
+        for filename, data in files.items():
+            self.write(filename, data)
+        loader = fileLoader.bundleLoader(list(files), with_hash=True, data_size=7)
+        self.assertEqual(loader.size, 111)
+        self.assertEqual(loader.manifest[2], ['share/c/d', 100, fileLoader.get_file_info(
+            'share/c/d')])
+
+        manifest = [['recv/' + filename, size, file_hash]
+                    for filename, size, file_hash in loader.manifest]
+        writer = fileLoader.bundleWriter(manifest)
+        for position, data in loader:
+            writer.write(position, data)
+        self.assertEqual(writer.checksums(), loader.checksums())
+        writer.close()
+        for filename, data in files.items():
+            self.assertEqual(self.read('recv/' + filename), data)
+
+    def test_removed_file(self):
+        """A file removed before the bundle is read is left out of the manifest.
+        """
+        self.write('share/a', b'a')
+        loader = fileLoader.bundleLoader(['share/a', 'share/removed'])
+        self.assertEqual(loader.manifest, [['share/a', 1, None]])
+
+
+class dedupTest(folderTest):
+    block_size = 4096
+
+    def setUp(self):
+        super().setUp()
+        # The blocks are split small, while the chunks of hashing are still aligned to them.
+        for name, value in (('TEMP_FILE_SIZE', self.block_size), ('HASH_READ_SIZE', 1024)):
+            patcher = mock.patch.object(fileLoader, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.blocks = [self.random.randbytes(self.block_size) for _ in range(4)]
+
+    @staticmethod
+    def get_hashes(blocks):
+        return b''.join(hashlib.sha1(block).digest() for block in blocks)
+
+    def test_copy_blocks(self):
+        """The blocks held by another local file are copied, and the others are requested.
+        """
+        self.write('share/source', b''.join(self.blocks[:3]))
+        fileLoader.get_block_hashes('share/source')
+
+        blocks = [self.blocks[1], self.blocks[3], self.blocks[0]]
+        copied = fileLoader.copy_blocks('share/renamed', 3 * self.block_size,
+                                        self.get_hashes(blocks))
+        self.assertEqual(copied, [0, 2])
+        data = self.read('share/renamed')
+        self.assertEqual(data[:self.block_size], blocks[0])
+        self.assertEqual(data[2 * self.block_size:], blocks[2])
+
+    def test_old_copy(self):
+        """Only the blocks at the same index are kept from the old copy of the file itself.
+        """
+        self.write('share/a', b''.join(self.blocks[:2]))
+        fileLoader.get_block_hashes('share/a')
+
+        blocks = [self.blocks[0], self.blocks[0], self.blocks[3]]
+        copied = fileLoader.copy_blocks('share/a', 3 * self.block_size, self.get_hashes(blocks))
+        self.assertEqual(copied, [0])
+
+    def test_changed_source(self):
+        """A source file changed since it was hashed is not copied from.
+        """
+        self.write('share/source', self.blocks[0])
+        fileLoader.get_block_hashes('share/source')
+        self.write('share/source', self.blocks[1] + self.blocks[2])
+
+        copied = fileLoader.copy_blocks('share/b', self.block_size,
+                                        self.get_hashes(self.blocks[:1]))
+        self.assertEqual(copied, [])
+
+
+class sparseTest(folderTest):
+    """The sparse file has two data ranges, each followed by a hole.
+    """
+    size = 5 * fileLoader.HOLE_MIN_SIZE
+
+    def setUp(self):
+        super().setUp()
+        self.data = [self.random.randbytes(4096) for _ in range(2)]
+        self.ranges = [(0, 4096), (3 * fileLoader.HOLE_MIN_SIZE, 4096)]
+        self.write_sparse('share/sparse', [(position, data) for (position, _), data in
+                                           zip(self.ranges, self.data)], self.size)
+
+    def test_find_holes(self):
+        """The holes are skipped by the iteration, and the data ranges are read only.
+        """
+        loader = fileLoader.blockLoader('share/sparse')
+        self.assertEqual(loader.find_holes(), [[4096, 3 * fileLoader.HOLE_MIN_SIZE - 4096],
+                                               [3 * fileLoader.HOLE_MIN_SIZE + 4096,
+                                                2 * fileLoader.HOLE_MIN_SIZE - 4096]])
+        self.assertEqual(loader.get_ranges(), self.ranges)
+        self.assertEqual([(position, bytes(data)) for position, data in loader],
+                         [(position, data) for (position, _), data in zip(self.ranges, self.data)])
+
+    def test_small_hole(self):
+        """A hole smaller than HOLE_MIN_SIZE is sent as data.
+        """
+        self.write('share/dense', self.random.randbytes(fileLoader.HOLE_MIN_SIZE))
+        loader = fileLoader.blockLoader('share/dense')
+        self.assertFalse(loader.is_sparse())
+        self.assertEqual(loader.find_holes(), [])
+        loader.close()
+
+    def test_fill(self):
+        """A sparse file is not preallocated, and the old data in a hole is overwritten by zeros.
+        """
+        self.write('share/copy', self.random.randbytes(self.size // 2))
+        writer = fileLoader.fileWriter('share/copy', self.size, sparse=True)
+        loader = fileLoader.blockLoader('share/sparse')
+        for position, size in loader.find_holes():
+            writer.fill(position, size)
+        for position, data in loader:
+            writer.write(position, data)
+        writer.close()
+
+        self.assertEqual(self.read('share/copy'), self.read('share/sparse'))
+        self.assertLess(os.stat('share/copy').st_blocks * 512, self.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
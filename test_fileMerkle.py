@@ -0,0 +1,133 @@
+# -*- coding: UTF-8 -*-
+"""
+Tests of comparing the Merkle trees and ordering the versions of the files between sockets.
+"""
+
+import unittest
+
+import fileLoader
+import fileMerkle
+from test_fileLoader import folderTest
+
+
+class newerTest(unittest.TestCase):
+    def test_same_version(self):
+        self.assertFalse(fileMerkle.is_newer([1, 'a', '', 2], [1, 'a', '', 1]))
+
+    def test_in_transmission(self):
+        """The file still in transmission by another socket is not replaced.
+        """
+        self.assertFalse(fileMerkle.is_newer([1, 'b', '', 2], [1, 'a', None, None]))
+
+    def test_received_copy(self):
+        """A received copy is never newer, even if it is received later.
+        """
+        self.assertFalse(fileMerkle.is_newer([1, 'a', 'a', 2], [1, 'b', '', 1]))
+        # Another socket changes the version received from the local socket.
+        self.assertFalse(fileMerkle.is_newer([1, 'a', '', 2], [1, 'b', 'a', 1]))
+
+    def test_changed_version(self):
+        """The version changed from the one which another socket holds is newer, even if the
+        clock of the local host is behind.
+        """
+        self.assertTrue(fileMerkle.is_newer([1, 'b', 'a', 1], [1, 'a', '', 2]))
+        self.assertTrue(fileMerkle.is_newer([1, 'b', '', 1], [1, 'a', 'a', 2]))
+
+    def test_concurrent_changes(self):
+        """Both versions changed locally are ordered by the times and then the md5, so that
+        exactly one socket sends.
+        """
+        self.assertTrue(fileMerkle.is_newer([1, 'a', '', 2], [1, 'b', '', 1]))
+        self.assertFalse(fileMerkle.is_newer([1, 'b', '', 1], [1, 'a', '', 2]))
+        self.assertTrue(fileMerkle.is_newer([1, 'b', '', 1], [1, 'a', '', 1]))
+        self.assertFalse(fileMerkle.is_newer([1, 'a', '', 1], [1, 'b', '', 1]))
+
+
+class compareTest(unittest.TestCase):
+    file_num = 2 * fileMerkle.MERKLE_BUCKET_SIZE
+
+    def new_files(self):
+        return {'share/f%d' % i: [i, 'md5-%d' % i, '', i] for i in range(self.file_num)}
+
+    def sync(self, tree, peer_tree):
+        """Descend from the root like the sockets, and collect the files which the local tree
+        sends to another socket.
+        """
+        added = list()
+        updated = list()
+        prefixes = ['']
+        while prefixes:
+            prefix = prefixes.pop()
+            node_prefix, children, files = peer_tree.get_node(prefix)
+            self.assertEqual(node_prefix, prefix)
+            new_prefixes, new_added, new_updated = tree.compare(prefix, children, files)
+            prefixes.extend(new_prefixes)
+            added.extend(new_added)
+            updated.extend(new_updated)
+        return sorted(added), sorted(updated)
+
+    def test_same_files(self):
+        tree = fileMerkle.merkleTree(self.new_files())
+        self.assertEqual(tree.root, fileMerkle.merkleTree(self.new_files()).root)
+        self.assertEqual(tree.get_node('')[2], None)
+        self.assertEqual(self.sync(tree, fileMerkle.merkleTree(self.new_files())), ([], []))
+
+    def test_changed_files(self):
+        """Only the missing and newer local files are found, where a node with many files is
+        descended into.
+        """
+        tree = fileMerkle.merkleTree(self.new_files())
+        peer_files = self.new_files()
+        del peer_files['share/f1']
+        # Another socket changes f2 from the local version, and both sockets change f3.
+        peer_files['share/f2'][1:] = ['other', 'md5-2', 3]
+        peer_files['share/f3'][1:] = ['other', '', 100]
+        peer_files['share/extra'] = [0, 'extra', '', 0]
+        peer_tree = fileMerkle.merkleTree(peer_files)
+
+        self.assertEqual(self.sync(tree, peer_tree), (['share/f1'], []))
+        self.assertEqual(self.sync(peer_tree, tree), (['share/extra'], ['share/f2', 'share/f3']))
+
+    def test_in_transmission(self):
+        """The local files still in transmission are not sent, even to an empty socket.
+        """
+        files = self.new_files()
+        files['share/f0'][2:] = [None, None]
+        tree = fileMerkle.merkleTree(files)
+        self.assertEqual(self.sync(tree, fileMerkle.merkleTree()),
+                         (sorted(files.keys() - {'share/f0'}), []))
+
+    def test_update(self):
+        """The tree changed in place has the same root as a tree built at once.
+        """
+        files = self.new_files()
+        tree = fileMerkle.merkleTree(files)
+        tree.root
+        tree.update({'share/f0': None, 'share/f1': [1, 'other', '', 1]})
+        del files['share/f0']
+        files['share/f1'] = [1, 'other', '', 1]
+        self.assertEqual(tree.root, fileMerkle.merkleTree(files).root)
+
+
+class refreshTest(folderTest):
+    def test_refresh(self):
+        """The received versions are marked by the journal, and the files in transmission are
+        added by their expected size and md5.
+        """
+        self.write('share/local', b'local')
+        self.write('share/received', b'received')
+        self.write('share/counting', b'')
+        journal = fileLoader.transferJournal()
+        journal.receive('share/received', fileLoader.get_file_info('share/received'))
+        journal.start('share/counting', 100, 'md5', 1)
+
+        tree = fileMerkle.merkleTree()
+        tree.refresh('share', {'share/counting': 1}, journal)
+        self.assertEqual(tree.files['share/local'][2], '')
+        self.assertEqual(tree.files['share/received'][2],
+                         fileLoader.get_file_info('share/received'))
+        self.assertEqual(tree.files['share/counting'], [100, 'md5', None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: UTF-8 -*-
+"""
+Tests of the policies of scheduling the queued send commands.
+"""
+
+import unittest
+
+import fileLoader
+import fileScheduler
+import fileSocket
+
+BLOCK_SIZE = fileLoader.TEMP_FILE_SIZE
+
+
+def get_block(filename, block_index):
+    return fileSocket._sendThread.send_file, None, (filename, block_index), 0, None
+
+
+class schedulerTest(unittest.TestCase):
+    def new_scheduler(self, policy, rules=None):
+        """Get a scheduler with the blocks of a large file queued before a small file.
+        """
+        scheduler = fileScheduler.sendScheduler(policy, rules)
+        scheduler.renew('share/large', 3 * BLOCK_SIZE)
+        scheduler.renew('share/small', BLOCK_SIZE // 2)
+        for block_index in range(3):
+            scheduler.put(get_block('share/large', block_index))
+        scheduler.put(get_block('share/small', 0))
+        return scheduler
+
+    @staticmethod
+    def get_all(scheduler):
+        blocks = list()
+        while not scheduler.empty():
+            blocks.append(scheduler.get()[2])
+        return blocks
+
+    def test_fifo(self):
+        self.assertEqual(self.get_all(self.new_scheduler('fifo')),
+                         [('share/large', 0), ('share/large', 1), ('share/large', 2),
+                          ('share/small', 0)])
+
+    def test_srf(self):
+        """The file with the shortest remaining size is sent first.
+        """
+        self.assertEqual(self.get_all(self.new_scheduler('srf')),
+                         [('share/small', 0), ('share/large', 0), ('share/large', 1),
+                          ('share/large', 2)])
+
+    def test_rr(self):
+        """A block of each file is sent in turn.
+        """
+        self.assertEqual(self.get_all(self.new_scheduler('rr')),
+                         [('share/large', 0), ('share/small', 0), ('share/large', 1),
+                          ('share/large', 2)])
+
+    def test_priority(self):
+        """The files with a higher priority by the rules are sent first under any policy.
+        """
+        for policy in fileScheduler.POLICIES:
+            scheduler = self.new_scheduler(policy, [fileScheduler.parse_rule('*/large=1')])
+            self.assertEqual(self.get_all(scheduler)[-1], ('share/small', 0))
+
+    def test_other_commands(self):
+        """The commands other than the blocks are taken before any block.
+        """
+        scheduler = self.new_scheduler('fifo')
+        scheduler.put((fileSocket._sendThread.send_cont, None, 1, False, set(), ''))
+        self.assertIs(scheduler.get()[0], fileSocket._sendThread.send_cont)
+        self.assertEqual(scheduler.qsize(), 4)
+
+    def test_renew(self):
+        """The queued blocks of a file sent again are removed.
+        """
+        scheduler = self.new_scheduler('srf')
+        scheduler.get()
+        scheduler.renew('share/large', 2 * BLOCK_SIZE)
+        scheduler.put(get_block('share/large', 1))
+        self.assertEqual(self.get_all(scheduler), [('share/large', 1)])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            fileScheduler.sendScheduler('lifo')
+        with self.assertRaises(ValueError):
+            fileScheduler.parse_rule('*.conf')
+        self.assertEqual(fileScheduler.parse_rule('a=b=2'), ('a=b', 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
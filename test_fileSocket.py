@@ -0,0 +1,361 @@
+# -*- coding: UTF-8 -*-
+"""
+Tests of the messages sent and received by the sockets, including the CONT handshake between the
+sockets with optional features and the baseline sockets.
+"""
+
+import queue
+import socket
+import struct
+import threading
+import unittest
+import zlib
+
+import fileLoader
+import fileSocket
+from fileSocket import _protocol
+from test_fileLoader import folderTest
+
+
+def recv_message(sock):
+    """Receive a message in the basic framing.
+
+    Args:
+        sock: A socket to receive the message.
+
+    Returns:
+        None if the connection is closed, or a set of the code and arguments.
+    """
+    guide = fileSocket._link.recv_exactly(sock, _protocol.guide_struct.size)
+    if guide is None:
+        return None
+    package = fileSocket._link.recv_exactly(sock, _protocol.guide_struct.unpack(guide)[0])
+    return None if package is None else _protocol.unpack(package)
+
+
+def send_message(sock, code, *args):
+    """Send a message in the basic framing.
+
+    Args:
+        sock: A socket to send the message.
+        code: A _protocol.code of the message.
+        *args: The arguments of the message.
+    """
+    package = _protocol.pack(code, *args)
+    sock.sendall(_protocol.guide_struct.pack(len(package)) + package)
+
+
+def run_actions(actions):
+    """Run a send command without a connection, where every action succeeds.
+
+    Args:
+        actions: A generator returned by a send command of fileSocket._sendHandler.
+
+    Returns:
+        A list of sets of the code and arguments of the sent messages.
+        The return of the send command.
+    """
+    sent = list()
+    try:
+        action = next(actions)
+        while True:
+            if action[0] == 'write_package':
+                # The data in the buffers of blockLoader is copied before they are reused.
+                sent.append((action[1], tuple(bytes(arg) if isinstance(arg, memoryview) else arg
+                                              for arg in action[2])))
+            action = actions.send(None)
+    except StopIteration as e:
+        return sent, e.value
+
+
+def close_recv_socket(recv_socket):
+    """Close a receiver of the thread engine with a pool of one thread.
+
+    Args:
+        recv_socket: A instance of fileSocket.recvSocket.
+    """
+    # The thread leaves the shrunk pool after its next connection, before the socket is closed
+    # under it.
+    thread = recv_socket.thread_list[0]
+    recv_socket.init_thread(0)
+    socket.create_connection(recv_socket.recv_sock.getsockname(), timeout=10).close()
+    thread.join(10)
+    recv_socket.recv_sock.close()
+
+
+class contTest(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen()
+        self.addr = self.listener.getsockname()
+        self.listener.settimeout(10)
+
+    def tearDown(self):
+        self.listener.close()
+
+    @staticmethod
+    def new_recv_socket(main_queue):
+        recv_socket = fileSocket.recvSocket(('127.0.0.1', 0), main_queue, queue.Queue(), dict())
+        # The pool is shared by the class in a process, so each test owns a new pool.
+        recv_socket.thread_list = list()
+        recv_socket.init_thread(1)
+        return recv_socket
+
+    def test_send_to_baseline(self):
+        """A baseline receiver gets the two arguments of its recv_cont() and nothing else.
+        """
+        received = list()
+
+        def baseline_recv():
+            sock, _ = self.listener.accept()
+            sock.settimeout(10)
+            with sock:
+                code, *args = recv_message(sock)
+                received.append((code, args))
+                # The baseline recv_cont(sock_num, is_echo) pauses by closing the connection.
+                sock.shutdown(socket.SHUT_WR)
+                received.append(sock.recv(1))
+
+        receiver = threading.Thread(target=baseline_recv)
+        receiver.start()
+        send_socket = fileSocket.sendSocket(self.addr, queue.Queue(), queue.Queue())
+        thread = send_socket.new_thread()
+        thread.transmit(thread.send_cont(self.addr, 1, False, {'crc'}, ''))
+        receiver.join(10)
+
+        self.assertEqual(received, [(_protocol.code.CONT, [1, False]), b''])
+
+    def test_recv_features(self):
+        """A receiver with optional features asks for them by FEAT command.
+        """
+        main_queue = queue.Queue()
+        recv_socket = self.new_recv_socket(main_queue)
+        addr = recv_socket.recv_sock.getsockname()
+        send_socket = fileSocket.sendSocket(addr, queue.Queue(), queue.Queue())
+        thread = send_socket.new_thread()
+        thread.transmit(thread.send_cont(addr, 2, False, {'crc', 'v2'}, 'root'))
+
+        self.assertEqual(main_queue.get(timeout=10),
+                         (fileSocket.fileSocket.recv_cont, 2, False, 'crc,v2', 'root'))
+        close_recv_socket(recv_socket)
+
+    def test_recv_from_baseline(self):
+        """A baseline sender which closes the connection after CONT command is accepted without
+        features.
+        """
+        main_queue = queue.Queue()
+        recv_socket = self.new_recv_socket(main_queue)
+        with socket.create_connection(recv_socket.recv_sock.getsockname(), timeout=10) as sock:
+            send_message(sock, _protocol.code.CONT, 3, True)
+
+        self.assertEqual(main_queue.get(timeout=10), (fileSocket.fileSocket.recv_cont, 3, True))
+        close_recv_socket(recv_socket)
+
+
+class protocolTest(unittest.TestCase):
+    args = (True, 7, 1 << 40, 0.5, 'share/文件', b'\x00data', memoryview(b'view'))
+
+    def test_v2(self):
+        """The arguments of all the types are unpacked from the joined buffers of pack_v2().
+        """
+        buffers = _protocol.pack_v2(_protocol.code.PAKG, *self.args)
+        self.assertEqual(buffers[0][0], _protocol.version)
+        code, *args = _protocol.unpack(b''.join(buffers))
+        self.assertEqual(code, _protocol.code.PAKG)
+        self.assertEqual([bytes(i) if isinstance(i, memoryview) else i for i in args],
+                         [True, 7, 1 << 40, 0.5, 'share/文件', b'\x00data', b'view'])
+
+    def test_v1(self):
+        """The packages of v1 are told from v2 by the first byte.
+        """
+        args = (True, 7, 1 << 40, 0.5, 'share/file', b'\x00data')
+        package = _protocol.pack(_protocol.code.PAKG, *args)
+        self.assertNotEqual(package[0], _protocol.version)
+        self.assertEqual(_protocol.pack_buffers(_protocol.code.PAKG, *args, version=1), [package])
+        code, *unpacked = _protocol.unpack(memoryview(package))
+        self.assertEqual(code, _protocol.code.PAKG)
+        self.assertEqual([bytes(i) if isinstance(i, memoryview) else i for i in unpacked],
+                         list(args))
+
+    def test_no_arguments(self):
+        self.assertEqual(_protocol.unpack(b''.join(_protocol.pack_v2(_protocol.code.VRFY))),
+                         (_protocol.code.VRFY,))
+
+    def test_unknown_type(self):
+        with self.assertRaises(Exception):
+            _protocol.pack_v2(_protocol.code.PAKG, None)
+
+
+class codecTest(folderTest):
+    @staticmethod
+    def new_thread(features):
+        send_socket = fileSocket.sendSocket(('127.0.0.1', 0), queue.Queue(), queue.Queue())
+        send_socket.set_features(features)
+        thread = send_socket.new_thread()
+        thread.connect(send_socket.send_addr)
+        return thread
+
+    def test_negotiation(self):
+        """The first codec of fileLoader.CODECS supported by both sockets is used.
+        """
+        self.assertEqual(self.new_thread({'bz2', 'lzma', 'crc'}).codec, 'lzma')
+        self.assertIsNone(self.new_thread({'crc'}).codec)
+
+    def test_compressible(self):
+        """A compressible block is sent by ZPKG commands, which are decompressed to the data.
+        """
+        data = b'CAN201 Files Sharing\n' * 20000
+        self.write('share/text', data)
+        thread = self.new_thread({'zlib', 'crc'})
+        sent, (sent_size, _, crc) = run_actions(thread._send_data(fileLoader.blockLoader(
+            'share/text')))
+
+        self.assertEqual({code for code, _ in sent}, {_protocol.code.ZPKG})
+        self.assertEqual(b''.join(fileLoader.decompress(codec, data)
+                                  for _, (_, codec, data) in sent), data)
+        self.assertLess(sent_size, len(data) // 10)
+        self.assertEqual(crc, zlib.crc32(data))
+
+    def test_skip_incompressible(self):
+        """A block whose sample does not shrink is sent raw without compressing it.
+        """
+        data = self.random.randbytes(256 * 1024)
+        self.write('share/random', data)
+        thread = self.new_thread({'zlib'})
+        sent, (sent_size, _, crc) = run_actions(thread._send_data(fileLoader.blockLoader(
+            'share/random')))
+
+        self.assertEqual({code for code, _ in sent}, {_protocol.code.PAKG})
+        self.assertEqual(b''.join(data for _, (_, data) in sent), data)
+        self.assertEqual(sent_size, len(data))
+        self.assertIsNone(crc)
+
+
+class holeTest(folderTest):
+    @staticmethod
+    def new_thread(features):
+        thread = codecTest.new_thread(features)
+        # The sent blocks are recorded by the controller, which is not started.
+        thread.parent.controller = fileSocket._poolController(thread.parent, 1, 1)
+        return thread
+
+    def test_send_holes(self):
+        """The holes of a sparse file are sent as HOLE commands before the data, and the CRC32
+        covers the zeros of the holes.
+        """
+        size = 4 * fileLoader.HOLE_MIN_SIZE
+        data = self.random.randbytes(4096)
+        self.write_sparse('share/sparse', [(0, data)], size)
+        thread = self.new_thread({'sparse', 'crc'})
+        sent, _ = run_actions(thread.send_file(thread.parent.send_addr, ('share/sparse', 0), 1,
+                                                 'md5'))
+
+        self.assertEqual(sent, [(_protocol.code.SEND, ('share/sparse', 1, size, 0, 'md5', True)),
+                                (_protocol.code.HOLE, (4096, size - 4096)),
+                                (_protocol.code.PAKG, (0, data)),
+                                (_protocol.code.VRFY, (zlib.crc32(bytes(size - 4096),
+                                                                  zlib.crc32(data)),))])
+
+    def test_baseline(self):
+        """The holes are sent as zero data to the sockets without 'sparse' feature.
+        """
+        size = 4 * fileLoader.HOLE_MIN_SIZE
+        self.write_sparse('share/sparse', [(0, b'data')], size)
+        thread = self.new_thread(set())
+        sent, _ = run_actions(thread.send_file(thread.parent.send_addr, ('share/sparse', 0), 1,
+                                                 'md5'))
+
+        self.assertEqual(sent[0], (_protocol.code.SEND, ('share/sparse', 1, size, 0, 'md5')))
+        self.assertNotIn(_protocol.code.HOLE, [code for code, _ in sent])
+        self.assertEqual(b''.join(args[1] for code, args in sent if code == _protocol.code.PAKG),
+                         self.read('share/sparse'))
+
+
+class recvTest(folderTest):
+    """A base class which runs a receiver of the thread engine over the shared folder.
+    """
+    def setUp(self):
+        super().setUp()
+        self.main_queue = queue.Queue()
+        self.recv_socket = fileSocket.recvSocket(('127.0.0.1', 0), self.main_queue, queue.Queue(),
+                                                 dict(), 'share')
+        # The pool is shared by the class in a process, so each test owns a new pool.
+        self.recv_socket.thread_list = list()
+        self.recv_socket.init_thread(1)
+
+    def tearDown(self):
+        close_recv_socket(self.recv_socket)
+        super().tearDown()
+
+    def send(self, *messages):
+        """Send the messages to the receiver and wait until the connection is closed.
+
+        Args:
+            *messages: Sets of the code and arguments of the messages.
+        """
+        with socket.create_connection(self.recv_socket.recv_sock.getsockname(),
+                                      timeout=10) as sock:
+            for code, *args in messages:
+                send_message(sock, code, *args)
+            self.assertEqual(sock.recv(1), b'')
+
+
+class crcTest(recvTest):
+    def test_check_block(self):
+        """A block read back with a different CRC32 is requested again by its index.
+        """
+        data = self.random.randbytes(10000)
+        stream = fileSocket._recvStream(1)
+        stream.filename = 'share/a'
+        stream.fw = fileLoader.fileWriter('share/a', 3 * fileLoader.TEMP_FILE_SIZE)
+        stream.fw.write(2 * fileLoader.TEMP_FILE_SIZE, data)
+
+        self.assertEqual(stream.check(None), [])
+        self.assertEqual(stream.check(zlib.crc32(data)), [])
+        self.assertEqual(stream.check(zlib.crc32(data) ^ 1), [['share/a', 2, None]])
+        stream.close()
+
+    def test_check_bundle(self):
+        """Only the corrupt files of a bundle are requested again.
+        """
+        files = {'share/a': self.random.randbytes(100), 'share/b': self.random.randbytes(200)}
+        stream = fileSocket._recvStream(1)
+        stream.manifest = [[filename, len(data), 'md5'] for filename, data in files.items()]
+        stream.fw = fileLoader.bundleWriter(stream.manifest)
+        stream.fw.write(0, b''.join(files.values()))
+
+        crc = struct.pack('!2I', zlib.crc32(files['share/a']), zlib.crc32(b'corrupt'))
+        self.assertEqual(stream.check(memoryview(crc)), [['share/b', 0, 'md5']])
+        stream.close()
+
+    def test_recv_vrfy(self):
+        """A corrupt block is not counted, and the main process is told to request it again.
+        """
+        data = self.random.randbytes(1000)
+        self.send((_protocol.code.SEND, 'share/a', 2, 2000, 1, 'md5'),
+                  (_protocol.code.PAKG, 0, data),
+                  (_protocol.code.VRFY, zlib.crc32(data) ^ 1))
+
+        self.assertEqual(self.main_queue.get(timeout=10),
+                         (fileSocket.fileSocket.recv_send, 'share/a', 2, 2000, 'md5'))
+        self.assertEqual(self.main_queue.get(timeout=10),
+                         (fileSocket.fileSocket.retry_blocks, [['share/a', 1, 'md5']]))
+
+    def test_rtry(self):
+        """RTRY command carries the md5 only for a journaled file.
+        """
+        thread = fileSocket.sendSocket(('127.0.0.1', 0), queue.Queue(),
+                                       queue.Queue()).new_thread()
+        sent, _ = run_actions(thread.send_rtry(None, 'share/a', 1, None))
+        self.assertEqual(sent, [(_protocol.code.RTRY, ('share/a', 1))])
+        sent, _ = run_actions(thread.send_rtry(None, 'share/a', 1, 'md5'))
+        self.assertEqual(sent, [(_protocol.code.RTRY, ('share/a', 1, 'md5'))])
+
+        self.send((_protocol.code.RTRY, 'share/a', 1, 'md5'))
+        self.assertEqual(self.main_queue.get(timeout=10),
+                         (fileSocket.fileSocket.recv_rtry, 'share/a', 1, 'md5'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+"""
+Tests of rejecting the paths out of the shared folder from the swarm peers.
+"""
+
+import json
+import os
+import unittest
+
+import fileLoader
+import fileSocket
+import fileSwarm
+from fileSocket import _protocol
+from test_fileLoader import folderTest
+from test_fileSocket import recvTest
+
+
+class sharedTest(folderTest):
+    def test_is_shared(self):
+        os.makedirs('outside')
+        os.symlink(os.path.abspath('outside'), 'share/link')
+        self.assertTrue(fileLoader.is_shared('share/a', 'share'))
+        self.assertTrue(fileLoader.is_shared('./share/b/c', './share'))
+        self.assertFalse(fileLoader.is_shared('share', 'share'))
+        self.assertFalse(fileLoader.is_shared('share/../secret', 'share'))
+        self.assertFalse(fileLoader.is_shared('../secret', 'share'))
+        self.assertFalse(fileLoader.is_shared(os.path.abspath('share/a'), 'share'))
+        # A symbolic link out of the shared folder is followed.
+        self.assertFalse(fileLoader.is_shared('share/link/a', 'share'))
+
+    def test_manifest(self):
+        """The files out of the shared folder and the files in transmission are not announced.
+        """
+        self.write('share/a', b'a')
+        self.write('secret', b'secret')
+        manifest = fileSwarm.get_manifest(['share/a', 'share/b', 'share/../secret', 'share/c'],
+                                          {'share/c': 1}, 'share')
+        self.assertEqual(manifest, [['share/a', 1, fileLoader.get_file_info('share/a')],
+                                    ['share/b', 0, None]])
+
+
+class rejectTest(recvTest):
+    def test_have(self):
+        """A HAVE command with a path out of the shared folder is dropped as a whole.
+        """
+        manifest = [['share/a', 1, 'md5'], ['share/../../secret', 1, 'md5']]
+        self.send((_protocol.code.HAVE, json.dumps(manifest), 5000, False, False))
+        manifest = [['share/a', 1, 'md5']]
+        self.send((_protocol.code.HAVE, json.dumps(manifest), 5000, False, False))
+
+        self.assertEqual(self.main_queue.get(timeout=10),
+                         (fileSocket.fileSocket.recv_have, ('127.0.0.1', 5000), manifest, False,
+                          False))
+        self.assertTrue(self.main_queue.empty())
+
+    def test_getb(self):
+        """A GETB command of a file out of the shared folder is dropped.
+        """
+        self.send((_protocol.code.GETB, '/etc/passwd', 'md5', 0, 5000))
+        self.send((_protocol.code.GETB, 'share/a', 'md5', 0, 5000))
+
+        self.assertEqual(self.main_queue.get(timeout=10),
+                         (fileSocket.fileSocket.recv_getb, ('127.0.0.1', 5000), 'share/a', 'md5',
+                          0))
+        self.assertTrue(self.main_queue.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()